@@ -1,2 +1,8 @@
-from .djqscsv import (render_to_csv_response, write_csv,  # NOQA
-                      generate_filename, CSVException)  # NOQA
+from .djqscsv import (render_to_csv_response, render_to_zip_response,  # NOQA
+                      write_csv, generate_filename, CSVException)  # NOQA
+
+try:
+    from ._async import arender_to_csv_response  # NOQA
+except (ImportError, SyntaxError):
+    # asynchronous rendering requires Python 3.6+ and asgiref
+    pass
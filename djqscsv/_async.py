@@ -0,0 +1,194 @@
+"""
+Asynchronous counterparts of the CSV rendering functions, for projects that
+run django under ASGI.
+"""
+import time
+
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from django import VERSION as DJANGO_VERSION
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+from .djqscsv import (CSVException, DEFAULT_BUFFER_SIZE,
+                      DEFAULT_FLUSH_INTERVAL, _Compressor, _CSVExport, _Echo,
+                      _ExportStats, _get_compressed_filename,
+                      _get_header_chunks, _get_response_filename, _timer)
+from .signals import export_finished
+
+
+async def arender_to_csv_response(queryset, filename=None,
+                                  append_datestamp=False,
+                                  buffer_size=DEFAULT_BUFFER_SIZE,
+                                  buffer_rows=None,
+                                  flush_interval=DEFAULT_FLUSH_INTERVAL,
+                                  compression=None, content_encoding=True,
+                                  **kwargs):
+    """
+    the asynchronous version of `render_to_csv_response`, which streams
+    the CSV from an async generator instead of tying up a thread for the
+    whole download. the response body is the same as that of the
+    synchronous version.
+    """
+    if DJANGO_VERSION < (4, 2):
+        raise CSVException('streaming responses with an asynchronous body '
+                           'require Django 4.2 or later')
+
+    filename = _get_response_filename(queryset, filename, append_datestamp)
+
+    content_type = 'text/csv'
+    if compression and not content_encoding:
+        filename = _get_compressed_filename(filename, compression)
+        content_type = 'application/gzip'
+
+    content = _aiter_csv(queryset, _Echo(), **kwargs)
+    if buffer_size or buffer_rows:
+        content = _abuffer_chunks(content, buffer_size, buffer_rows,
+                                  flush_interval, _get_header_chunks(kwargs))
+    if compression:
+        content = _acompress_chunks(content, _Compressor(compression))
+    response = StreamingHttpResponse(content, content_type=content_type)
+
+    response['Content-Disposition'] = 'attachment; filename=%s;' % filename
+    response['Cache-Control'] = 'no-cache'
+    if compression and content_encoding:
+        response['Content-Encoding'] = compression
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+    return response
+
+
+async def _aiter_csv(queryset, file_obj, **kwargs):
+    """
+    the asynchronous version of `_iter_csv`. COPY is not used, as it
+    would have to run in a thread for the whole export.
+    """
+    kwargs['use_copy'] = False
+    if export_finished.has_listeners(queryset.model):
+        async for chunk in _aiter_instrumented_csv(queryset, file_obj,
+                                                   **kwargs):
+            yield chunk
+        return
+
+    export = _CSVExport(queryset, file_obj, **kwargs)
+
+    for chunk in export.write_header():
+        yield chunk
+
+    write_record = export.write_record
+    async for record in _arecords(export):
+        yield write_record(record)
+
+
+async def _aiter_instrumented_csv(queryset, file_obj, **kwargs):
+    """the asynchronous version of `_iter_instrumented_csv`."""
+    stats = _ExportStats(queryset, file_obj)
+    timings = stats.timings
+    try:
+        export = _CSVExport(queryset, stats.file_obj, **kwargs)
+
+        started = _timer()
+        for chunk in export.write_header():
+            written = _timer()
+            timings['write'] += written - started
+            yield chunk
+            started = _timer()
+            timings['downstream'] += started - written
+
+        writerow = export.writer.writerow
+        records = _arecords(export)
+        while True:
+            started = _timer()
+            try:
+                record = await records.__anext__()
+            except StopAsyncIteration:
+                stats.fetched(_timer() - started)
+                break
+            fetched = _timer()
+            stats.fetched(fetched - started)
+
+            row = export.serialize_record(record)
+            serialized = _timer()
+            result = writerow(row)
+            written = _timer()
+            timings['serialize'] += serialized - fetched
+            timings['write'] += written - serialized
+            stats.rows += 1
+            stats.written(written)
+            yield result
+            timings['downstream'] += _timer() - written
+
+        stats.completed = True
+    finally:
+        stats.send()
+
+
+async def _arecords(export):
+    """
+    iterates over the records of an export without blocking the event
+    loop, using the async ORM iteration where django provides it.
+    """
+    if (export.use_iterator and not export.keyset_page_size and
+            not export.many_related and
+            hasattr(export.values_qs, 'aiterator')):
+        # Django 4.1+, to-many related fields are fetched with the
+        # synchronous records below
+        records = export.values_qs.aiterator(
+            chunk_size=export.iterator_chunk_size)
+        async for record in records:
+            yield record
+        return
+
+    # otherwise, fetch one chunk of rows at a time in django's
+    # thread for database access
+    records = await sync_to_async(export.records)()
+    next_chunk = sync_to_async(_next_chunk)
+    while True:
+        chunk = await next_chunk(records, export.iterator_chunk_size)
+        if not chunk:
+            break
+        for record in chunk:
+            yield record
+
+
+def _next_chunk(records, size):
+    return list(islice(records, size))
+
+
+async def _abuffer_chunks(chunks, buffer_size, buffer_rows=None,
+                          flush_interval=None, header_chunks=0):
+    """the asynchronous version of `_buffer_chunks`."""
+    buffered = []
+    buffered_bytes = 0
+    last_flush = time.time()
+
+    async for chunk in chunks:
+        buffered.append(chunk)
+        buffered_bytes += len(chunk)
+        if header_chunks:
+            header_chunks -= 1
+            flush = not header_chunks
+        else:
+            flush = ((buffer_size and buffered_bytes >= buffer_size) or
+                     (buffer_rows and len(buffered) >= buffer_rows) or
+                     (flush_interval is not None and
+                      time.time() - last_flush >= flush_interval))
+        if flush:
+            yield b''.join(buffered)
+            buffered = []
+            buffered_bytes = 0
+            last_flush = time.time()
+
+    if buffered:
+        yield b''.join(buffered)
+
+
+async def _acompress_chunks(chunks, compressor):
+    """the asynchronous version of `_compress_chunks`."""
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk, flush=True)
+        if compressed:
+            yield compressed
+    yield compressor.finish()
@@ -5,42 +5,96 @@ Used internally, subject to change without notice.
 
 This module may later be officially supported.
 """
+import heapq
+import itertools
+import tempfile
+
+from collections import OrderedDict
+from operator import itemgetter
+
+import six
+from six.moves import cPickle as pickle
+
+# the most rows ORDER_BY sorts in memory before it spills them to disk
+DEFAULT_SORT_BUFFER_ROWS = 100000
+
+# the number of rows pickled together in a sorted run on disk
+SPILL_BATCH_SIZE = 1000
+
+# stands in for the numeric extreme of a MIN or MAX group with a text cell
+_TEXT = object()
 
 
 def _identity(x):
     return x
 
 
-def _transform(dataset, arg):
-    if isinstance(arg, str):
+def _split_header(dataset):
+    """returns the header row of a dataset and an iterator over the rest."""
+    rows = iter(dataset)
+    for header in rows:
+        return header, rows
+    raise ValueError('the dataset has no header row')
+
+
+def _transform(header, arg):
+    if isinstance(arg, six.string_types):
         field = arg
         display_name = arg
         transformer = _identity
     else:
         field, display_name, transformer = arg
         if field is None:
-            field = dataset[0][0]
-    return (dataset[0].index(field), display_name, transformer)
+            field = header[0]
+    return (header.index(field), display_name, transformer)
 
 
 def SELECT(dataset, *args):
-    # turn the args into indices based on the first row
-    index_headers = [_transform(dataset, arg) for arg in args]
-    results = []
+    """
+    takes any iterable of rows, header first, and returns a generator
+    over the selected columns. the header is read right away, the other
+    rows only as the result is consumed.
+    """
+    header, rows = _split_header(dataset)
+    # turn the args into indices based on the header row
+    index_headers = [_transform(header, arg) for arg in args]
+    return _select(index_headers, rows)
 
+
+def _select(index_headers, rows):
     # treat header row as special
-    results += [[header[1] for header in index_headers]]
+    yield [header[1] for header in index_headers]
 
     # add the rest of the rows
-    results += [[trans(datarow[i]) for i, h, trans in index_headers]
-                for datarow in dataset[1:]]
-    return results
+    project = _compile_projection(index_headers)
+    for datarow in rows:
+        yield project(datarow)
+
+
+def _compile_projection(index_headers):
+    """
+    returns a function that turns a row into the selected columns.
+
+    the function is generated from source, so that columns without a
+    transformer cost a single index instead of a call to _identity.
+    """
+    namespace = {}
+    cells = []
+    for position, (index, _, transformer) in enumerate(index_headers):
+        if transformer is _identity:
+            cells.append('row[%d]' % index)
+        else:
+            name = '_transformer_%d' % position
+            namespace[name] = transformer
+            cells.append('%s(row[%d])' % (name, index))
+    return eval('lambda row: [%s]' % ', '.join(cells), namespace)
 
 
 def EXCLUDE(dataset, *args):
-    antiargs = [value for index, value in enumerate(dataset[0])
+    header, rows = _split_header(dataset)
+    antiargs = [value for index, value in enumerate(header)
                 if index not in args and value not in args]
-    return SELECT(dataset, *antiargs)
+    return SELECT(itertools.chain([header], rows), *antiargs)
 
 
 def CONSTANT(value, display_name):
@@ -49,3 +103,313 @@ def CONSTANT(value, display_name):
 
 def AS(field, display_name):
     return (field, display_name, _identity)
+
+
+def WHERE(dataset, arg, predicate):
+    """
+    returns a generator over the header and the rows for which `predicate`
+    is true for the (transformed) value of the column `arg`.
+    """
+    header, rows = _split_header(dataset)
+    index, _, transformer = _transform(header, arg)
+    return _where(header, rows, index, transformer, predicate)
+
+
+def _where(header, rows, index, transformer, predicate):
+    yield header
+    for datarow in rows:
+        if predicate(transformer(datarow[index])):
+            yield datarow
+
+
+def ORDER_BY(dataset, *args, **kwargs):
+    """
+    returns a generator over the header and the rows sorted by the given
+    columns, compared by their transformed values. prefix a field name
+    with '-' to sort in descending order. the sort is stable.
+
+    at most `buffer_rows` rows are sorted in memory at a time. larger
+    datasets are sorted in runs that are spilled to temporary files and
+    merged while the result is consumed.
+    """
+    buffer_rows = kwargs.pop('buffer_rows', DEFAULT_SORT_BUFFER_ROWS)
+    if kwargs:
+        raise TypeError('unexpected keyword arguments: %s' %
+                        ', '.join(sorted(kwargs)))
+    if buffer_rows < 1:
+        raise ValueError('buffer_rows must be at least 1')
+
+    header, rows = _split_header(dataset)
+    columns = [_sort_column(header, arg) for arg in args]
+    return _order_by(header, rows, _sort_key(columns), buffer_rows)
+
+
+def _sort_column(header, arg):
+    field = arg if isinstance(arg, six.string_types) else arg[0]
+    descending = bool(field) and field.startswith('-')
+    if descending:
+        if isinstance(arg, six.string_types):
+            arg = (field[1:], field[1:], _identity)
+        else:
+            arg = (field[1:],) + tuple(arg[1:])
+    index, _, transformer = _transform(header, arg)
+    return index, transformer, descending
+
+
+def _sort_key(columns):
+    """returns a function that turns a row into its sort key."""
+    def values(datarow):
+        return tuple(transformer(datarow[index])
+                     for index, transformer, _ in columns)
+
+    descending = tuple(desc for _, _, desc in columns)
+    if not any(descending):
+        return values
+    return lambda datarow: _SortKey(values(datarow), descending)
+
+
+class _SortKey(object):
+    """
+    a sort key with a direction for every column. descending values can't
+    simply be negated, since they aren't necessarily numbers.
+    """
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __lt__(self, other):
+        for value, other_value, descending in zip(self.values, other.values,
+                                                  self.descending):
+            if value == other_value:
+                continue
+            if descending:
+                return other_value < value
+            return value < other_value
+        return False
+
+
+def _order_by(header, rows, key, buffer_rows):
+    yield header
+
+    runs = []
+    try:
+        while True:
+            run = list(itertools.islice(rows, buffer_rows))
+            run.sort(key=key)
+            if len(run) < buffer_rows and not runs:
+                # everything fits into memory
+                for datarow in run:
+                    yield datarow
+                return
+            if run:
+                runs.append(_spill(run))
+            if len(run) < buffer_rows:
+                break
+
+        # runs are merged in order, so rows with equal keys keep their
+        # original order
+        merged = heapq.merge(*[_read_run(run_file, key, run_index)
+                               for run_index, run_file in enumerate(runs)])
+        for _, _, datarow in merged:
+            yield datarow
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+
+def _spill(run):
+    """writes a sorted run to a temporary file and returns the file."""
+    run_file = tempfile.TemporaryFile()
+    for start in range(0, len(run), SPILL_BATCH_SIZE):
+        pickle.dump(run[start:start + SPILL_BATCH_SIZE], run_file,
+                    pickle.HIGHEST_PROTOCOL)
+    run_file.seek(0)
+    return run_file
+
+
+def _read_run(run_file, key, run_index):
+    """yields the rows of a sorted run as (key, run index, row) tuples."""
+    while True:
+        try:
+            batch = pickle.load(run_file)
+        except EOFError:
+            return
+        for datarow in batch:
+            yield key(datarow), run_index, datarow
+
+
+def GROUP_BY(dataset, *args):
+    """
+    returns a generator over the rows grouped by the columns among `args`,
+    with one column for each aggregate (COUNT, SUM, MIN or MAX) among them,
+    in the order of the arguments. groups appear in the order they are
+    first seen. the groups are collected in memory, so the result is only
+    produced once the dataset has been read.
+
+    MIN and MAX compare the cells of a column as numbers if they all are
+    numbers, and as text otherwise.
+    """
+    header, rows = _split_header(dataset)
+    columns = [arg.resolve(header) if isinstance(arg, _Aggregate)
+               else _transform(header, arg) for arg in args]
+    return _group_by(columns, rows)
+
+
+def _group_by(columns, rows):
+    yield [display_name for _, display_name, _ in columns]
+
+    # aggregate columns carry the aggregate in place of a transformer
+    is_aggregate = [isinstance(transformer, _Aggregate)
+                    for _, _, transformer in columns]
+    key_columns = [(index, transformer)
+                   for (index, _, transformer), aggregated
+                   in zip(columns, is_aggregate) if not aggregated]
+    aggregates = [(index, aggregate)
+                  for (index, _, aggregate), aggregated
+                  in zip(columns, is_aggregate) if aggregated]
+
+    groups = OrderedDict()
+    for datarow in rows:
+        key = tuple(transformer(datarow[index])
+                    for index, transformer in key_columns)
+        states = groups.get(key)
+        if states is None:
+            states = groups[key] = [aggregate.initial
+                                    for _, aggregate in aggregates]
+        for state_index, (index, aggregate) in enumerate(aggregates):
+            states[state_index] = aggregate.step(
+                states[state_index], datarow, index)
+
+    if not groups and not key_columns:
+        # like SQL, aggregating an empty dataset without grouping by any
+        # column gives a single row, with a count of 0
+        groups[()] = [aggregate.initial for _, aggregate in aggregates]
+
+    # an aggregate may finish a column differently once it has seen all
+    # of its groups
+    for state_index, (_, aggregate) in enumerate(aggregates):
+        column = aggregate.finish([group_states[state_index]
+                                   for group_states
+                                   in six.itervalues(groups)])
+        for states, value in zip(six.itervalues(groups), column):
+            states[state_index] = value
+
+    for key, states in six.iteritems(groups):
+        key_values = iter(key)
+        states = iter(states)
+        yield [next(states) if aggregated else next(key_values)
+               for aggregated in is_aggregate]
+
+
+class _Aggregate(object):
+    """
+    an aggregate column of GROUP_BY. `reduce` combines the value so far
+    with the transformed value of the next row, and empty values are
+    skipped like NULLs in SQL.
+    """
+
+    def __init__(self, field, display_name, transformer, reduce,
+                 initial=None):
+        self.field = field
+        self.display_name = display_name
+        self.transformer = transformer
+        self.reduce = reduce
+        self.initial = initial
+
+    def resolve(self, header):
+        """returns the column index, display name and the aggregate."""
+        if self.field is None:
+            return (None, self.display_name, self)
+        index, display_name, _ = _transform(
+            header, (self.field, self.display_name, self.transformer))
+        return (index, display_name, self)
+
+    def step(self, state, datarow, index):
+        if index is None:
+            return self.reduce(state, None)
+        value = datarow[index]
+        if value is None or value == '':
+            return state
+        value = self.transformer(value)
+        if state is None:
+            return value
+        return self.reduce(state, value)
+
+    def finish(self, states):
+        """returns the values of a column from the states of its groups."""
+        return states
+
+
+class _Extreme(_Aggregate):
+    """
+    MIN or MAX with the default transformer. the cells of a column are
+    compared as numbers while they all are numbers, so that '9' comes
+    before '10', and as text once one of them isn't, since numbers and
+    text can't be compared on Python 3. every group keeps both extremes
+    until the whole column has been read.
+    """
+
+    def __init__(self, field, display_name, pick):
+        super(_Extreme, self).__init__(field, display_name, _identity, pick)
+
+    def step(self, state, datarow, index):
+        value = datarow[index]
+        if value is None or value == '':
+            return state
+        try:
+            number = _number(value)
+        except ValueError:
+            number = _TEXT
+        text = (six.text_type(value), value)
+        if state is None:
+            return (number, text)
+
+        if number is _TEXT or state[0] is _TEXT:
+            number = _TEXT
+        else:
+            number = self.reduce(state[0], number)
+        return (number, self.reduce(state[1], text, key=itemgetter(0)))
+
+    def finish(self, states):
+        numeric = all(state is None or state[0] is not _TEXT
+                      for state in states)
+        return [None if state is None else
+                state[0] if numeric else state[1][1]
+                for state in states]
+
+
+def _number(value):
+    """turns text into an int or a float, leaving other values alone."""
+    if not isinstance(value, six.string_types):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def COUNT(display_name='count'):
+    return _Aggregate(None, display_name, _identity,
+                      lambda state, value: state + 1, initial=0)
+
+
+def SUM(field, display_name=None, transformer=_number):
+    return _Aggregate(field, display_name or field, transformer,
+                      lambda state, value: state + value)
+
+
+def MIN(field, display_name=None, transformer=None):
+    if transformer is None:
+        return _Extreme(field, display_name or field, min)
+    return _Aggregate(field, display_name or field, transformer, min)
+
+
+def MAX(field, display_name=None, transformer=None):
+    if transformer is None:
+        return _Extreme(field, display_name or field, max)
+    return _Aggregate(field, display_name or field, transformer, max)
@@ -0,0 +1,190 @@
+"""
+A cache for rendered CSV exports, so that repeated downloads of the same
+report don't run the query and serialize the rows every time.
+
+Pass an `ExportCache` as the `cache` argument of `render_to_csv_response`
+or `write_csv`.
+"""
+import hashlib
+import os
+import tempfile
+import uuid
+
+from django.apps import apps
+from django.db.models.signals import post_delete, post_save
+
+from .djqscsv import (_get_export_fingerprint, _get_export_querysets,
+                      _get_model_label)
+
+# the default total size in bytes of the cached exports
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# Python 2 has no atomic replace on windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+class ExportCache(object):
+    """
+    Stores rendered exports in `directory`, keyed by their compiled SQL
+    and export options.
+
+    once the cached exports take up more than `max_size` bytes, the least
+    recently used ones are removed. the exports of a model are invalidated
+    whenever one of its instances is saved or deleted, which covers every
+    model whose table the query reads. note that `QuerySet.update()`, bulk
+    operations and raw SQL don't send these signals.
+
+    the signals are watched from the start, so that processes which save
+    instances without ever exporting them still invalidate the exports of
+    other processes. by default every model is watched; pass `models` to
+    only watch the models that are exported.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, models=None):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+
+        for path in (self.directory, self._generations_directory()):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        for sender in (models if models is not None else [None]):
+            post_save.connect(self._invalidate_sender, sender=sender)
+            post_delete.connect(self._invalidate_sender, sender=sender)
+
+    def get_key(self, queryset, kwargs):
+        """
+        returns the key of the export of a queryset with the given export
+        options.
+        """
+        querysets = _get_export_querysets(queryset, kwargs)
+        values_qs = querysets[0]
+
+        generations = []
+        for model in _get_query_models(querysets):
+            generations.append((_get_model_label(model),
+                                self._get_generation(model)))
+
+        key_data = repr((_get_export_fingerprint(values_qs, kwargs),
+                         generations))
+        return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+    def open(self, key):
+        """
+        returns the cached export as an open binary file, or None if there
+        is no export for the key.
+        """
+        path = self._entry_path(key)
+        try:
+            cached = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        # mark the export as recently used
+        os.utime(path, None)
+        return cached
+
+    def store(self, key):
+        """
+        returns a file-like object to write the export for a key to. call
+        its `commit` method once the export is complete, or `discard` to
+        abandon it.
+        """
+        return _CacheEntry(self, key)
+
+    def invalidate(self, model):
+        """invalidates every cached export that reads from a model."""
+        path = self._generation_path(model)
+        with open(path + '.tmp', 'w') as generation_file:
+            generation_file.write(uuid.uuid4().hex)
+        _replace(path + '.tmp', path)
+
+    def clear(self):
+        """removes every cached export."""
+        for name in os.listdir(self.directory):
+            if name.endswith('.csv'):
+                _remove(os.path.join(self.directory, name))
+
+    def evict(self):
+        """
+        removes the least recently used exports until the cached exports
+        fit into `max_size`.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.csv'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            _remove(path)
+            total_size -= size
+
+    def _invalidate_sender(self, sender, **kwargs):
+        self.invalidate(sender)
+
+    def _get_generation(self, model):
+        try:
+            with open(self._generation_path(model)) as generation_file:
+                return generation_file.read()
+        except (IOError, OSError):
+            return ''
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, '%s.csv' % key)
+
+    def _generations_directory(self):
+        return os.path.join(self.directory, 'generations')
+
+    def _generation_path(self, model):
+        return os.path.join(self._generations_directory(),
+                            _get_model_label(model))
+
+
+class _CacheEntry(object):
+    """A file-like object that writes an export to the cache."""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.file = tempfile.NamedTemporaryFile(dir=cache.directory,
+                                                suffix='.tmp', delete=False)
+
+    def write(self, value):
+        self.file.write(value)
+
+    def commit(self):
+        self.file.close()
+        _replace(self.file.name, self.cache._entry_path(self.key))
+        self.cache.evict()
+
+    def discard(self):
+        self.file.close()
+        _remove(self.file.name)
+
+
+def _get_query_models(querysets):
+    """returns the models whose tables the querysets read from."""
+    tables = set(join.table_name
+                 for queryset in querysets
+                 for join in queryset.query.alias_map.values())
+    models = [model for model in apps.get_models(include_auto_created=True)
+              if model._meta.db_table in tables]
+    for queryset in querysets:
+        if queryset.model not in models:
+            models.append(queryset.model)
+    return sorted(models, key=_get_model_label)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -1,12 +1,44 @@
+import csv
 import datetime
+import functools
+import hashlib
+import json
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
 
-import unicodecsv as csv
+from io import BytesIO
+from itertools import islice
+from operator import itemgetter
 
-from django.core.exceptions import ValidationError
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import Count, F, Max, Min, Q
+from django.db.models.constants import LOOKUP_SEP
+from django.utils.cache import patch_vary_headers
 from django.utils.text import slugify
-from django.http import HttpResponse, StreamingHttpResponse
+from django.http import (FileResponse, HttpResponse,
+                         HttpResponseNotModified, StreamingHttpResponse)
 
 import six
+from six.moves import queue
+
+from .signals import export_finished
+
+if six.PY2:
+    # the stdlib csv module of Python 2 can't write text
+    import unicodecsv
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # Django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
 
 """ A simple python package for turning django models into csvs """
 
@@ -14,7 +46,75 @@ import six
 # the rest will be passed along to the csv writer
 DJQSCSV_KWARGS = {
     'field_header_map', 'field_serializer_map', 'use_verbose_names',
-    'field_order'}
+    'field_order', 'use_iterator', 'iterator_chunk_size', 'use_copy',
+    'keyset_page_size', 'keyset_field', 'write_header', 'related_fields',
+    'related_delimiter', 'csv_writer', 'export_spec', 'prefetch',
+    'progress', 'progress_interval', 'progress_total'}
+
+# keyword arguments that decide the columns and the formatting of an
+# export, which an `ExportSpec` declares once
+LAYOUT_KWARGS = {
+    'field_header_map', 'field_serializer_map', 'use_verbose_names',
+    'field_order', 'related_fields', 'related_delimiter', 'csv_writer'}
+
+# keyword arguments that don't change the output of an export
+OUTPUT_NEUTRAL_KWARGS = {
+    'use_iterator', 'iterator_chunk_size', 'prefetch', 'progress',
+    'progress_interval', 'progress_total'}
+
+# the only csv writer options that can be handed over to postgres' COPY
+COPY_CSV_KWARGS = {'encoding', 'delimiter'}
+
+# the number of rows fetched from the database cursor at a time when
+# iterating without filling the queryset result cache
+DEFAULT_ITERATOR_CHUNK_SIZE = 2000
+
+# the prefix of the columns added to a values queryset when the fields
+# that keyset pagination orders by are not among its columns
+KEYSET_COLUMN = 'djqscsv_keyset_key'
+
+# the name of the column added to a values queryset to look up the
+# to-many related fields of its rows, when the primary key is not exported
+RELATED_KEY_COLUMN = 'djqscsv_related_key'
+
+# the number of rows whose to-many related fields are fetched in a single
+# query, which keeps the query below SQLite's limit of 999 parameters
+RELATED_BATCH_SIZE = 500
+
+# the separator of the values of a to-many related field in a single cell
+DEFAULT_RELATED_DELIMITER = ', '
+
+# the number of bytes read from a cached export at a time when a range of
+# it is sent
+RANGE_CHUNK_SIZE = 64 * 1024
+
+# the zlib window bits that produce each supported compression format
+COMPRESSION_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# the number of primary key ranges each worker process renders during a
+# parallel export
+SHARDS_PER_PROCESS = 4
+
+# the number of bytes collected before a chunk of a streaming response
+# is sent, and the longest time in seconds between two chunks while
+# rows are still arriving
+DEFAULT_BUFFER_SIZE = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# the number of chunks a background thread may produce ahead of the
+# generator consuming them
+DEFAULT_QUEUE_SIZE = 16
+
+# the shortest time in seconds between two progress reports, and the
+# number of rows written between two looks at the clock
+DEFAULT_PROGRESS_INTERVAL = 1.0
+PROGRESS_CHECK_ROWS = 100
+
+# the clock that instrumented exports are timed with
+_timer = getattr(time, 'perf_counter', time.time)
 
 
 class CSVException(Exception):
@@ -30,130 +130,976 @@ class _Echo(object):
         return value
 
 
+class _EncodedFile(object):
+    """
+    A file-like object that takes text and writes it to a binary file
+    object, encoded.
+    """
+
+    def __init__(self, file_obj, encoding='utf-8', errors='strict'):
+        self.file_obj = file_obj
+        self.encoding = encoding
+        self.errors = errors
+
+    def write(self, value):
+        return self.file_obj.write(value.encode(self.encoding, self.errors))
+
+
+def text_csv_writer(file_obj, encoding='utf-8', errors='strict',
+                    **csv_kwargs):
+    """
+    returns a csv writer that writes rows of text to a binary file object.
+
+    the C csv writer of the standard library renders each row into a
+    single string, which is then encoded in one go. on Python 2, where it
+    can't write text, unicodecsv encodes the cells instead.
+    """
+    if six.PY2:
+        return unicodecsv.writer(file_obj, encoding=encoding, errors=errors,
+                                 **csv_kwargs)
+    return csv.writer(_EncodedFile(file_obj, encoding, errors), **csv_kwargs)
+
+
+if six.PY2:
+    DEFAULT_CSV_WRITER = unicodecsv.writer
+else:
+    DEFAULT_CSV_WRITER = text_csv_writer
+
+
+class _ChunkBuffer(object):
+    """A file-like object that collects writes until they are taken."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, value):
+        self.chunks.append(value)
+        return len(value)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """returns everything written since the last call and forgets it."""
+        chunk = b''.join(self.chunks)
+        self.chunks = []
+        return chunk
+
+
+class _CallbackWriter(object):
+    """A file-like object that hands everything written to it to a callback,
+    in chunks of at least `buffer_size` bytes.
+    """
+    def __init__(self, callback, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.callback = callback
+        self.buffer_size = buffer_size
+        self.buffered = []
+        self.buffered_bytes = 0
+
+    def write(self, value):
+        self.buffered.append(value)
+        self.buffered_bytes += len(value)
+        if self.buffered_bytes >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered:
+            self.callback(b''.join(self.buffered))
+            self.buffered = []
+            self.buffered_bytes = 0
+
+
+class _Compressor(object):
+    """Incrementally compresses data in one of the `COMPRESSION_WBITS`
+    formats.
+    """
+    def __init__(self, compression):
+        if compression not in COMPRESSION_WBITS:
+            raise CSVException('unsupported compression: %s' % compression)
+        self.compressobj = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                            zlib.DEFLATED,
+                                            COMPRESSION_WBITS[compression])
+
+    def compress(self, data, flush=False):
+        """
+        compresses data. if `flush` is set, everything compressed so far
+        is returned, so that the receiver can decompress it right away.
+        """
+        compressed = self.compressobj.compress(data)
+        if flush:
+            compressed += self.compressobj.flush(zlib.Z_SYNC_FLUSH)
+        return compressed
+
+    def finish(self):
+        return self.compressobj.flush()
+
+
+class _CompressedFile(object):
+    """A file-like object that compresses everything written to it before
+    writing it to another file object.
+    """
+    def __init__(self, file_obj, compression):
+        self.file_obj = file_obj
+        self.compressor = _Compressor(compression)
+
+    def write(self, value):
+        compressed = self.compressor.compress(value)
+        if compressed:
+            return self.file_obj.write(compressed)
+
+    def finish(self):
+        """writes the end of the compressed stream."""
+        self.file_obj.write(self.compressor.finish())
+
+
+class _CountingFile(object):
+    """A file-like object that counts the bytes written through it."""
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.size = 0
+
+    def write(self, value):
+        self.size += len(value)
+        return self.file_obj.write(value)
+
+
+class _TeeFile(object):
+    """A file-like object that writes everything to two file objects."""
+    def __init__(self, file_obj, other_file_obj):
+        self.file_obj = file_obj
+        self.other_file_obj = other_file_obj
+
+    def write(self, value):
+        self.other_file_obj.write(value)
+        return self.file_obj.write(value)
+
+
 def render_to_csv_response(queryset, filename=None, append_datestamp=False,
-                           streaming=True, **kwargs):
+                           streaming=True, buffer_size=DEFAULT_BUFFER_SIZE,
+                           buffer_rows=None,
+                           flush_interval=DEFAULT_FLUSH_INTERVAL,
+                           compression=None, content_encoding=True,
+                           cache=None, request=None, etag_version=None,
+                           etag_field=None, spool_max_size=None, **kwargs):
     """
     provides the boilerplate for making a CSV http response.
     takes a filename or generates one from the queryset's model.
+
+    if `spool_max_size` is given, a non-streaming export is rendered into
+    a temporary file, which moves from memory to disk once it holds more
+    than that many bytes, and sent as a `FileResponse`.
+
+    if `etag_version` or `etag_field` is given, the response gets an ETag
+    and, given the `request`, answers conditional requests with 304 Not
+    Modified and range requests from the `cache`.
     """
-    if filename:
-        filename = _validate_and_clean_filename(filename)
-        if append_datestamp:
-            filename = _append_datestamp(filename)
-    else:
-        filename = generate_filename(queryset,
-                                     append_datestamp=append_datestamp)
+    filename = _get_response_filename(queryset, filename, append_datestamp)
 
     response_args = {'content_type': 'text/csv'}
+    if compression and not content_encoding:
+        filename = _get_compressed_filename(filename, compression)
+        response_args['content_type'] = 'application/gzip'
+
+    etag = None
+    if etag_version is not None or etag_field is not None:
+        # the same ETag must always stand for the same bytes
+        if not queryset.ordered:
+            if _is_sliced(queryset):
+                raise CSVException('sliced querysets must be ordered to '
+                                   'get an ETag')
+            queryset = queryset.order_by('pk')
+        etag = _get_etag(queryset, kwargs, etag_version, etag_field,
+                         (compression, content_encoding))
+
+    # ranges are only served from a cached rendering, which has a known
+    # size and doesn't change between the requests of a download
+    accept_ranges = bool(etag and cache is not None and not compression)
 
-    if not streaming:
+    if etag and request is not None and _etag_matches(
+            request.META.get('HTTP_IF_NONE_MATCH'), etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        if compression and content_encoding:
+            patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    # a partial response, or a 416 for a range outside of the export
+    response = None
+    if accept_ranges and request is not None:
+        response = _get_range_response(request, queryset, cache, etag,
+                                       kwargs)
+
+    if response is None and not streaming and spool_max_size is not None:
+        response = _get_spooled_response(queryset, spool_max_size,
+                                         compression, cache, response_args,
+                                         kwargs)
+    elif response is None and not streaming:
         response = HttpResponse(**response_args)
-        write_csv(queryset, response, **kwargs)
-    else:
-        response = StreamingHttpResponse(
-            _iter_csv(queryset, _Echo(), **kwargs), **response_args)
+        write_csv(queryset, response, compression=compression, cache=cache,
+                  **kwargs)
+    elif response is None:
+        if cache is not None:
+            content = _iter_cached_csv(queryset, cache, **kwargs)
+        else:
+            content = _iter_csv(queryset, _Echo(), **kwargs)
+        if buffer_size or buffer_rows:
+            content = _buffer_chunks(content, buffer_size, buffer_rows,
+                                     flush_interval,
+                                     _get_header_chunks(kwargs))
+        if compression:
+            content = _compress_chunks(content, _Compressor(compression))
+        response = StreamingHttpResponse(content, **response_args)
 
     response['Content-Disposition'] = 'attachment; filename=%s;' % filename
     response['Cache-Control'] = 'no-cache'
+    if compression and content_encoding:
+        response['Content-Encoding'] = compression
+        # caches must not send the compressed export to other clients
+        patch_vary_headers(response, ('Accept-Encoding',))
+    if etag:
+        response['ETag'] = etag
+    if accept_ranges:
+        response['Accept-Ranges'] = 'bytes'
+
+    return response
+
+
+def render_to_zip_response(querysets, filename=None, append_datestamp=False,
+                           **kwargs):
+    """
+    streams a ZIP archive with a CSV file for each queryset. takes a
+    mapping of filenames to querysets, or a list of querysets and
+    (filename, queryset) pairs. querysets without a filename are named
+    after their model.
+
+    every file is compressed while it is written, and the archive is sent
+    as the compressed data comes out. the keyword arguments are passed to
+    each CSV export.
+    """
+    if sys.version_info < (3, 6):
+        raise CSVException('streaming ZIP archives require Python 3.6 or '
+                           'later')
+
+    members = _get_zip_members(querysets)
+
+    if filename:
+        filename = _validate_and_clean_filename(filename, extension='.zip')
+    else:
+        filename = 'export.zip'
+    if append_datestamp:
+        filename = _append_datestamp(filename, extension='.zip')
 
+    response = StreamingHttpResponse(_iter_zip(members, **kwargs),
+                                     content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=%s;' % filename
+    response['Cache-Control'] = 'no-cache'
     return response
 
 
-def write_csv(queryset, file_obj, **kwargs):
+def write_csv(queryset, file_obj, processes=None, compression=None,
+              cache=None, **kwargs):
     """
     Writes CSV data to a file object based on the contents of the queryset.
+
+    If `processes` is given, the rows are rendered in that many worker
+    processes, one primary key range at a time, unless the queryset's
+    database is inside a transaction.
+
+    If `compression` is given, the data is compressed in that format
+    while it is written.
+
+    If `cache` is given, a cached copy of the same export is written if
+    there is one, and the export is added to the cache otherwise.
     """
+    if compression:
+        compressed_file = _CompressedFile(file_obj, compression)
+        write_csv(queryset, compressed_file, processes=processes,
+                  cache=cache, **kwargs)
+        compressed_file.finish()
+        return
+
+    if cache is not None:
+        key = cache.get_key(queryset, kwargs)
+        cached = cache.open(key)
+        if cached is not None:
+            with cached:
+                shutil.copyfileobj(cached, file_obj)
+            return
+
+        entry = cache.store(key)
+        try:
+            write_csv(queryset, _TeeFile(file_obj, entry),
+                      processes=processes, **kwargs)
+        except BaseException:
+            entry.discard()
+            raise
+        entry.commit()
+        return
+
+    # the workers can't see the writes of the caller's transaction, and
+    # closing its connection would break it
+    if (processes and not connections[queryset.db].in_atomic_block and
+            _can_shard(queryset)):
+        _write_csv_parallel(queryset, file_obj, processes, **kwargs)
+        return
+
     # Force iteration over all rows so they all get written to the file
     for _ in _iter_csv(queryset, file_obj, **kwargs):
         pass
 
 
+def _write_csv_parallel(queryset, file_obj, processes, **kwargs):
+    """
+    Splits the queryset into primary key ranges, renders each range to CSV
+    in a pool of worker processes and writes the parts to the file object
+    in primary key order.
+    """
+    bounds = queryset.aggregate(lowest=Min('pk'), highest=Max('pk'))
+    lowest, highest = bounds['lowest'], bounds['highest']
+    if lowest is not None and not isinstance(lowest, six.integer_types):
+        raise CSVException('parallel exports require an integer '
+                           'primary key')
+
+    # the callback can't be called from the workers
+    for key in ('progress', 'progress_interval', 'progress_total'):
+        kwargs.pop(key, None)
+
+    # the BOM and header are written once, by rendering an empty queryset
+    write_csv(queryset.none(), file_obj, **kwargs)
+    if lowest is None:
+        return
+
+    kwargs['write_header'] = False
+    queryset_state = _pickle_queryset(queryset)
+    shard_count = processes * SHARDS_PER_PROCESS
+    shard_size = (highest - lowest + shard_count) // shard_count
+    shards = [(queryset_state, start, start + shard_size, kwargs)
+              for start in range(lowest, highest + 1, shard_size)]
+
+    # the workers must not share the database connections of this process
+    for connection in connections.all():
+        connection.close()
+
+    pool = multiprocessing.Pool(processes, initializer=_init_shard_worker)
+    try:
+        for part in pool.imap(_render_shard, shards):
+            file_obj.write(part)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _can_shard(queryset):
+    """
+    every primary key range runs the whole query, so sliced, grouped and
+    distinct querysets, whose rows depend on all of the others, are
+    rendered in a single process.
+    """
+    query = queryset.query
+    return not (_is_sliced(queryset) or query.group_by is not None or
+                query.distinct)
+
+
+def _pickle_queryset(queryset):
+    """
+    returns a picklable state of a queryset: its model, database, query
+    and whether it returns dicts. unlike pickling the queryset itself,
+    this does not evaluate it.
+    """
+    is_values = _get_values_queryset(queryset) is queryset
+    names = None
+    if type(queryset).__name__ == 'ValuesQuerySet':
+        # Django 1.8 keeps the names of the columns on the queryset
+        names = (queryset._fields, queryset.extra_names,
+                 queryset.field_names, queryset.annotation_names)
+    return queryset.model, queryset.db, queryset.query, is_values, names
+
+
+def _unpickle_queryset(queryset_state):
+    model, using, query, is_values, names = queryset_state
+    manager = model._default_manager.db_manager(using)
+    queryset = manager.values() if is_values else manager.all()
+    # the documented way to restore a pickled query
+    queryset.query = query
+    if names is not None:
+        (queryset._fields, queryset.extra_names, queryset.field_names,
+         queryset.annotation_names) = names
+    return queryset
+
+
+def _init_shard_worker():
+    # worker processes that were not forked from a configured django
+    # process must set up django before they can query the database
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def _render_shard(shard):
+    queryset_state, start, end, kwargs = shard
+    queryset = _unpickle_queryset(queryset_state).filter(pk__gte=start,
+                                                         pk__lt=end)
+    buf = BytesIO()
+    write_csv(queryset, buf, **kwargs)
+    return buf.getvalue()
+
+
 def _iter_csv(queryset, file_obj, **kwargs):
     """
     The main worker function. Writes CSV data to a file object based on the
     contents of the queryset and yields each row.
     """
+    tracker = None
+    if kwargs.get('progress') is not None:
+        tracker = _ProgressTracker(queryset, file_obj, **kwargs)
+        file_obj = tracker.file_obj
 
-    # process keyword arguments to pull out the ones used by this function
-    field_header_map = kwargs.get('field_header_map', {})
-    field_serializer_map = kwargs.get('field_serializer_map', {})
-    use_verbose_names = kwargs.get('use_verbose_names', True)
-    field_order = kwargs.get('field_order', None)
+    if export_finished.has_listeners(queryset.model):
+        for chunk in _iter_instrumented_csv(queryset, file_obj, tracker,
+                                            **kwargs):
+            yield chunk
+        return
 
-    csv_kwargs = {'encoding': 'utf-8'}
+    export = _CSVExport(queryset, file_obj, **kwargs)
 
-    for key, val in six.iteritems(kwargs):
-        if key not in DJQSCSV_KWARGS:
-            csv_kwargs[key] = val
+    for chunk in export.write_header():
+        yield chunk
 
-    # add BOM to support CSVs in MS Excel (for Windows only)
-    yield file_obj.write(b'\xef\xbb\xbf')
+    if export.use_copy:
+        # an empty queryset compiles to no SQL at all
+        if export.copy_sql is not None:
+            chunks = _iter_copy(export.values_qs.db, export.copy_sql)
+            if tracker is not None:
+                chunks = tracker.track_chunks(chunks)
+            for chunk in chunks:
+                yield file_obj.write(chunk)
+        if tracker is not None:
+            tracker.finish()
+        return
 
-    # the CSV must always be built from a values queryset
-    # in order to introspect the necessary fields.
-    # However, repeated calls to values can expose fields that were not
-    # present in the original qs. If using `values` as a way to
-    # scope field permissions, this is unacceptable. The solution
-    # is to make sure values is called *once*.
-
-    # perform an string check to avoid a non-existent class in certain
-    # versions
-    if type(queryset).__name__ == 'ValuesQuerySet':
-        values_qs = queryset
+    write_record = export.write_record
+    if tracker is None:
+        for record in export.records():
+            yield write_record(record)
     else:
-        # could be a non-values qs, or could be django 1.9+
-        iterable_class = getattr(queryset, '_iterable_class', object)
-        if iterable_class.__name__ == 'ValuesIterable':
-            values_qs = queryset
-        else:
-            values_qs = queryset.values()
+        for record in tracker.track(export.records()):
+            yield write_record(record)
+        tracker.finish()
+
 
+def _iter_instrumented_csv(queryset, file_obj, tracker=None, **kwargs):
+    """
+    the same as `_iter_csv`, but times every phase of the export and
+    sends `export_finished` once it is over. `tracker` reports the
+    progress of the export, if it is given.
+    """
+    stats = _ExportStats(queryset, file_obj)
+    timings = stats.timings
     try:
-        # Django 1.9+
-        field_names = list(values_qs.query.values_select)
-    except AttributeError:
-        # Django 1.8
-        field_names = values_qs.field_names
+        export = _CSVExport(queryset, stats.file_obj, **kwargs)
+
+        started = _timer()
+        for chunk in export.write_header():
+            written = _timer()
+            timings['write'] += written - started
+            yield chunk
+            started = _timer()
+            timings['downstream'] += started - written
+
+        if export.use_copy:
+            stats.rows = None
+            chunks = iter(())
+            if export.copy_sql is not None:
+                chunks = _iter_copy(export.values_qs.db, export.copy_sql)
+            if tracker is not None:
+                chunks = tracker.track_chunks(chunks)
+            for chunk in stats.timed_fetch(chunks):
+                started = _timer()
+                result = stats.file_obj.write(chunk)
+                written = _timer()
+                timings['write'] += written - started
+                stats.written(written)
+                yield result
+                timings['downstream'] += _timer() - written
+        else:
+            writerow = export.writer.writerow
+            records = export.records()
+            if tracker is not None:
+                records = tracker.track(records)
+            for record in stats.timed_fetch(records):
+                started = _timer()
+                row = export.serialize_record(record)
+                serialized = _timer()
+                result = writerow(row)
+                written = _timer()
+                timings['serialize'] += serialized - started
+                timings['write'] += written - serialized
+                stats.rows += 1
+                stats.written(written)
+                yield result
+                timings['downstream'] += _timer() - written
+
+        if tracker is not None:
+            tracker.finish()
+        stats.completed = True
+    finally:
+        stats.send()
+
+
+class _ProgressTracker(object):
+    """
+    Counts the rows and bytes an export writes and passes its progress to
+    the `progress` callback at most every `progress_interval` seconds, and
+    once more when the export is finished.
+
+    the callback gets a dict with the keys:
+
+    - 'rows': the number of rows written, or None for COPY exports
+    - 'bytes': the number of bytes written, before any compression
+    - 'elapsed': the seconds since the export started
+    - 'rows_per_second': the average throughput, once rows were written
+    - 'total': the number of rows to export, if `progress_total` is
+      'exact' or the database could estimate it for 'estimate'
+    - 'eta': the estimated seconds until the export is finished, given
+      the total and the throughput
+    - 'finished': whether this is the report of the finished export
+    """
+
+    def __init__(self, queryset, file_obj, **kwargs):
+        self.callback = kwargs['progress']
+        self.interval = kwargs.get('progress_interval',
+                                   DEFAULT_PROGRESS_INTERVAL)
+        self.file_obj = _CountingFile(file_obj)
+        self.rows = 0
+        self.started = self.last_report = _timer()
+
+        progress_total = kwargs.get('progress_total', None)
+        if progress_total == 'exact':
+            self.total = queryset.count()
+        elif progress_total == 'estimate':
+            self.total = _estimate_count(queryset)
+        elif progress_total is None:
+            self.total = None
+        else:
+            raise CSVException("progress_total must be 'exact', 'estimate' "
+                               "or None, not %r" % (progress_total,))
+
+    def track(self, records):
+        """
+        yields the records, counting them and reporting the progress
+        every `PROGRESS_CHECK_ROWS` rows when it is due.
+        """
+        check_rows = PROGRESS_CHECK_ROWS
+        rows = 0
+        check_at = check_rows
+        for record in records:
+            yield record
+            # the next record is asked for once this one is written
+            rows += 1
+            if rows >= check_at:
+                check_at += check_rows
+                self.rows = rows
+                now = _timer()
+                if now - self.last_report >= self.interval:
+                    self.report(now)
+        self.rows = rows
+
+    def track_chunks(self, chunks):
+        """yields the chunks of a COPY export, whose rows are not counted."""
+        self.rows = None
+        for chunk in chunks:
+            yield chunk
+            now = _timer()
+            if now - self.last_report >= self.interval:
+                self.report(now)
+
+    def finish(self):
+        self.report(_timer(), finished=True)
+
+    def report(self, now, finished=False):
+        self.last_report = now
+        elapsed = now - self.started
+        rows_per_second = None
+        if self.rows and elapsed > 0:
+            rows_per_second = self.rows / elapsed
+
+        eta = None
+        if finished:
+            eta = 0.0
+        elif self.total is not None and rows_per_second:
+            eta = max(self.total - self.rows, 0) / rows_per_second
 
-    extra_columns = list(values_qs.query.extra_select)
-    if extra_columns:
-        field_names += extra_columns
+        self.callback({
+            'rows': self.rows,
+            'bytes': self.file_obj.size,
+            'elapsed': elapsed,
+            'rows_per_second': rows_per_second,
+            'total': self.total,
+            'eta': eta,
+            'finished': finished,
+        })
 
-    aggregate_columns = list(values_qs.query.annotation_select)
 
-    if aggregate_columns:
-        field_names += aggregate_columns
+class _ExportStats(object):
+    """The timings and counts of an export, for `export_finished`."""
 
-    if field_order:
-        # go through the field_names and put the ones
-        # that appear in the ordering list first
-        field_names = ([field for field in field_order
-                       if field in field_names] +
-                       [field for field in field_names
-                        if field not in field_order])
+    def __init__(self, queryset, file_obj):
+        self.queryset = queryset
+        self.file_obj = _CountingFile(file_obj)
+        self.rows = 0
+        self.completed = False
+        self.timings = {'query': 0.0, 'fetch': 0.0, 'serialize': 0.0,
+                        'write': 0.0, 'downstream': 0.0}
+        self.first_row = None
+        self.start = _timer()
 
-    writer = csv.DictWriter(file_obj, field_names, **csv_kwargs)
+    def timed_fetch(self, records):
+        """
+        yields the items of an iterator, adding the time spent waiting for
+        them to the timings.
+        """
+        records = iter(records)
+        while True:
+            started = _timer()
+            try:
+                record = next(records)
+            except StopIteration:
+                self.fetched(_timer() - started)
+                return
+            self.fetched(_timer() - started)
+            yield record
+
+    def fetched(self, seconds):
+        # the query runs while waiting for the first row
+        if self.first_row is None:
+            self.timings['query'] += seconds
+        else:
+            self.timings['fetch'] += seconds
+
+    def written(self, now):
+        if self.first_row is None:
+            self.first_row = now - self.start
+
+    def send(self):
+        timings = dict(self.timings, total=_timer() - self.start,
+                       first_row=self.first_row)
+        export_finished.send(sender=self.queryset.model,
+                             queryset=self.queryset, rows=self.rows,
+                             bytes=self.file_obj.size,
+                             completed=self.completed, timings=timings)
+
+
+class _ExportLayout(object):
+    """
+    The parts of an export that only depend on the columns of its values
+    queryset and on the export options: the ordered columns, the header
+    row, the compiled serializers and the csv writer options.
+    """
+
+    def __init__(self, values_qs, kwargs):
+        field_header_map = kwargs.get('field_header_map', {})
+        field_serializer_map = kwargs.get('field_serializer_map', {})
+        use_verbose_names = kwargs.get('use_verbose_names', True)
+        field_order = kwargs.get('field_order', None)
+        related_fields = kwargs.get('related_fields', ())
+        self.related_delimiter = kwargs.get('related_delimiter',
+                                            DEFAULT_RELATED_DELIMITER)
+        self.custom_writer = kwargs.get('csv_writer', None)
+        self.csv_writer = self.custom_writer or DEFAULT_CSV_WRITER
+
+        csv_kwargs = {'encoding': 'utf-8'}
+
+        for key, val in six.iteritems(kwargs):
+            if key not in DJQSCSV_KWARGS:
+                csv_kwargs[key] = val
+
+        # rows are written positionally, so the DictWriter-only options are
+        # handled here: missing values are filled in with `restval`, and
+        # records never contain keys outside of the field names.
+        self.restval = csv_kwargs.pop('restval', '')
+        csv_kwargs.pop('extrasaction', None)
+        self.csv_kwargs = csv_kwargs
+        self.field_serializer_map = field_serializer_map
+
+        model = values_qs.model
+
+        try:
+            # Django 1.9+
+            field_names = list(values_qs.query.values_select)
+        except AttributeError:
+            # Django 1.8, whose list is extended below
+            field_names = list(values_qs.field_names)
+
+        forward_related, many_related = _split_related_fields(
+            model, related_fields)
+
+        # forward relations are joined into the query as extra columns
+        self.forward_related = [
+            lookup for lookup in forward_related
+            if lookup not in field_names and
+            lookup not in values_qs.query.annotation_select]
+        values_qs = self._add_forward_related(values_qs)
+
+        extra_columns = list(values_qs.query.extra_select)
+        aggregate_columns = list(values_qs.query.annotation_select)
+
+        # the columns in the order they appear in the compiled SQL
+        self.select_names = extra_columns + field_names + aggregate_columns
+
+        if extra_columns:
+            field_names += extra_columns
+
+        if aggregate_columns:
+            field_names += aggregate_columns
+
+        # to-many relations are filled into the records after they are
+        # fetched, looked up by the primary keys of the rows
+        self.many_related = many_related
+        self.related_key = None
+        self.add_related_key = False
+        if many_related:
+            field_names += many_related
+            pk_name = model._meta.pk.attname
+            if pk_name in field_names:
+                self.related_key = pk_name
+            else:
+                self.add_related_key = True
+
+        if field_order:
+            # go through the field_names and put the ones
+            # that appear in the ordering list first
+            field_names = ([field for field in field_order
+                           if field in field_names] +
+                           [field for field in field_names
+                            if field not in field_order])
+
+        # verbose_name defaults to the raw field name, so in either case
+        # this will produce a complete mapping of field names to column names
+        name_map = dict((field, field) for field in field_names)
+        if use_verbose_names:
+            name_map.update(
+                dict((field.name, field.verbose_name)
+                     for field in model._meta.fields
+                     if field.name in field_names))
+
+        # merge the custom field headers into the verbose/raw defaults,
+        # if provided
+        merged_header_map = name_map.copy()
+        if extra_columns:
+            merged_header_map.update(dict((k, k) for k in extra_columns))
+        merged_header_map.update(field_header_map)
+
+        self.values_qs = self._add_related_key(values_qs)
+        self.field_names = field_names
+        self.header_row = [merged_header_map[field] for field in field_names]
+
+        # the serializers of to-many relations apply to each related value,
+        # the cell already holds their joined text
+        self.related_serializers = dict(
+            (lookup, _make_serializer(field_serializer_map.get(lookup),
+                                      self.restval))
+            for lookup in many_related)
+        self.serializers = _compile_serializers(
+            field_names,
+            dict((field, serializer)
+                 for field, serializer in six.iteritems(field_serializer_map)
+                 if field not in self.related_serializers),
+            self.restval)
+        self.get_values = _values_getter(field_names)
+
+        # the header row as bytes, once it has been rendered up front
+        self.encoded_header = None
+
+    def encode_header(self):
+        """
+        renders the header row up front, which also checks the csv writer
+        options. writers that don't return what they write keep writing
+        the header themselves.
+        """
+        writer = self.csv_writer(_Echo(), **self.csv_kwargs)
+        encoded = writer.writerow(self.header_row)
+        if isinstance(encoded, bytes):
+            self.encoded_header = encoded
+
+    def prepare(self, values_qs):
+        """
+        adds the related columns of the layout to another values queryset
+        with the same columns as the one the layout was made from.
+        """
+        return self._add_related_key(self._add_forward_related(values_qs))
+
+    def _add_forward_related(self, values_qs):
+        if self.forward_related:
+            values_qs = values_qs.annotate(
+                **dict((lookup, F(lookup)) for lookup in self.forward_related))
+        return values_qs
+
+    def _add_related_key(self, values_qs):
+        if self.add_related_key:
+            values_qs, names = _select_columns(values_qs,
+                                               [(RELATED_KEY_COLUMN, 'pk')])
+            self.related_key = names[0]
+        return values_qs
+
+
+def _get_export_layout(queryset, kwargs):
+    """
+    returns the layout of an export and the values queryset it runs, with
+    the columns of its related fields.
+    """
+    export_spec = kwargs.get('export_spec', None)
+    if export_spec is not None:
+        # the layout was set up when the spec was declared
+        layout = export_spec.layout
+        return layout, layout.prepare(export_spec.apply(queryset, kwargs))
+
+    layout = _ExportLayout(_get_values_queryset(queryset), kwargs)
+    return layout, layout.values_qs
+
+
+def _get_export_querysets(queryset, kwargs):
+    """
+    returns the values queryset an export runs, followed by a queryset
+    that joins the tables its to-many related fields are read from, if it
+    has any.
+    """
+    layout, values_qs = _get_export_layout(queryset, kwargs)
+    querysets = [values_qs]
+    if layout.many_related:
+        querysets.append(values_qs.model._default_manager.values(
+            *layout.many_related))
+    return querysets
+
+
+class _CSVExport(object):
+    """
+    Everything needed to write one queryset to a file object as CSV: the
+    values queryset, its ordered columns, the csv writer and the compiled
+    serializers.
+    """
+
+    def __init__(self, queryset, file_obj, **kwargs):
+        # process keyword arguments to pull out the ones used by this class
+        self.use_iterator = kwargs.get('use_iterator', True)
+        self.iterator_chunk_size = kwargs.get('iterator_chunk_size',
+                                              DEFAULT_ITERATOR_CHUNK_SIZE)
+        use_copy = kwargs.get('use_copy', False)
+        self.write_header_row = kwargs.get('write_header', True)
+        self.keyset_page_size = kwargs.get('keyset_page_size', None)
+        self.keyset_field = kwargs.get('keyset_field', 'pk')
+        self.prefetch = kwargs.get('prefetch', None)
+
+        layout, values_qs = _get_export_layout(queryset, kwargs)
+        if self.keyset_page_size:
+            _check_keyset_queryset(values_qs)
+
+        self.field_names = layout.field_names
+        self.header_row = layout.header_row
+        self.serializers = layout.serializers
+        self.get_values = layout.get_values
+        self.many_related = layout.many_related
+        self.related_key = layout.related_key
+        self.related_delimiter = layout.related_delimiter
+        self.related_serializers = layout.related_serializers
+
+        csv_kwargs = layout.csv_kwargs
+        # pages can't be handed over to COPY, which runs a single query,
+        # and custom writers may not format rows the way postgres does
+        self.use_copy = (use_copy and not self.keyset_page_size and
+                         not layout.many_related and
+                         layout.custom_writer is None and
+                         _can_copy(values_qs, layout.field_names,
+                                   layout.field_serializer_map, csv_kwargs,
+                                   layout.restval))
+        self.encoded_header = layout.encoded_header
+        if self.use_copy:
+            self.copy_sql = _compile_copy_sql(
+                values_qs, layout.select_names, layout.field_names,
+                csv_kwargs.get('delimiter', ','))
+            # match the line endings of the rows written by postgres
+            csv_kwargs = dict(csv_kwargs, lineterminator='\n')
+            self.encoded_header = None
+
+        self.values_qs = values_qs
+        self.file_obj = file_obj
+        self.writer = layout.csv_writer(file_obj, **csv_kwargs)
+
+    def write_header(self):
+        """
+        writes the BOM and the header row, unless disabled, and yields the
+        results of the writes.
+        """
+        if self.write_header_row:
+            # add BOM to support CSVs in MS Excel (for Windows only)
+            yield self.file_obj.write(b'\xef\xbb\xbf')
+            if self.encoded_header is not None:
+                yield self.file_obj.write(self.encoded_header)
+            else:
+                yield self.writer.writerow(self.header_row)
+
+    def records(self):
+        """
+        returns an iterator over the records of the values queryset,
+        fetched ahead in a background thread if `prefetch` is set.
+        """
+        # another connection would not see the writes of a transaction
+        if (self.prefetch and
+                not connections[self.values_qs.db].in_atomic_block):
+            return _prefetch_records(self._fetch_records,
+                                     self.iterator_chunk_size,
+                                     self.prefetch)
+        return self._fetch_records()
+
+    def _fetch_records(self):
+        if self.keyset_page_size:
+            records = _iterate_keyset(self.values_qs, self.field_names,
+                                      self.keyset_field,
+                                      self.keyset_page_size)
+        elif self.use_iterator:
+            records = _iterate_without_cache(self.values_qs,
+                                             self.iterator_chunk_size)
+        else:
+            records = iter(self.values_qs)
 
-    # verbose_name defaults to the raw field name, so in either case
-    # this will produce a complete mapping of field names to column names
-    name_map = dict((field, field) for field in field_names)
-    if use_verbose_names:
-        name_map.update(
-            dict((field.name, field.verbose_name)
-                 for field in queryset.model._meta.fields
-                 if field.name in field_names))
+        if self.many_related:
+            records = _attach_many_related(self, records)
+        return records
 
-    # merge the custom field headers into the verbose/raw defaults, if provided
-    merged_header_map = name_map.copy()
-    if extra_columns:
-        merged_header_map.update(dict((k, k) for k in extra_columns))
-    merged_header_map.update(field_header_map)
+    def fetch_many_related(self, records):
+        """
+        fills in the to-many related fields of a batch of records, with
+        one query per field.
+        """
+        keys = [record[self.related_key] for record in records]
+        manager = self.values_qs.model._default_manager.using(
+            self.values_qs.db)
+        for lookup in self.many_related:
+            serialize = self.related_serializers[lookup]
+            related = dict((key, []) for key in keys)
+            pairs = manager.filter(pk__in=keys).values_list(
+                'pk', lookup).order_by('pk', lookup)
+            for key, value in pairs:
+                # rows without related objects are joined to a NULL
+                if value is not None:
+                    related[key].append(serialize(value))
+            for record in records:
+                record[lookup] = self.related_delimiter.join(
+                    related[record[self.related_key]])
 
-    yield writer.writerow(merged_header_map)
+    def serialize_record(self, record):
+        """returns the CSV row of a single record, as a list of text."""
+        return _serialize_row(self.serializers, self.get_values(record))
 
-    for record in values_qs:
-        record = _sanitize_record(field_serializer_map, record)
-        yield writer.writerow(record)
+    def write_record(self, record):
+        """writes a single record as a CSV row."""
+        return self.writer.writerow(
+            _serialize_row(self.serializers, self.get_values(record)))
 
 
 def generate_filename(queryset, append_datestamp=False):
@@ -174,43 +1120,838 @@ def generate_filename(queryset, append_datestamp=False):
 ########################################
 
 
-def _validate_and_clean_filename(filename):
+def _get_model_label(model):
+    # Options.label is Django 1.9+
+    opts = model._meta
+    return '%s.%s' % (opts.app_label, opts.object_name)
+
+
+def _get_response_filename(queryset, filename, append_datestamp):
+    if filename:
+        filename = _validate_and_clean_filename(filename)
+        if append_datestamp:
+            filename = _append_datestamp(filename)
+    else:
+        filename = generate_filename(queryset,
+                                     append_datestamp=append_datestamp)
+    return filename
+
+
+def _get_zip_members(querysets):
+    """returns the (filename, queryset) pairs of the files of a ZIP archive."""
+    if hasattr(querysets, 'items'):
+        items = list(querysets.items())
+    else:
+        items = [item if isinstance(item, tuple) else (None, item)
+                 for item in querysets]
+
+    members = []
+    filenames = set()
+    for filename, queryset in items:
+        filename = _get_response_filename(queryset, filename, False)
+        if filename in filenames:
+            raise CSVException('more than one file is named %s' % filename)
+        filenames.add(filename)
+        members.append((filename, queryset))
+    return members
+
+
+def _iter_zip(members, **kwargs):
+    """
+    writes a CSV file for every (filename, queryset) pair into a ZIP
+    archive and yields the archive as it is written.
+
+    the archive is written to a stream that can't seek, so zipfile adds
+    the sizes and checksums after the data of each file. the ZIP64
+    extensions are always enabled, since the sizes aren't known upfront.
+    """
+    output = _ChunkBuffer()
+    archive = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+    for filename, queryset in members:
+        info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with archive.open(info, 'w', force_zip64=True) as member:
+            for _ in _iter_csv(queryset, member, **kwargs):
+                chunk = output.take()
+                if chunk:
+                    yield chunk
+        yield output.take()
+    archive.close()
+    yield output.take()
+
+
+def _options_repr(value, _seen=frozenset()):
+    """
+    returns a representation of an export option that stays the same
+    across processes.
+    """
+    if isinstance(value, dict):
+        return sorted((_options_repr(key, _seen), _options_repr(item, _seen))
+                      for key, item in six.iteritems(value))
+    elif isinstance(value, (list, tuple)):
+        return [_options_repr(item, _seen) for item in value]
+    elif callable(value):
+        return _callable_repr(value, _seen)
+    return six.text_type(value)
+
+
+def _callable_repr(value, seen):
+    """
+    identifies a function by its name and where it is defined, since
+    lambdas all share a name, and by the values it closes over, its
+    defaults and the instance it is bound to, since closures made by the
+    same factory all share a name and a line.
+    """
+    if isinstance(value, functools.partial):
+        return ['partial', _options_repr(value.func, seen),
+                _options_repr(value.args, seen),
+                _options_repr(value.keywords or {}, seen)]
+
+    code = getattr(value, '__code__', None)
+    name = getattr(value, '__qualname__',
+                   getattr(value, '__name__', repr(value)))
+    identity = '%s.%s:%s' % (getattr(value, '__module__', ''), name,
+                             code.co_firstlineno if code else '')
+    if code is None or id(value) in seen:
+        return identity
+
+    # recursive functions close over themselves
+    seen = seen | {id(value)}
+    closure = []
+    for cell in getattr(value, '__closure__', None) or ():
+        try:
+            closure.append(_options_repr(cell.cell_contents, seen))
+        except ValueError:
+            # a variable that isn't assigned yet
+            closure.append(None)
+
+    bound_to = getattr(value, '__self__', None)
+    return [identity, closure,
+            _options_repr(getattr(value, '__defaults__', None) or (), seen),
+            _options_repr(getattr(value, '__kwdefaults__', None) or {}, seen),
+            None if bound_to is None else _options_repr(bound_to, seen)]
+
+
+def _get_export_fingerprint(values_qs, kwargs):
+    """
+    returns a representation of the query and the options of an export,
+    which is the same for every export with the same output.
+    """
+    try:
+        sql, params = values_qs.query.sql_with_params()
+    except EmptyResultSet:
+        sql, params = None, ()
+
+    options = sorted((key, _options_repr(value))
+                     for key, value in six.iteritems(kwargs)
+                     if key not in OUTPUT_NEUTRAL_KWARGS)
+    return values_qs.db, sql, _options_repr(params), options
+
+
+def _get_etag(queryset, kwargs, version, field, encoding):
+    """
+    returns a strong ETag for an export, made from its query, options and
+    encoding, the caller's `version` and, if `field` is given, the latest
+    value of that field and the number of rows.
+    """
+    values_qs = _get_export_layout(queryset, kwargs)[1]
+    data = None
+    if field is not None:
+        data = queryset.aggregate(latest=Max(field), count=Count('pk'))
+        data = (_options_repr(data['latest']), data['count'])
+
+    etag_data = repr((_get_export_fingerprint(values_qs, kwargs),
+                      _options_repr(version), data, encoding))
+    return '"%s"' % hashlib.sha1(etag_data.encode('utf-8')).hexdigest()
+
+
+def _etag_matches(header, etag):
+    """checks whether an If-None-Match header matches an ETag."""
+    if not header:
+        return False
+    # If-None-Match uses the weak comparison
+    etags = [value.strip() for value in header.split(',')]
+    return '*' in etags or etag in [value[2:] if value.startswith('W/')
+                                    else value for value in etags]
+
+
+def _parse_range(header, size):
+    """
+    returns the first and last byte of a single byte range of a `size`
+    bytes long file, or None for headers that aren't a single byte range.
+    raises CSVException if the range is not satisfiable.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    byte_range = header[len('bytes='):].strip()
+    if ',' in byte_range or '-' not in byte_range:
+        return None
+
+    first, last = [value.strip() for value in byte_range.split('-', 1)]
+    try:
+        if not first:
+            # the last bytes of the file
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first = int(first)
+            last = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+
+    if first > last or first >= size:
+        raise CSVException('unsatisfiable range: %s' % header)
+    return first, last
+
+
+def _get_range_response(request, queryset, cache, etag, kwargs):
+    """
+    returns a response with the range of the export that the request asks
+    for, from the cache, or None to send the whole export.
+    """
+    range_header = request.META.get('HTTP_RANGE')
+    if not range_header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range.strip() != etag:
+        return None
+
+    key = cache.get_key(queryset, kwargs)
+    cached = cache.open(key)
+    if cached is None:
+        # render the export into the cache first, to know its size
+        entry = cache.store(key)
+        try:
+            write_csv(queryset, entry, **kwargs)
+        except BaseException:
+            entry.discard()
+            raise
+        entry.commit()
+        cached = cache.open(key)
+        if cached is None:
+            return None
+
+    cached.seek(0, 2)
+    size = cached.tell()
+    try:
+        byte_range = _parse_range(range_header, size)
+    except CSVException:
+        cached.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+    if byte_range is None:
+        cached.close()
+        return None
+
+    first, last = byte_range
+    cached.seek(first)
+    response = StreamingHttpResponse(
+        _iter_file_range(cached, last - first + 1), status=206,
+        content_type='text/csv')
+    response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+    response['Content-Length'] = str(last - first + 1)
+    return response
+
+
+def _get_spooled_response(queryset, max_size, compression, cache,
+                          response_args, kwargs):
+    """
+    returns a `FileResponse` that sends the export from a temporary file,
+    or straight from the cache if it holds the export.
+
+    a file on disk lets the server send it with `wsgi.file_wrapper`,
+    which can use sendfile, instead of copying it through python.
+    """
+    file_obj = None
+    if cache is not None and not compression:
+        file_obj = cache.open(cache.get_key(queryset, kwargs))
+
+    if file_obj is None:
+        file_obj = tempfile.SpooledTemporaryFile(max_size=max_size)
+        try:
+            write_csv(queryset, file_obj, compression=compression,
+                      cache=cache, **kwargs)
+        except BaseException:
+            file_obj.close()
+            raise
+
+    file_obj.seek(0, 2)
+    size = file_obj.tell()
+    file_obj.seek(0)
+
+    response = FileResponse(file_obj, **response_args)
+    response['Content-Length'] = str(size)
+    return response
+
+
+def _iter_file_range(file_obj, length):
+    """yields `length` bytes of a file from its position, then closes it."""
+    with file_obj:
+        while length > 0:
+            chunk = file_obj.read(min(length, RANGE_CHUNK_SIZE))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _get_compressed_filename(filename, compression):
+    if compression != 'gzip':
+        raise CSVException('only gzip compressed files can be downloaded')
+    return filename + '.gz'
+
+
+def _validate_and_clean_filename(filename, extension='.csv'):
 
     if filename.count('.'):
-        if not filename.endswith('.csv'):
-            raise ValidationError('the only accepted file extension is .csv')
+        if not filename.endswith(extension):
+            raise ValidationError('the only accepted file extension is %s' %
+                                  extension)
         else:
-            filename = filename[:-4]
+            filename = filename[:-len(extension)]
 
-    filename = slugify(six.text_type(filename)) + '.csv'
+    filename = slugify(six.text_type(filename)) + extension
     return filename
 
 
-def _sanitize_record(field_serializer_map, record):
+def _get_header_chunks(kwargs):
+    """
+    returns the number of chunks `_iter_csv` yields before the rows: the
+    BOM and the header row, unless the header is disabled.
+    """
+    return 2 if kwargs.get('write_header', True) else 0
+
+
+def _buffer_chunks(chunks, buffer_size, buffer_rows=None,
+                   flush_interval=None, header_chunks=0):
+    """
+    takes an iterable of byte strings, such as the rows yielded by
+    `_iter_csv`, and groups them into larger chunks.
 
-    def _serialize_value(value):
-        # provide default serializer for the case when
-        # non text values get sent without a serializer
-        if isinstance(value, datetime.datetime):
-            return value.isoformat()
+    the first `header_chunks` chunks, the BOM and the header row, are
+    emitted together as soon as they arrive, before the query has
+    returned any rows. after that a chunk is emitted once it holds at
+    least `buffer_size` bytes or `buffer_rows` rows, or when
+    `flush_interval` seconds have passed since the previous chunk.
+    """
+    buffered = []
+    buffered_bytes = 0
+    last_flush = time.time()
+
+    for chunk in chunks:
+        buffered.append(chunk)
+        buffered_bytes += len(chunk)
+        if header_chunks:
+            header_chunks -= 1
+            flush = not header_chunks
         else:
-            return six.text_type(value)
+            flush = ((buffer_size and buffered_bytes >= buffer_size) or
+                     (buffer_rows and len(buffered) >= buffer_rows) or
+                     (flush_interval is not None and
+                      time.time() - last_flush >= flush_interval))
+        if flush:
+            yield b''.join(buffered)
+            buffered = []
+            buffered_bytes = 0
+            last_flush = time.time()
+
+    if buffered:
+        yield b''.join(buffered)
+
+
+def _iter_cached_csv(queryset, cache, **kwargs):
+    """
+    yields the CSV data of a queryset from the cache if it is there, and
+    adds it to the cache while yielding it otherwise.
+    """
+    key = cache.get_key(queryset, kwargs)
+    cached = cache.open(key)
+    if cached is not None:
+        with cached:
+            for chunk in iter(lambda: cached.read(DEFAULT_BUFFER_SIZE), b''):
+                yield chunk
+        return
+
+    entry = cache.store(key)
+    complete = False
+    try:
+        for chunk in _iter_csv(queryset, _Echo(), **kwargs):
+            entry.write(chunk)
+            yield chunk
+        complete = True
+    finally:
+        # an export that was not streamed to its end is not cached
+        if complete:
+            entry.commit()
+        else:
+            entry.discard()
+
+
+def _compress_chunks(chunks, compressor):
+    """
+    compresses an iterable of byte strings into a single stream, flushing
+    the compressor after every chunk so that each one can be decompressed
+    as soon as it arrives.
+    """
+    for chunk in chunks:
+        compressed = compressor.compress(chunk, flush=True)
+        if compressed:
+            yield compressed
+    yield compressor.finish()
+
+
+def _iterate_without_cache(queryset, chunk_size):
+    """
+    iterate over a queryset without populating its result cache, so
+    that memory use does not grow with the number of rows.
+
+    on backends that support them, django streams the rows from a
+    server-side cursor, fetching `chunk_size` rows at a time.
+    """
+    try:
+        # Django 2.0+
+        return queryset.iterator(chunk_size=chunk_size)
+    except TypeError:
+        # Django < 2.0 uses a fixed chunk size
+        return queryset.iterator()
+
+
+def _is_sliced(queryset):
+    # Query.is_sliced is Django 2.1+
+    return bool(queryset.query.low_mark or
+                queryset.query.high_mark is not None)
+
+
+def _get_values_queryset(queryset):
+    # the CSV must always be built from a values queryset
+    # in order to introspect the necessary fields.
+    # However, repeated calls to values can expose fields that were not
+    # present in the original qs. If using `values` as a way to
+    # scope field permissions, this is unacceptable. The solution
+    # is to make sure values is called *once*.
+
+    # perform an string check to avoid a non-existent class in certain
+    # versions
+    if type(queryset).__name__ == 'ValuesQuerySet':
+        return queryset
+
+    # could be a non-values qs, or could be django 1.9+
+    iterable_class = getattr(queryset, '_iterable_class', object)
+    if iterable_class.__name__ == 'ValuesIterable':
+        return queryset
+    return queryset.values()
+
+
+def _iterate_keyset(values_qs, field_names, keyset_field, page_size):
+    """
+    iterate over a values queryset in pages of `page_size` rows, ordered
+    by `keyset_field`, a field or a tuple of fields. the primary key is
+    added as the last field unless it is one of them, so that fields that
+    aren't unique, such as an `updated` timestamp, can be paged by too.
+    every page is a short query that starts right after the last key of
+    the previous page, so no query holds a snapshot open for the whole
+    export.
+
+    prefix a field with '-' to walk it in descending order.
+    """
+    model = values_qs.model
+    pk_name = model._meta.pk.attname
+    if isinstance(keyset_field, six.string_types):
+        keyset_field = [keyset_field]
+
+    keys = []
+    for field in keyset_field:
+        descending = field.startswith('-')
+        key = field.lstrip('-')
+        if key in ('pk', model._meta.pk.name):
+            key = pk_name
+        _check_keyset_field(model, key)
+        keys.append((key, descending))
+    if pk_name not in [name for name, _ in keys]:
+        keys.append((pk_name, keys[-1][1]))
+
+    # the keys are needed to start the next page, so the ones that aren't
+    # exported are added to the records under names that aren't written
+    # to the CSV
+    missing = [('%s_%d' % (KEYSET_COLUMN, index), lookup)
+               for index, (lookup, _) in enumerate(keys)
+               if lookup not in field_names]
+    values_qs, names = _select_columns(values_qs, missing)
+    names = dict(zip([lookup for _, lookup in missing], names))
+    columns = [(names.get(lookup, lookup), reverse)
+               for lookup, reverse in keys]
+
+    ordered_qs = values_qs.order_by(*[('-' if reverse else '') + column
+                                      for column, reverse in columns])
+
+    page = list(ordered_qs[:page_size])
+    while page:
+        for record in page:
+            yield record
+        if len(page) < page_size:
+            break
+        next_qs = ordered_qs.filter(_keyset_after(columns, page[-1]))
+        page = list(next_qs[:page_size])
+
+
+def _check_keyset_queryset(values_qs):
+    """
+    keyset pagination reorders the query and adds its keys to it. sliced
+    querysets can't be reordered, and the keys would change the rows of
+    grouped and distinct querysets, so those are refused.
+    """
+    if _is_sliced(values_qs):
+        raise CSVException("keyset pagination can't page a sliced queryset")
+    if values_qs.query.group_by is not None or values_qs.query.distinct:
+        raise CSVException("keyset pagination can't page a grouped or "
+                           "distinct queryset")
+
+
+def _check_keyset_field(model, key):
+    """
+    keyset pagination can't page past NULL keys, which compare as neither
+    greater nor less than any key, so nullable fields are refused.
+    """
+    opts = model._meta
+    for part in key.split(LOOKUP_SEP):
+        try:
+            field = opts.get_field(part)
+        except FieldDoesNotExist:
+            # an annotation, which the database has to check
+            return
+        if field.null:
+            raise CSVException('keyset pagination would skip the rows '
+                               'whose %s is NULL' % key)
+        if not field.is_relation or field.related_model is None:
+            return
+        opts = field.related_model._meta
+
+
+def _select_columns(values_qs, columns):
+    """
+    adds columns that aren't written to the CSV, given as pairs of a name
+    and a field lookup, to the records of a values queryset. returns the
+    queryset and the names the columns are found under in the records.
+
+    on Django 1.8 annotations added after `values()` are left out of the
+    records, so the lookups are selected again as fields under their own
+    names instead.
+    """
+    if not columns:
+        return values_qs, []
+    lookups = [lookup for _, lookup in columns]
+    if type(values_qs).__name__ == 'ValuesQuerySet':
+        names = (values_qs.extra_names + values_qs.field_names +
+                 values_qs.annotation_names)
+        return values_qs.values(*(names + lookups)), lookups
+    values_qs = values_qs.annotate(
+        **dict((name, F(lookup)) for name, lookup in columns))
+    return values_qs, [name for name, _ in columns]
+
+
+def _keyset_after(columns, record):
+    """
+    returns the condition for the rows after `record` in the order of the
+    keyset columns. this spells out the row value comparison
+    (a, b) > (x, y) as a > x OR (a = x AND b > y), which works on every
+    database and with columns in different directions.
+    """
+    condition = None
+    equal = Q()
+    for column, descending in columns:
+        lookup = '%s__%s' % (column, 'lt' if descending else 'gt')
+        after = equal & Q(**{lookup: record[column]})
+        condition = after if condition is None else condition | after
+        equal &= Q(**{column: record[column]})
+    return condition
+
+
+def _split_related_fields(model, related_fields):
+    """
+    splits related field lookups into those that follow only forward
+    relations, which can be joined into the query, and those that cross
+    a to-many relation.
+    """
+    forward = []
+    many = []
+    for lookup in related_fields:
+        opts = model._meta
+        to_many = False
+        for part in lookup.split(LOOKUP_SEP):
+            try:
+                field = opts.get_field(part)
+            except FieldDoesNotExist:
+                raise CSVException('%s has no related field %s' %
+                                   (model.__name__, lookup))
+            if not field.is_relation or field.related_model is None:
+                # the rest of the lookup is a transform of this field
+                break
+            if field.many_to_many or field.one_to_many:
+                to_many = True
+            opts = field.related_model._meta
+        (many if to_many else forward).append(lookup)
+    return forward, many
+
+
+def _attach_many_related(export, records):
+    """
+    fills in the to-many related fields of the records of an export, one
+    batch at a time.
+    """
+    while True:
+        batch = list(islice(records, RELATED_BATCH_SIZE))
+        if not batch:
+            return
+        export.fetch_many_related(batch)
+        for record in batch:
+            yield record
+
+
+def _can_copy(values_qs, field_names, field_serializer_map, csv_kwargs,
+              restval):
+    """
+    checks whether postgres can render the rows of `values_qs` by
+    itself with COPY, that is, without any python side serialization.
+    """
+    connection = connections[values_qs.db]
+    if connection.vendor != 'postgresql':
+        return False
+    # COPY is run with the copy_expert and mogrify of psycopg2 cursors,
+    # which psycopg 3 doesn't have
+    extensions = getattr(connection.Database, 'extensions', None)
+    if not hasattr(getattr(extensions, 'cursor', None), 'copy_expert'):
+        return False
+    if any(field in field_serializer_map for field in field_names):
+        return False
+    if restval or set(csv_kwargs) - COPY_CSV_KWARGS:
+        return False
+    return csv_kwargs['encoding'].lower().replace('-', '') == 'utf8'
+
+
+def _compile_copy_sql(values_qs, select_names, field_names, delimiter):
+    """
+    compiles a values queryset into a COPY statement that writes its rows
+    as CSV, with the columns in the order of `field_names`.
+
+    returns None if the queryset can't match any rows.
+    """
+    try:
+        sql, params = values_qs.query.sql_with_params()
+    except EmptyResultSet:
+        return None
+
+    with connections[values_qs.db].cursor() as cursor:
+        sql = cursor.mogrify(sql, params)
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8')
+
+    # joined columns can share a name, so the columns of the query are
+    # renamed positionally before they get reordered
+    aliases = ['"djqscsv_%d"' % index for index in range(len(select_names))]
+    columns = [aliases[select_names.index(field)] for field in field_names]
+
+    return ("COPY (SELECT %s FROM (%s) AS djqscsv_export (%s)) "
+            "TO STDOUT WITH (FORMAT csv, DELIMITER '%s')" % (
+                ', '.join(columns), sql, ', '.join(aliases),
+                delimiter.replace("'", "''")))
+
+
+def _estimate_count(queryset):
+    """
+    returns the query planner's estimate of the number of rows of a
+    queryset, which is much cheaper than counting them, or None if the
+    database doesn't provide one.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def _iter_copy(using, copy_sql):
+    """
+    runs a COPY ... TO STDOUT statement and yields its output in chunks
+    while it runs.
+    """
+    with connections[using].cursor() as cursor:
+        def _copy(emit):
+            output = _CallbackWriter(emit)
+            cursor.copy_expert(copy_sql, output)
+            output.flush()
+
+        for chunk in _iter_in_thread(_copy):
+            yield chunk
+
+
+def _prefetch_records(fetch_records, chunk_size, queue_size):
+    """
+    iterates over the records returned by `fetch_records` in a background
+    thread, which fetches up to `queue_size` chunks of `chunk_size`
+    records ahead of the consumer.
+
+    the thread queries the database with connections of its own, which
+    it closes once it is done or the consumer goes away.
+    """
+    def _fetch(emit):
+        records = None
+        try:
+            records = fetch_records()
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+                emit(chunk)
+        finally:
+            # closing the iterator closes its database cursor
+            close = getattr(records, 'close', None)
+            if close is not None:
+                close()
+            for connection in connections.all():
+                connection.close()
+
+    for chunk in _iter_in_thread(_fetch, queue_size):
+        for record in chunk:
+            yield record
+
+
+class _ProducerCancelled(Exception):
+    pass
+
+
+class _ProducerFailed(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def _iter_in_thread(produce, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    calls `produce(emit)` in a background thread and yields every value
+    that it passes to `emit`, in order.
+
+    at most `queue_size` values are held in memory: `emit` blocks until
+    the consumer catches up. if the generator is closed before the
+    producer is done, the next call to `emit` raises in the producer to
+    stop it. exceptions raised by the producer are re-raised here.
+    """
+    items = queue.Queue(queue_size)
+    stopped = threading.Event()
+    done = object()
+
+    def emit(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _ProducerCancelled()
+
+    def run():
+        try:
+            produce(emit)
+            emit(done)
+        except _ProducerCancelled:
+            pass
+        except BaseException:
+            try:
+                emit(_ProducerFailed(sys.exc_info()))
+            except _ProducerCancelled:
+                pass
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, _ProducerFailed):
+                six.reraise(*item.exc_info)
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def _serialize_value(value):
+    # provide default serializer for the case when
+    # non text values get sent without a serializer
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    else:
+        return six.text_type(value)
+
+
+def _make_serializer(serializer, restval):
+    """
+    returns a function that turns a single value of a column into text.
+
+    None values become `restval`, and the output of a user provided
+    serializer is coerced to text if it did not produce a string.
+    """
+    text_type = six.text_type
+
+    if serializer is None:
+        def _serialize(value):
+            # text is by far the most common case, so check for it first
+            value_type = type(value)
+            if value_type is text_type:
+                return value
+            elif value is None:
+                return restval
+            elif value_type is int:
+                return text_type(value)
+            elif value_type is datetime.datetime:
+                return value.isoformat()
+            return _serialize_value(value)
+    else:
+        def _serialize(value):
+            if value is None:
+                return restval
+            value = serializer(value)
+            if not isinstance(value, text_type):
+                value = text_type(value)
+            return value
+
+    return _serialize
+
+
+def _compile_serializers(field_names, field_serializer_map, restval=''):
+    """
+    takes the ordered field names of an export and returns a tuple with
+    the function that serializes each column, in the same order.
+    """
+    return tuple(_make_serializer(field_serializer_map.get(field), restval)
+                 for field in field_names)
+
+
+def _values_getter(field_names):
+    """
+    returns a function that extracts the values of the given fields, in
+    order, from a record of a values queryset.
+    """
+    if len(field_names) == 1:
+        field_name = field_names[0]
+        return lambda record: (record[field_name],)
+    return itemgetter(*field_names)
 
-    obj = {}
-    for key, val in six.iteritems(record):
-        if val is not None:
-            serializer = field_serializer_map.get(key, _serialize_value)
-            newval = serializer(val)
-            # If the user provided serializer did not produce a string,
-            # coerce it to a string
-            if not isinstance(newval, six.text_type):
-                newval = six.text_type(newval)
-            obj[key] = newval
 
-    return obj
+def _serialize_row(serializers, values):
+    return [serialize(value) for serialize, value in zip(serializers, values)]
 
 
-def _append_datestamp(filename):
+def _append_datestamp(filename, extension='.csv'):
     """
     takes a filename and returns a new filename with the
     current formatted date appended to it.
@@ -218,8 +1959,9 @@ def _append_datestamp(filename):
     raises an exception if it receives an unclean filename.
     validation/preprocessing must be called separately.
     """
-    if filename != _validate_and_clean_filename(filename):
+    if filename != _validate_and_clean_filename(filename, extension):
         raise ValidationError('cannot datestamp unvalidated filename')
 
     formatted_datestring = datetime.date.today().strftime("%Y%m%d")
-    return '%s_%s.csv' % (filename[:-4], formatted_datestring)
+    return '%s_%s%s' % (filename[:-len(extension)], formatted_datestring,
+                        extension)
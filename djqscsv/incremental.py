@@ -0,0 +1,153 @@
+"""
+Incremental exports, for appending the rows that changed since the last
+export to a CSV file instead of exporting the whole table again.
+
+`write_incremental_csv` exports the rows whose value of a monotonic column,
+such as the primary key or an `updated` timestamp, is past the watermark
+of the previous export, and keeps the watermark in a small state file next
+to the CSV.
+"""
+import datetime
+import decimal
+import json
+import os
+import uuid
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Max
+
+from .djqscsv import CSVException, write_csv
+
+# Python 2 has no atomic replace on windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+def write_incremental_csv(queryset, path, watermark_field='pk',
+                          state_path=None, **kwargs):
+    """
+    appends the rows of `queryset` whose `watermark_field` is greater than
+    the watermark stored in `state_path`, which defaults to the CSV's path
+    with `.state` appended, to the CSV file at `path`. returns the new
+    watermark, or None while the queryset has no rows.
+
+    the BOM and the header are only written when the file is created, for
+    example on the first export or after the file was moved away. takes
+    the same keyword arguments as `write_csv`, except `write_header`.
+
+    the watermark is only stored once the rows are written. if an export
+    fails halfway, the rows it appended are truncated by the next export,
+    so that no row is written twice. an existing CSV without a state file
+    is never appended to.
+    """
+    if 'write_header' in kwargs:
+        raise CSVException('incremental exports decide whether to write '
+                           'the header')
+
+    model = queryset.model
+    try:
+        if watermark_field == 'pk':
+            field = model._meta.pk
+        else:
+            field = model._meta.get_field(watermark_field)
+    except FieldDoesNotExist:
+        raise CSVException('%s has no field %s' % (model.__name__,
+                                                   watermark_field))
+
+    if state_path is None:
+        state_path = path + '.state'
+    state = _read_state(state_path)
+
+    if state is not None and state['field'] != watermark_field:
+        raise CSVException('%s holds the watermark of %s, not %s' %
+                           (state_path, state['field'], watermark_field))
+
+    if not os.path.exists(path):
+        # a new file, whose rows are cut off again if the export fails
+        state = {
+            'field': watermark_field,
+            'watermark': state['watermark'] if state is not None else None,
+            'size': 0,
+        }
+        _write_state(state_path, state)
+    elif state is None:
+        raise CSVException('%s has no state file at %s' % (path, state_path))
+
+    watermark = None
+    if state['watermark'] is not None:
+        watermark = field.to_python(state['watermark'])
+        queryset = queryset.filter(**{'%s__gt' % watermark_field:
+                                      watermark})
+
+    # rows that arrive while the export runs are left for the next one
+    new_watermark = queryset.aggregate(
+        watermark=Max(watermark_field))['watermark']
+    if new_watermark is None:
+        return watermark
+    queryset = queryset.filter(**{'%s__lte' % watermark_field:
+                                  new_watermark})
+    queryset = queryset.order_by(*_unique_ordering(watermark_field))
+
+    with _open_for_append(path, state) as csv_file:
+        write_csv(queryset, csv_file, write_header=csv_file.tell() == 0,
+                  **kwargs)
+        size = csv_file.tell()
+
+    _write_state(state_path, {
+        'field': watermark_field,
+        'watermark': _serialize_watermark(new_watermark),
+        'size': size,
+    })
+    return new_watermark
+
+
+def _unique_ordering(watermark_field):
+    if watermark_field == 'pk':
+        return ['pk']
+    return [watermark_field, 'pk']
+
+
+def _open_for_append(path, state):
+    """
+    opens the CSV to append to, after cutting off the rows of an export
+    that failed before it stored its watermark.
+    """
+    if not os.path.exists(path):
+        return open(path, 'wb')
+
+    csv_file = open(path, 'r+b')
+    csv_file.seek(0, os.SEEK_END)
+    size = csv_file.tell()
+
+    if size < state['size']:
+        csv_file.close()
+        raise CSVException('%s is smaller than it was after the last '
+                           'export' % path)
+    if size > state['size']:
+        csv_file.truncate(state['size'])
+        csv_file.seek(state['size'])
+    return csv_file
+
+
+def _serialize_watermark(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        # unlike DjangoJSONEncoder, this keeps the microseconds
+        return value.isoformat()
+    elif isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    return value
+
+
+def _read_state(state_path):
+    try:
+        with open(state_path) as state_file:
+            return json.load(state_file)
+    except (IOError, OSError):
+        return None
+    except ValueError:
+        raise CSVException('%s is not a valid state file' % state_path)
+
+
+def _write_state(state_path, state):
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    _replace(state_path + '.tmp', state_path)
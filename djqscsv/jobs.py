@@ -0,0 +1,281 @@
+"""
+Background CSV exports, for querysets that take longer to export than a
+request may last.
+
+An `ExportJobStore` renders submitted querysets with a pool of workers into
+a directory, where their status and progress can be polled and the results
+downloaded once they are finished.
+"""
+import json
+import os
+import pickle
+import time
+import uuid
+
+from multiprocessing.pool import Pool, ThreadPool
+
+from django.db import connections
+from django.http import FileResponse
+
+from .djqscsv import (CSVException, _CompressedFile, _get_compressed_filename,
+                      _get_response_filename, _init_shard_worker, _iter_csv,
+                      _pickle_queryset, _unpickle_queryset)
+
+PENDING = 'pending'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+# the longest time in seconds between two progress updates of a job
+PROGRESS_INTERVAL = 1.0
+
+# Python 2 has no atomic replace on windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+class ExportJobStore(object):
+    """
+    Runs CSV exports in the background and keeps their results in
+    `directory`.
+
+    `workers` is the number of exports that run at the same time, in
+    threads or, if `processes` is set, in worker processes. With no
+    workers, exports run right away in the calling thread.
+
+    jobs are removed once they have not been updated for `max_age`
+    seconds.
+    """
+
+    def __init__(self, directory, workers=1, processes=False,
+                 max_age=24 * 60 * 60):
+        self.directory = os.path.abspath(directory)
+        self.workers = workers
+        self.processes = processes
+        self.max_age = max_age
+        self._pool = None
+        self._results = {}
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def submit(self, queryset, filename=None, append_datestamp=False,
+               compression=None, **kwargs):
+        """
+        starts exporting the queryset in the background and returns the
+        id of the new job. takes the same keyword arguments as `write_csv`,
+        except `processes`.
+        """
+        self.cleanup()
+
+        filename = _get_response_filename(queryset, filename,
+                                          append_datestamp)
+        if compression:
+            filename = _get_compressed_filename(filename, compression)
+
+        job_id = uuid.uuid4().hex
+        job = (self.directory, job_id, _pickle_queryset(queryset),
+               compression, kwargs, bool(self.workers))
+        if self.workers and self.processes:
+            # the pool pickles the job in a thread of its own, where the
+            # error would never be seen and the job would stay pending
+            try:
+                pickle.dumps(job, pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                raise CSVException('jobs that run in worker processes '
+                                   'must be picklable: %s' % e)
+
+        _write_status(self.directory, job_id, {
+            'status': PENDING,
+            'filename': filename,
+            'created': time.time(),
+            'rows': 0,
+            'total': None,
+            'eta': None,
+            'error': None,
+        })
+
+        if self.workers:
+            self._results[job_id] = self._get_pool().apply_async(
+                _run_job, job)
+        else:
+            _run_job(*job)
+
+        return job_id
+
+    def status(self, job_id):
+        """
+        returns the status of a job, a dict with the keys:
+
+        - 'status': one of 'pending', 'running', 'finished' or 'failed'
+        - 'filename': the filename to download the result as
+        - 'created': the time the job was submitted, as a timestamp
+        - 'rows': the number of rows written so far, or None for exports
+          that use COPY
+        - 'total': the number of rows to export, if `progress_total` was
+          given and the total is known
+        - 'eta': the estimated seconds until the job is finished
+        - 'error': the error message of a failed job
+        """
+        try:
+            with open(self._status_path(job_id)) as status_file:
+                return json.load(status_file)
+        except (IOError, OSError, ValueError):
+            raise CSVException('unknown export job: %s' % job_id)
+
+    def wait(self, job_id, timeout=None):
+        """waits until a job submitted to the workers has run."""
+        result = self._results.get(job_id)
+        if result is not None:
+            result.wait(timeout)
+        return self.status(job_id)
+
+    def open(self, job_id):
+        """returns the result of a finished job as an open binary file."""
+        if self.status(job_id)['status'] != FINISHED:
+            raise CSVException('export job %s is not finished' % job_id)
+        return open(self._result_path(job_id), 'rb')
+
+    def response(self, job_id):
+        """returns a response to download the result of a finished job."""
+        filename = self.status(job_id)['filename']
+        if filename.endswith('.gz'):
+            content_type = 'application/gzip'
+        else:
+            content_type = 'text/csv'
+
+        response = FileResponse(self.open(job_id), content_type=content_type)
+        response['Content-Disposition'] = ('attachment; filename=%s;' %
+                                           filename)
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def cleanup(self):
+        """removes the files of jobs that have expired."""
+        expired_before = time.time() - self.max_age
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            job_id = name[:-len('.json')]
+            try:
+                if os.path.getmtime(self._status_path(job_id)) >= \
+                        expired_before:
+                    continue
+            except OSError:
+                continue
+            for path in (self._result_path(job_id),
+                         self._result_path(job_id) + '.part',
+                         self._status_path(job_id)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._results.pop(job_id, None)
+
+    def close(self):
+        """waits for the running jobs and stops the workers."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.processes:
+                # the workers must not share the database connections of
+                # this process, which can't be closed inside a transaction
+                if any(connection.in_atomic_block
+                       for connection in connections.all()):
+                    raise CSVException('worker processes can not be '
+                                       'started inside a transaction')
+                for connection in connections.all():
+                    connection.close()
+                self._pool = Pool(self.workers,
+                                  initializer=_init_shard_worker)
+            else:
+                self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def _status_path(self, job_id):
+        return _status_path(self.directory, job_id)
+
+    def _result_path(self, job_id):
+        return _result_path(self.directory, job_id)
+
+
+def _status_path(directory, job_id):
+    return os.path.join(directory, '%s.json' % job_id)
+
+
+def _result_path(directory, job_id):
+    return os.path.join(directory, '%s.csv' % job_id)
+
+
+def _write_status(directory, job_id, status):
+    path = _status_path(directory, job_id)
+    with open(path + '.tmp', 'w') as status_file:
+        json.dump(status, status_file)
+    _replace(path + '.tmp', path)
+
+
+def _update_status(directory, job_id, **changes):
+    with open(_status_path(directory, job_id)) as status_file:
+        status = json.load(status_file)
+    status.update(changes)
+    _write_status(directory, job_id, status)
+
+
+def _get_progress_kwargs(directory, job_id, kwargs):
+    """
+    returns the export options of a job with a progress callback that
+    keeps its status file up to date, and calls the callback of the
+    options as well, if there is one.
+    """
+    callback = kwargs.get('progress')
+
+    def progress(report):
+        _update_status(directory, job_id, rows=report['rows'],
+                       total=report['total'], eta=report['eta'])
+        if callback is not None:
+            callback(report)
+
+    job_kwargs = dict(kwargs, progress=progress)
+    job_kwargs.setdefault('progress_interval', PROGRESS_INTERVAL)
+    return job_kwargs
+
+
+def _run_job(directory, job_id, queryset_state, compression, kwargs,
+             close_connections):
+    """
+    renders the result of a job, keeping its status file up to date.
+
+    the result is written to a temporary file that is only moved into
+    place once the export is finished.
+    """
+    result_path = _result_path(directory, job_id)
+    try:
+        _update_status(directory, job_id, status=RUNNING)
+        queryset = _unpickle_queryset(queryset_state)
+
+        with open(result_path + '.part', 'wb') as result_file:
+            file_obj = result_file
+            if compression:
+                file_obj = _CompressedFile(result_file, compression)
+
+            for _ in _iter_csv(queryset, file_obj,
+                               **_get_progress_kwargs(directory, job_id,
+                                                      kwargs)):
+                pass
+
+            if compression:
+                file_obj.finish()
+
+        _replace(result_path + '.part', result_path)
+        _update_status(directory, job_id, status=FINISHED)
+    except Exception as e:
+        _update_status(directory, job_id, status=FAILED, error=str(e))
+    finally:
+        if close_connections:
+            # django only closes connections at the end of a request, so
+            # the worker has to close its own
+            for connection in connections.all():
+                connection.close()
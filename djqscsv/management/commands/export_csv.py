@@ -0,0 +1,248 @@
+"""
+Exports the rows of one or more models to CSV files, without loading the
+querysets into memory.
+
+run it with::
+
+  $ python manage.py export_csv shop.Order --filter status=paid \\
+      --fields id customer__email total --order-by id \\
+      --output orders.csv
+
+  $ python manage.py export_csv shop.Order shop.Customer shop.Product \\
+      --workers 3 --compression gzip --output /var/backups/shop
+"""
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from django.apps import apps
+from django.core.exceptions import FieldError, ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from djqscsv.djqscsv import write_csv
+
+# the suffixes of the files written with each kind of compression
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'deflate': '.deflate'}
+
+# Python 2 has no atomic replace on windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+class Command(BaseCommand):
+    help = ('Exports the rows of one or more models to CSV files, reading '
+            'them from the database in chunks.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='+', metavar='app_label.Model',
+                            help='the models to export')
+        parser.add_argument('--output', default='.',
+                            help='the file to write a single export to, or '
+                                 'the directory to write the exports to, '
+                                 'named after their models (default: the '
+                                 'current directory)')
+        parser.add_argument('--filter', action='append', default=[],
+                            metavar='LOOKUP=VALUE',
+                            help='only export the rows that match a lookup, '
+                                 'such as status=paid or id__in=1,2,3. can '
+                                 'be given more than once')
+        parser.add_argument('--exclude', action='append', default=[],
+                            metavar='LOOKUP=VALUE',
+                            help='leave out the rows that match a lookup')
+        parser.add_argument('--fields', nargs='+',
+                            help='the fields to export, which may follow '
+                                 'relations, such as customer__email '
+                                 '(default: every concrete field)')
+        parser.add_argument('--order-by', nargs='+',
+                            help='the fields to order the rows by')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='the number of models that are exported '
+                                 'at the same time, each in a thread of '
+                                 'its own')
+        parser.add_argument('--processes', type=int,
+                            help='render each export in this many worker '
+                                 'processes, one primary key range at a '
+                                 'time')
+        parser.add_argument('--compression',
+                            choices=sorted(COMPRESSION_SUFFIXES),
+                            help='compress the files as they are written')
+        parser.add_argument('--chunk-size', type=int,
+                            help='the number of rows fetched from the '
+                                 'database at a time')
+        parser.add_argument('--keyset-page-size', type=int,
+                            help='read the rows in pages of this many rows '
+                                 'with keyset pagination, so that no '
+                                 'transaction is held open for the whole '
+                                 'export. this overrides --order-by')
+        parser.add_argument('--use-copy', action='store_true',
+                            help='let PostgreSQL render the rows with COPY')
+        parser.add_argument('--delimiter', default=',',
+                            help='the column separator')
+        parser.add_argument('--no-header', action='store_true',
+                            help="don't write the BOM and the header row")
+        parser.add_argument('--no-verbose-names', action='store_true',
+                            help='name the columns after their fields '
+                                 'instead of their verbose names')
+
+    def handle(self, *args, **options):
+        querysets = [(label, _get_queryset(label, options))
+                     for label in options['models']]
+        paths = _get_paths([queryset.model for _, queryset in querysets],
+                           options)
+        kwargs = _get_export_kwargs(options)
+        self.verbosity = options['verbosity']
+
+        exports = [(label, queryset, path, kwargs)
+                   for (label, queryset), path in zip(querysets, paths)]
+        workers = min(options['workers'], len(exports))
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(self._run_in_thread, exports)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._run(*export) for export in exports]
+
+        failures = 0
+        for (label, _, path, _), (rows, error) in zip(exports, results):
+            if error is not None:
+                failures += 1
+                self.stderr.write('%s could not be exported: %s' %
+                                  (label, error))
+            elif self.verbosity >= 1:
+                if rows is None:
+                    self.stdout.write('Exported %s to %s' % (label, path))
+                else:
+                    self.stdout.write('Exported %d rows of %s to %s' %
+                                      (rows, label, path))
+
+        if failures:
+            raise CommandError('%d of %d exports failed' %
+                               (failures, len(exports)))
+
+    def _run_in_thread(self, export):
+        try:
+            return self._run(*export)
+        finally:
+            # django only closes connections at the end of a request, so
+            # the thread has to close its own
+            for connection in connections.all():
+                connection.close()
+
+    def _run(self, label, queryset, path, kwargs):
+        """
+        writes one export to a temporary file that is only moved into
+        place once it is complete. returns the number of rows written and
+        the error the export failed with.
+        """
+        reports = []
+
+        def progress(report):
+            reports.append(report)
+            if self.verbosity >= 2 and not report['finished']:
+                self.stderr.write(_format_progress(label, report))
+
+        try:
+            with open(path + '.part', 'wb') as csv_file:
+                write_csv(queryset, csv_file, progress=progress, **kwargs)
+            _replace(path + '.part', path)
+        except Exception as e:
+            try:
+                os.remove(path + '.part')
+            except OSError:
+                pass
+            return None, e
+
+        # parallel exports don't report their progress
+        rows = reports[-1]['rows'] if reports else None
+        return rows, None
+
+
+def _get_queryset(label, options):
+    try:
+        model = apps.get_model(label)
+    except (LookupError, ValueError):
+        raise CommandError('unknown model: %s' % label)
+
+    try:
+        queryset = model._default_manager.filter(
+            **_parse_lookups(options['filter']))
+        queryset = queryset.exclude(**_parse_lookups(options['exclude']))
+        if options['fields']:
+            queryset = queryset.values(*options['fields'])
+        if options['order_by']:
+            queryset = queryset.order_by(*options['order_by'])
+    except (FieldError, ValidationError, ValueError) as e:
+        raise CommandError('%s: %s' % (label, e))
+    return queryset
+
+
+def _parse_lookups(lookups):
+    """
+    turns LOOKUP=VALUE arguments into filter keyword arguments. the values
+    of `in` lookups are separated by commas, and those of `isnull` lookups
+    are booleans.
+    """
+    parsed = {}
+    for lookup in lookups:
+        name, equals, value = lookup.partition('=')
+        if not equals or not name:
+            raise CommandError('filters look like LOOKUP=VALUE, not %s' %
+                               lookup)
+        if name.endswith('__in'):
+            value = value.split(',') if value else []
+        elif name.endswith('__isnull'):
+            value = value.lower() in ('1', 'true', 'yes')
+        parsed[name] = value
+    return parsed
+
+
+def _get_paths(models, options):
+    """
+    returns the path to write the export of each model to. several exports
+    always go into a directory, which is created if it doesn't exist.
+    """
+    output = options['output']
+    if len(set(models)) != len(models):
+        raise CommandError('every model can only be exported once')
+
+    if len(models) == 1 and not os.path.isdir(output):
+        return [output]
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    suffix = COMPRESSION_SUFFIXES.get(options['compression'], '')
+    return [os.path.join(output, '%s_%s.csv%s' % (model._meta.app_label,
+                                                  model._meta.model_name,
+                                                  suffix))
+            for model in models]
+
+
+def _get_export_kwargs(options):
+    kwargs = {
+        'delimiter': options['delimiter'],
+        'write_header': not options['no_header'],
+        'use_verbose_names': not options['no_verbose_names'],
+        'use_copy': options['use_copy'],
+        'processes': options['processes'],
+        'compression': options['compression'],
+        'progress_total': 'estimate',
+    }
+    if options['chunk_size'] is not None:
+        kwargs['iterator_chunk_size'] = options['chunk_size']
+    if options['keyset_page_size'] is not None:
+        kwargs['keyset_page_size'] = options['keyset_page_size']
+    return kwargs
+
+
+def _format_progress(label, report):
+    if report['rows'] is None:
+        message = '%s: %d bytes' % (label, report['bytes'])
+    else:
+        message = '%s: %d rows, %d rows/s' % (
+            label, report['rows'], report['rows_per_second'] or 0)
+    if report['eta'] is not None:
+        message += ', about %d seconds left' % report['eta']
+    return message
@@ -0,0 +1,25 @@
+"""
+Signals sent by djqscsv, for feeding exports into metrics and logging.
+"""
+from django.dispatch import Signal
+
+# sent with the queryset's model as the sender once an export has written
+# its last row, or has been abandoned, with the arguments:
+#
+# - queryset: the exported queryset
+# - rows: the number of rows written, or None for COPY exports
+# - bytes: the number of bytes written, before any compression
+# - completed: whether every row was written
+# - timings: a dict of times in seconds, with the keys
+#   - 'query': waiting for the first row, which includes running the query
+#   - 'fetch': waiting for the remaining rows
+#   - 'serialize': turning the rows into text
+#   - 'write': writing the rows to the file object
+#   - 'downstream': waiting for the consumer of a stream to ask for more
+#   - 'total': the whole export
+#   - 'first_row': from the start of the export until the first row was
+#     written, or None if there were no rows
+#
+# exports only measure their timings while a receiver is connected for
+# their model.
+export_finished = Signal()
@@ -0,0 +1,99 @@
+"""
+Export specs, for exports that are served over and over again.
+
+An `ExportSpec` declares the columns, headers, serializers, ordering and
+csv options of a model's export once, usually at import time. They are
+checked and set up right away, so that every export made with the spec
+only has to apply it to the queryset at hand.
+"""
+import csv
+
+from django.core.exceptions import FieldError
+
+from .djqscsv import (DJQSCSV_KWARGS, LAYOUT_KWARGS, CSVException,
+                      _ExportLayout, _get_model_label, _options_repr,
+                      render_to_csv_response, write_csv)
+
+
+class ExportSpec(object):
+    """
+    The layout of the exports of `model`: its `fields`, which default to
+    all of its concrete fields, and the options in `LAYOUT_KWARGS` or of
+    the csv writer.
+
+    a spec is passed to the export functions as `export_spec`, or used
+    through its own `render_to_csv_response` and `write_csv`. those take
+    the options of each export, such as `use_iterator` or `filename`,
+    while the spec decides what the CSV looks like.
+    """
+
+    def __init__(self, model, fields=None, **kwargs):
+        for key in kwargs:
+            if key in DJQSCSV_KWARGS and key not in LAYOUT_KWARGS:
+                raise CSVException('%s is an option of each export, not '
+                                   'of an export spec' % key)
+
+        if fields is None:
+            fields = [field.attname for field in model._meta.concrete_fields]
+
+        self.model = model
+        self.fields = list(fields)
+        self.kwargs = kwargs
+
+        try:
+            values_qs = model._default_manager.values(*self.fields)
+        except FieldError as e:
+            raise CSVException('invalid export spec fields: %s' % e)
+
+        self.layout = _ExportLayout(values_qs, kwargs)
+
+        columns = set(self.layout.field_names)
+        for option in ('field_header_map', 'field_serializer_map',
+                       'field_order'):
+            unknown = set(kwargs.get(option) or ()) - columns
+            if unknown:
+                raise CSVException('%s names unknown columns: %s' %
+                                   (option, ', '.join(sorted(unknown))))
+
+        try:
+            self.layout.encode_header()
+        except (TypeError, ValueError, csv.Error) as e:
+            raise CSVException('invalid csv writer options: %s' % e)
+
+    def apply(self, queryset, kwargs=None):
+        """
+        returns the values queryset of an export of `queryset` with the
+        spec, given the export's keyword arguments.
+        """
+        if not issubclass(queryset.model, self.model):
+            raise CSVException('the export spec of %s does not apply to '
+                               'querysets of %s' % (self.model.__name__,
+                                                    queryset.model.__name__))
+        for key in kwargs or ():
+            if key in LAYOUT_KWARGS or key not in DJQSCSV_KWARGS:
+                raise CSVException('%s is declared by the export spec' % key)
+        return queryset.values(*self.fields)
+
+    def render_to_csv_response(self, queryset, **kwargs):
+        """`render_to_csv_response` with this spec."""
+        return render_to_csv_response(queryset, export_spec=self, **kwargs)
+
+    def write_csv(self, queryset, file_obj, **kwargs):
+        """`write_csv` with this spec."""
+        return write_csv(queryset, file_obj, export_spec=self, **kwargs)
+
+    def __repr__(self):
+        # cached exports and ETags are keyed by this
+        return 'ExportSpec(%s, %s, %s)' % (
+            _get_model_label(self.model), self.fields,
+            _options_repr(self.kwargs))
+
+    # the layout holds compiled functions, so a spec is sent to other
+    # processes as its declaration and set up again there
+
+    def __getstate__(self):
+        return {'model': self.model, 'fields': self.fields,
+                'kwargs': self.kwargs}
+
+    def __setstate__(self, state):
+        self.__init__(state['model'], state['fields'], **state['kwargs'])
@@ -1,2 +1,9 @@
-csv_file = TemporaryFile()
-djqscsv.write_csv(person_qs, csv_file)
+from djqscsv.jobs import ExportJobStore
+
+exports = ExportJobStore('/var/tmp/exports', workers=2)
+
+job_id = exports.submit(person_qs, filename='people.csv')
+exports.status(job_id)
+# => {'status': 'running', 'rows': 1500, 'filename': 'people.csv', ...}
+response = exports.response(job_id)
+# once the job is finished, returns a FileResponse for the export
@@ -22,5 +22,6 @@ setup(
         "Framework :: Django",
         "License :: OSI Approved :: GNU General Public License (GPL)"
     ],
-    install_requires=['django>=1.8', 'unicodecsv>=0.14.1'],
+    install_requires=['django>=1.8',
+                      'unicodecsv>=0.14.1; python_version < "3"'],
 )
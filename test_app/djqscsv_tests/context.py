@@ -5,5 +5,18 @@ sys.path.insert(0, os.path.join(
     '../..'))
 
 import djqscsv.djqscsv as djqscsv  # NOQA
+import djqscsv.jobs as jobs  # NOQA
+import djqscsv.cache as cache  # NOQA
+import djqscsv.signals as signals  # NOQA
+import djqscsv.spec as spec  # NOQA
+import djqscsv.incremental as incremental  # NOQA
 
+import djqscsv._csql as csql  # NOQA
 from djqscsv._csql import SELECT, EXCLUDE, AS, CONSTANT  # NOQA
+from djqscsv._csql import (WHERE, ORDER_BY, GROUP_BY, COUNT, SUM,  # NOQA
+                           MIN, MAX)  # NOQA
+
+try:
+    import djqscsv._async as djqscsv_async  # NOQA
+except (ImportError, SyntaxError):
+    djqscsv_async = None
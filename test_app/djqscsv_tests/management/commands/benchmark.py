@@ -0,0 +1,217 @@
+"""
+Benchmarks exports of a generated dataset, so that runs can be compared to
+catch performance regressions.
+
+run it with::
+
+  $ python manage.py migrate
+  $ python manage.py benchmark --rows 1000000 --output results.json
+
+the dataset is kept in the database between runs and only regenerated when
+the number of rows changes.
+"""
+import json
+import platform
+import time
+
+from datetime import timedelta
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import django
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from djqscsv_tests.context import djqscsv
+from djqscsv_tests.models import SOME_TIME, Activity, Person
+
+# the number of people inserted at a time
+BATCH_SIZE = 10000
+
+FIELDS = ('id', 'name', 'address', 'info', 'hobby__name', 'born')
+
+SERIALIZERS = {
+    'name': lambda name: name.upper(),
+    'born': lambda born: born.strftime('%Y-%m-%d %H:%M'),
+}
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+class _Sink(object):
+    """
+    counts the bytes written to it and notes when the first byte after the
+    header arrives.
+    """
+
+    def __init__(self, header_size=0):
+        self.header_size = header_size
+        self.size = 0
+        self.time_to_first_byte = None
+        self.start = _timer()
+
+    def write(self, value):
+        self.size += len(value)
+        if self.time_to_first_byte is None and self.size > self.header_size:
+            self.time_to_first_byte = _timer() - self.start
+
+
+def _write_csv(queryset, sink, **kwargs):
+    djqscsv.write_csv(queryset, sink, **kwargs)
+
+
+def _streaming(queryset, sink, **kwargs):
+    response = djqscsv.render_to_csv_response(queryset, **kwargs)
+    for chunk in response.streaming_content:
+        sink.write(chunk)
+
+
+def _non_streaming(queryset, sink, **kwargs):
+    response = djqscsv.render_to_csv_response(queryset, streaming=False,
+                                              **kwargs)
+    sink.write(response.content)
+
+
+MODES = (
+    ('write_csv', _write_csv),
+    ('streaming', _streaming),
+    ('non_streaming', _non_streaming),
+)
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks CSV exports of generated Person rows and writes '
+            'the results as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000,
+                            help='the number of people to export')
+        parser.add_argument('--activities', type=int, default=100,
+                            help='the number of activities to generate')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='the number of timed runs of each case, '
+                                 'of which the fastest is reported')
+        parser.add_argument('--no-memory', dest='memory',
+                            action='store_false',
+                            help="don't measure the peak memory, which "
+                                 "takes an extra run of each case")
+        parser.add_argument('--output',
+                            help='the file to write the results to, '
+                                 'instead of stdout')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        if _generate_data(rows, options['activities']):
+            self.stderr.write('generated %d people' % rows)
+
+        queryset = Person.objects.values(*FIELDS).order_by('id')
+        measure_memory = options['memory'] and tracemalloc is not None
+
+        results = []
+        for mode, run in MODES:
+            for serializers in (False, True):
+                for verbose_names in (True, False):
+                    kwargs = {'use_verbose_names': verbose_names}
+                    if serializers:
+                        kwargs['field_serializer_map'] = SERIALIZERS
+
+                    result = {
+                        'mode': mode,
+                        'serializers': serializers,
+                        'verbose_names': verbose_names,
+                        'rows': rows,
+                    }
+                    result.update(_measure(run, queryset, kwargs, rows,
+                                           options['repeat'],
+                                           measure_memory))
+                    results.append(result)
+                    self.stderr.write(
+                        '%(mode)s serializers=%(serializers)s '
+                        'verbose_names=%(verbose_names)s: '
+                        '%(rows_per_second).0f rows/s' % result)
+
+        report = json.dumps({
+            'created': time.time(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'rows': rows,
+            'results': results,
+        }, indent=2, sort_keys=True)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
+
+
+def _generate_data(rows, activities):
+    """
+    fills the database with `rows` people doing one of `activities`
+    activities, unless it already holds that many. returns whether any
+    data was generated.
+    """
+    if (Person.objects.count() == rows and
+            Activity.objects.count() == activities):
+        return False
+
+    with transaction.atomic():
+        Person.objects.all().delete()
+        Activity.objects.all().delete()
+
+        Activity.objects.bulk_create([Activity(name='activity %d' % i)
+                                      for i in range(activities)])
+        hobby_ids = list(Activity.objects.values_list('pk', flat=True))
+
+        for start in range(0, rows, BATCH_SIZE):
+            Person.objects.bulk_create([
+                Person(name='person %d' % i,
+                       address='%d main street' % i,
+                       info=u'likes "quotes", commas and caf\xe9 #%d' % i,
+                       hobby_id=hobby_ids[i % len(hobby_ids)],
+                       born=SOME_TIME + timedelta(minutes=i))
+                for i in range(start, min(start + BATCH_SIZE, rows))])
+
+    return True
+
+
+def _measure(run, queryset, kwargs, rows, repeat, measure_memory):
+    """
+    runs an export of `rows` rows `repeat` times and returns the timings of
+    the fastest run, and its peak memory use if `measure_memory` is set.
+    """
+    header = _Sink()
+    djqscsv.write_csv(queryset.none(), header, **kwargs)
+
+    best = None
+    for _ in range(max(repeat, 1)):
+        sink = _Sink(header.size)
+        run(queryset, sink, **kwargs)
+        seconds = _timer() - sink.start
+        if best is None or seconds < best[0]:
+            best = (seconds, sink)
+
+    seconds, sink = best
+    result = {
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else None,
+        'time_to_first_byte': sink.time_to_first_byte,
+        'bytes': sink.size,
+        'peak_memory': None,
+    }
+
+    if measure_memory:
+        # tracing slows python down, so memory is measured in its own run
+        tracemalloc.start()
+        try:
+            run(queryset, _Sink(header.size), **kwargs)
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return result
@@ -0,0 +1,124 @@
+"""
+Benchmarks the compiled row projections of the _csql helpers against the
+per-cell evaluation they replaced, on wide datasets.
+
+run it with::
+
+  $ python manage.py benchmark_csql --columns 20 100 500 --output csql.json
+"""
+import itertools
+import json
+import platform
+import time
+
+from collections import deque
+
+from django.core.management.base import BaseCommand
+
+from djqscsv_tests.context import AS, EXCLUDE, SELECT, csql
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def _interpreted_select(dataset, *args):
+    """
+    SELECT as it was before projections were compiled: a tuple unpack, an
+    index and a transformer call for every cell.
+    """
+    header, rows = csql._split_header(dataset)
+    index_headers = [csql._transform(header, arg) for arg in args]
+    yield [h for _, h, _ in index_headers]
+    for datarow in rows:
+        yield [trans(datarow[i]) for i, h, trans in index_headers]
+
+
+def _interpreted_exclude(dataset, *args):
+    header, rows = csql._split_header(dataset)
+    antiargs = [value for index, value in enumerate(header)
+                if index not in args and value not in args]
+    return _interpreted_select(itertools.chain([header], rows), *antiargs)
+
+
+def _upper(value):
+    return value.upper()
+
+
+def _cases(header):
+    """yields the name, the SELECT-like helper and arguments of each case."""
+    yield 'identity', SELECT, _interpreted_select, header
+    yield 'renamed', SELECT, _interpreted_select, [
+        AS(field, field.upper()) for field in header]
+    # a transformer on every fourth column
+    yield 'mixed', SELECT, _interpreted_select, [
+        (field, field, _upper) if index % 4 == 0 else field
+        for index, field in enumerate(header)]
+    yield 'exclude', EXCLUDE, _interpreted_exclude, header[::2]
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the _csql row projections on wide datasets and '
+            'writes the results as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000,
+                            help='the number of rows in each dataset')
+        parser.add_argument('--columns', type=int, nargs='+',
+                            default=[20, 100, 500],
+                            help='the widths of the datasets')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='the number of timed runs of each case, '
+                                 'of which the fastest is reported')
+        parser.add_argument('--output',
+                            help='the file to write the results to, '
+                                 'instead of stdout')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        results = []
+        for columns in options['columns']:
+            header = ['column_%d' % index for index in range(columns)]
+            datarow = ['value %d' % index for index in range(columns)]
+
+            for name, compiled, interpreted, select_args in _cases(header):
+                result = {'case': name, 'rows': rows, 'columns': columns}
+                for implementation, helper in (('compiled', compiled),
+                                               ('interpreted', interpreted)):
+                    seconds = _measure(helper, header, datarow, rows,
+                                       select_args, options['repeat'])
+                    result[implementation] = {
+                        'seconds': seconds,
+                        'rows_per_second': rows / seconds if seconds else None,
+                    }
+                result['speedup'] = (result['interpreted']['seconds'] /
+                                     result['compiled']['seconds'])
+                results.append(result)
+                self.stderr.write('%(case)s, %(columns)d columns: '
+                                  '%(speedup).2fx' % result)
+
+        report = json.dumps({
+            'created': time.time(),
+            'python': platform.python_version(),
+            'rows': rows,
+            'results': results,
+        }, indent=2, sort_keys=True)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
+
+
+def _measure(helper, header, datarow, rows, select_args, repeat):
+    """returns the fastest time to run a helper over the dataset."""
+    best = None
+    for _ in range(max(repeat, 1)):
+        # the same row is streamed over and over, so that wide datasets
+        # don't have to fit into memory
+        dataset = itertools.chain([header], itertools.repeat(datarow, rows))
+        start = _timer()
+        deque(helper(dataset, *select_args), maxlen=0)
+        seconds = _timer() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
@@ -1,7 +1,11 @@
 from six import python_2_unicode_compatible
 from django.db import models
 
-from django.utils.translation import ugettext as _
+try:
+    from django.utils.translation import ugettext as _
+except ImportError:
+    # Django 4.0+
+    from django.utils.translation import gettext as _
 from datetime import datetime
 
 SOME_TIME = datetime(2001, 1, 1, 1, 1)
@@ -1,2 +1,17 @@
+from djqscsv_tests.context import djqscsv_async
+
 from djqscsv_tests.tests.test_csv_creation import *  # NOQA
 from djqscsv_tests.tests.test_utilities import *  # NOQA
+from djqscsv_tests.tests.test_jobs import *  # NOQA
+from djqscsv_tests.tests.test_cache import *  # NOQA
+from djqscsv_tests.tests.test_benchmark import *  # NOQA
+from djqscsv_tests.tests.test_signals import *  # NOQA
+from djqscsv_tests.tests.test_csql import *  # NOQA
+from djqscsv_tests.tests.test_spec import *  # NOQA
+from djqscsv_tests.tests.test_incremental import *  # NOQA
+from djqscsv_tests.tests.test_export_csv import *  # NOQA
+
+# the test runner only discovers test*.py modules, so the async tests,
+# which are a syntax error on Python 2, are only imported where they run
+if djqscsv_async is not None:
+    from djqscsv_tests.tests.async_tests import *  # NOQA
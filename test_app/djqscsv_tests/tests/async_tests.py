@@ -0,0 +1,117 @@
+from unittest import skipIf
+
+import zlib
+
+from asgiref.sync import async_to_sync
+
+from django import VERSION as DJANGO_VERSION
+
+from io import BytesIO
+
+from djqscsv_tests.context import djqscsv, djqscsv_async, signals
+
+from djqscsv_tests.models import Person
+
+from djqscsv_tests.tests.test_csv_creation import CSVTestCase
+
+
+def collect(chunks):
+    async def _collect():
+        return [chunk async for chunk in chunks]
+    return async_to_sync(_collect)()
+
+
+class AsyncIterCSVTests(CSVTestCase):
+
+    def assertSameAsSync(self, qs, **kwargs):
+        obj = BytesIO()
+        djqscsv.write_csv(qs, obj, **kwargs)
+        content = collect(djqscsv_async._aiter_csv(qs, djqscsv._Echo(),
+                                                   **kwargs))
+        self.assertEqual(b''.join(content), obj.getvalue())
+
+    def test_async_full(self):
+        self.assertSameAsSync(self.qs)
+
+    def test_async_limited(self):
+        self.assertSameAsSync(self.qs.values('name', 'hobby__name'),
+                              field_header_map={'name': 'Name'})
+
+    def test_async_serializers(self):
+        self.assertSameAsSync(
+            self.qs, field_serializer_map={'born': lambda d: d.year})
+
+    def test_async_no_iterator(self):
+        self.assertSameAsSync(self.qs, use_iterator=False)
+
+    def test_async_keyset(self):
+        self.assertSameAsSync(self.qs, keyset_page_size=2)
+
+    def test_async_small_chunks(self):
+        self.assertSameAsSync(self.qs, iterator_chunk_size=1)
+
+    def test_async_buffered(self):
+        content = djqscsv_async._aiter_csv(self.qs, djqscsv._Echo())
+        buffered = collect(djqscsv_async._abuffer_chunks(content, 1024,
+                                                         header_chunks=2))
+        # the BOM and the header are sent before the rows
+        self.assertEqual(len(buffered), 2)
+        self.assertMatchesCsv(b''.join(buffered).splitlines(),
+                              self.FULL_PERSON_CSV)
+
+    def test_async_compressed(self):
+        content = djqscsv_async._aiter_csv(self.qs, djqscsv._Echo())
+        compressed = collect(djqscsv_async._acompress_chunks(
+            content, djqscsv._Compressor('deflate')))
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs, obj)
+        self.assertEqual(zlib.decompress(b''.join(compressed)),
+                         obj.getvalue())
+
+    def test_async_export_finished(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        signals.export_finished.connect(receiver, sender=Person)
+        self.addCleanup(signals.export_finished.disconnect, receiver,
+                        sender=Person)
+        self.assertSameAsSync(self.qs)
+
+        self.assertEqual(len(received), 2)
+        sync_received, async_received = received
+        self.assertEqual(async_received['rows'], 3)
+        self.assertEqual(async_received['bytes'], sync_received['bytes'])
+        self.assertTrue(async_received['completed'])
+        self.assertIsNotNone(async_received['timings']['first_row'])
+
+
+class AsyncRenderToCSVResponseTests(CSVTestCase):
+
+    @skipIf(DJANGO_VERSION < (4, 2),
+            'asynchronous streaming responses require Django 4.2+')
+    def test_arender_to_csv_response(self):
+        response = async_to_sync(djqscsv_async.arender_to_csv_response)(
+            self.qs, filename='test_csv', use_verbose_names=False)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=test_csv.csv;')
+        self.assertMatchesCsv(
+            b''.join(collect(response.streaming_content)).splitlines(),
+            self.FULL_PERSON_CSV_NO_VERBOSE)
+
+    @skipIf(DJANGO_VERSION < (4, 2),
+            'asynchronous streaming responses require Django 4.2+')
+    def test_arender_to_csv_response_compressed(self):
+        response = async_to_sync(djqscsv_async.arender_to_csv_response)(
+            self.qs, compression='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        collect(response.streaming_content)
+
+    @skipIf(DJANGO_VERSION >= (4, 2),
+            'asynchronous streaming responses require Django 4.2+')
+    def test_arender_to_csv_response_old_django(self):
+        with self.assertRaises(djqscsv.CSVException):
+            async_to_sync(djqscsv_async.arender_to_csv_response)(self.qs)
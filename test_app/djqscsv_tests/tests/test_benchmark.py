@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from django.core.management import call_command
+from django.test import TestCase
+from six import StringIO
+
+from djqscsv_tests.models import Activity, Person
+
+
+class BenchmarkCommandTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'results.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_benchmark(self, **options):
+        call_command('benchmark', rows=25, activities=3, repeat=1,
+                     output=self.output, stderr=StringIO(), **options)
+        with open(self.output) as output:
+            return json.load(output)
+
+    def test_generates_data(self):
+        self.run_benchmark(memory=False)
+        self.assertEqual(Person.objects.count(), 25)
+        self.assertEqual(Activity.objects.count(), 3)
+
+    def test_reuses_data(self):
+        self.run_benchmark(memory=False)
+        first_pk = Person.objects.order_by('pk').values_list('pk')[0]
+        self.run_benchmark(memory=False)
+        self.assertEqual(
+            Person.objects.order_by('pk').values_list('pk')[0], first_pk)
+
+    def test_reports_every_case(self):
+        report = self.run_benchmark()
+        self.assertEqual(report['rows'], 25)
+        self.assertEqual(len(report['results']), 12)
+        self.assertEqual(
+            set((result['mode'], result['serializers'],
+                 result['verbose_names'])
+                for result in report['results']),
+            set((mode, serializers, verbose_names)
+                for mode in ('write_csv', 'streaming', 'non_streaming')
+                for serializers in (False, True)
+                for verbose_names in (False, True)))
+
+        for result in report['results']:
+            self.assertEqual(result['rows'], 25)
+            self.assertGreater(result['bytes'], 0)
+            self.assertGreater(result['rows_per_second'], 0)
+            self.assertLessEqual(result['time_to_first_byte'],
+                                 result['seconds'])
+            if tracemalloc is not None:
+                self.assertGreater(result['peak_memory'], 0)
+
+
+class CSQLBenchmarkCommandTests(TestCase):
+
+    def test_reports_every_case(self):
+        output = StringIO()
+        call_command('benchmark_csql', rows=10, columns=[3, 8], repeat=1,
+                     stdout=output, stderr=StringIO())
+        report = json.loads(output.getvalue())
+
+        self.assertEqual(report['rows'], 10)
+        self.assertEqual(
+            sorted((result['case'], result['columns'])
+                   for result in report['results']),
+            sorted((case, columns)
+                   for case in ('identity', 'renamed', 'mixed', 'exclude')
+                   for columns in (3, 8)))
+        for result in report['results']:
+            for implementation in ('compiled', 'interpreted'):
+                self.assertGreater(
+                    result[implementation]['rows_per_second'], 0)
+            self.assertGreater(result['speedup'], 0)
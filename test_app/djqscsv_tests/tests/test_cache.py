@@ -0,0 +1,192 @@
+import datetime
+import functools
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+from io import BytesIO
+
+from djqscsv_tests.context import djqscsv, cache
+
+from djqscsv_tests.models import Activity
+
+from djqscsv_tests.tests.test_csv_creation import CSVTestCase
+
+
+class ExportCacheTests(CSVTestCase):
+
+    def setUp(self):
+        super(ExportCacheTests, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache = cache.ExportCache(directory)
+        # the cache's signal receivers are weak references, which go away
+        # with the cache
+        self.addCleanup(delattr, self, 'cache')
+
+    def write_csv(self, qs, **kwargs):
+        obj = BytesIO()
+        djqscsv.write_csv(qs, obj, cache=self.cache, **kwargs)
+        return obj.getvalue()
+
+    def cached_entries(self):
+        return [name for name in os.listdir(self.cache.directory)
+                if name.endswith('.csv')]
+
+    def test_write_csv_cached(self):
+        content = self.write_csv(self.qs)
+        self.assertMatchesCsv(content.splitlines(), self.FULL_PERSON_CSV)
+        self.assertEqual(len(self.cached_entries()), 1)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.write_csv(self.qs), content)
+
+    def test_write_csv_cached_compressed(self):
+        content = self.write_csv(self.qs)
+        with self.assertNumQueries(0):
+            compressed = self.write_csv(self.qs, compression='deflate')
+        self.assertEqual(len(self.cached_entries()), 1)
+        self.assertEqual(zlib.decompress(compressed), content)
+
+    def test_options_change_key(self):
+        self.write_csv(self.qs)
+        self.write_csv(self.qs, field_header_map={'name': 'Name'})
+        self.write_csv(self.qs.filter(name='ged'))
+        self.write_csv(self.qs, field_serializer_map={'id': lambda x: x})
+        self.write_csv(self.qs, field_serializer_map={'id': lambda y: y})
+        self.assertEqual(len(self.cached_entries()), 5)
+
+        with self.assertNumQueries(0):
+            self.write_csv(self.qs, field_header_map={'name': 'Name'},
+                           iterator_chunk_size=1)
+
+    def test_closures_change_key(self):
+        def strftime(format):
+            return lambda value: value.strftime(format)
+
+        year = self.write_csv(self.qs, field_serializer_map={
+            'born': strftime('%Y')})
+        day = self.write_csv(self.qs, field_serializer_map={
+            'born': strftime('%d/%m')})
+        self.assertIn(b',2001\r\n', year)
+        self.assertIn(b',01/01\r\n', day)
+
+        self.write_csv(self.qs, field_serializer_map={
+            'born': functools.partial(datetime.date.strftime, format='%Y')})
+        self.write_csv(self.qs, field_serializer_map={
+            'born': functools.partial(datetime.date.strftime, format='%m')})
+        self.assertEqual(len(self.cached_entries()), 4)
+
+        # the same closure is found again
+        with self.assertNumQueries(0):
+            self.assertEqual(self.write_csv(self.qs, field_serializer_map={
+                'born': strftime('%Y')}), year)
+
+    def test_save_invalidates(self):
+        self.write_csv(self.qs)
+        person = self.qs.get(name='ged')
+        person.address = 'atuan'
+        person.save()
+
+        content = self.write_csv(self.qs)
+        self.assertIn(b'atuan', content)
+
+    def test_save_before_export_invalidates(self):
+        self.write_csv(self.qs.values('name'))
+        # another process, which saves without having exported anything
+        directory = self.cache.directory
+        del self.cache
+        self.cache = cache.ExportCache(directory)
+        person = self.qs.get(name='ged')
+        person.name = 'sparrowhawk'
+        person.save()
+
+        content = self.write_csv(self.qs.values('name'))
+        self.assertIn(b'sparrowhawk', content)
+
+    def test_watched_models(self):
+        self.cache = cache.ExportCache(self.cache.directory,
+                                       models=[Activity])
+        self.write_csv(self.qs.values('name', 'hobby__name'))
+        activity = Activity.objects.get(name='Resting')
+        activity.name = 'Sleeping'
+        activity.save()
+        self.assertIn(b'Sleeping',
+                      self.write_csv(self.qs.values('name', 'hobby__name')))
+
+        person = self.qs.get(name='ged')
+        person.name = 'sparrowhawk'
+        person.save()
+        # saves of models that aren't watched don't invalidate anything
+        self.assertNotIn(b'sparrowhawk',
+                         self.write_csv(self.qs.values('name', 'hobby__name')))
+
+    def test_related_save_invalidates(self):
+        qs = self.qs.values('name', 'hobby__name')
+        self.write_csv(qs)
+        Activity.objects.filter(name='Resting').get().delete()
+
+        content = self.write_csv(qs)
+        self.assertNotIn(b'Resting', content)
+
+    def test_forward_related_field_save_invalidates(self):
+        qs = self.qs.values('name')
+        self.write_csv(qs, related_fields=['hobby__name'])
+        activity = Activity.objects.get(name='Resting')
+        activity.name = 'Sleeping'
+        activity.save()
+
+        content = self.write_csv(qs, related_fields=['hobby__name'])
+        self.assertIn(b'Sleeping', content)
+        self.assertNotIn(b'Resting', content)
+
+    def test_many_related_field_save_invalidates(self):
+        qs = Activity.objects.order_by('name')
+        self.write_csv(qs, related_fields=['person__name'])
+        person = self.qs.get(name='ged')
+        person.name = 'sparrowhawk'
+        person.save()
+
+        content = self.write_csv(qs, related_fields=['person__name'])
+        self.assertIn(b'sparrowhawk', content)
+
+    def test_eviction(self):
+        self.cache.max_size = len(self.write_csv(self.qs)) + 1
+        entry_path = os.path.join(self.cache.directory,
+                                  self.cached_entries()[0])
+        last_used = time.time() - 60
+        os.utime(entry_path, (last_used, last_used))
+
+        self.write_csv(self.qs.values('name'))
+        self.assertEqual(len(self.cached_entries()), 1)
+        with self.assertNumQueries(0):
+            self.write_csv(self.qs.values('name'))
+
+    def test_streaming_cached(self):
+        response = djqscsv.render_to_csv_response(self.qs, cache=self.cache)
+        content = b''.join(response.streaming_content)
+
+        with self.assertNumQueries(0):
+            response = djqscsv.render_to_csv_response(self.qs,
+                                                      cache=self.cache)
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_streaming_partial_not_cached(self):
+        response = djqscsv.render_to_csv_response(self.qs, cache=self.cache,
+                                                  buffer_size=None)
+        next(iter(response.streaming_content))
+        response.close()
+        self.assertEqual(self.cached_entries(), [])
+        self.assertEqual(
+            [name for name in os.listdir(self.cache.directory)
+             if name.endswith('.tmp')], [])
+
+    def test_non_streaming_cached(self):
+        self.write_csv(self.qs)
+        with self.assertNumQueries(0):
+            response = djqscsv.render_to_csv_response(
+                self.qs, cache=self.cache, streaming=False)
+        self.assertMatchesCsv(response.content.splitlines(),
+                              self.FULL_PERSON_CSV)
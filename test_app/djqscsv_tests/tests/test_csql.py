@@ -0,0 +1,254 @@
+import types
+
+from django.test import TestCase
+
+from djqscsv_tests.context import (SELECT, EXCLUDE, AS, CONSTANT, WHERE,
+                                   ORDER_BY, GROUP_BY, COUNT, SUM, MIN, MAX,
+                                   csql)
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+DATASET = [['id', 'name', 'address'],
+           ['1', 'vetch', 'iffish'],
+           ['2', 'nemmerle', 'roke'],
+           ['3', 'ged', 'gont']]
+
+
+class StreamingSelectTests(TestCase):
+
+    def stream(self, consumed):
+        # a one-shot iterator over the dataset that records how far it
+        # has been read
+        for row in DATASET:
+            consumed.append(row)
+            yield row
+
+    def test_select_returns_generator(self):
+        self.assertIsInstance(SELECT(DATASET, 'name'), types.GeneratorType)
+        self.assertIsInstance(EXCLUDE(DATASET, 'name'),
+                              types.GeneratorType)
+
+    def test_select_is_lazy(self):
+        consumed = []
+        selected = SELECT(self.stream(consumed), AS('name', 'Name'))
+        # only the header is read up front
+        self.assertEqual(len(consumed), 1)
+        self.assertEqual(next(selected), ['Name'])
+        self.assertEqual(next(selected), ['vetch'])
+        self.assertEqual(len(consumed), 2)
+        self.assertEqual(list(selected), [['nemmerle'], ['ged']])
+
+    def test_exclude_is_lazy(self):
+        consumed = []
+        excluded = EXCLUDE(self.stream(consumed), 'address', 0)
+        self.assertEqual(len(consumed), 1)
+        self.assertEqual(list(excluded),
+                         [['name'], ['vetch'], ['nemmerle'], ['ged']])
+
+    def test_chained(self):
+        selected = SELECT(EXCLUDE(iter(DATASET), 'id'),
+                          AS('address', 'Address'),
+                          CONSTANT('x', 'constant'))
+        self.assertEqual(list(selected),
+                         [['Address', 'constant'],
+                          ['iffish', 'x'], ['roke', 'x'], ['gont', 'x']])
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            SELECT(iter(DATASET), 'missing')
+
+    def test_empty_dataset(self):
+        with self.assertRaises(ValueError):
+            SELECT(iter([]), 'name')
+
+
+PEOPLE = [['name', 'hobby', 'age'],
+          ['vetch', 'magic', '40'],
+          ['nemmerle', 'resting', '300'],
+          ['ged', 'resting', '60'],
+          ['ogion', 'magic', ''],
+          ['tenar', 'weaving', '35']]
+
+
+class WhereTests(TestCase):
+
+    def test_where(self):
+        self.assertEqual(
+            list(WHERE(iter(PEOPLE), 'hobby',
+                       lambda hobby: hobby == 'magic')),
+            [PEOPLE[0], PEOPLE[1], PEOPLE[4]])
+
+    def test_where_transformer(self):
+        self.assertEqual(
+            list(WHERE(PEOPLE, ('age', 'age', lambda age: int(age or 0)),
+                       lambda age: age > 50)),
+            [PEOPLE[0], PEOPLE[2], PEOPLE[3]])
+
+    def test_where_chained(self):
+        selected = SELECT(WHERE(iter(PEOPLE), 'hobby',
+                                lambda hobby: hobby == 'resting'),
+                          AS('name', 'Name'))
+        self.assertEqual(list(selected), [['Name'], ['nemmerle'], ['ged']])
+
+
+class OrderByTests(TestCase):
+
+    def names(self, rows):
+        return [row[0] for row in rows]
+
+    def test_order_by(self):
+        ordered = list(ORDER_BY(iter(PEOPLE), 'name'))
+        self.assertEqual(ordered[0], PEOPLE[0])
+        self.assertEqual(self.names(ordered[1:]),
+                         ['ged', 'nemmerle', 'ogion', 'tenar', 'vetch'])
+
+    def test_order_by_descending(self):
+        ordered = list(ORDER_BY(PEOPLE, '-name'))
+        self.assertEqual(self.names(ordered[1:]),
+                         ['vetch', 'tenar', 'ogion', 'nemmerle', 'ged'])
+
+    def test_order_by_mixed_directions(self):
+        ordered = list(ORDER_BY(PEOPLE, 'hobby', '-name'))
+        self.assertEqual(self.names(ordered[1:]),
+                         ['vetch', 'ogion', 'nemmerle', 'ged', 'tenar'])
+
+    def test_order_by_transformer(self):
+        by_age = ('-age', 'age', lambda age: int(age or 0))
+        ordered = list(ORDER_BY(PEOPLE, by_age))
+        self.assertEqual(self.names(ordered[1:]),
+                         ['nemmerle', 'ged', 'vetch', 'tenar', 'ogion'])
+
+    def test_order_by_stable(self):
+        ordered = list(ORDER_BY(PEOPLE, 'hobby'))
+        self.assertEqual(self.names(ordered[1:]),
+                         ['vetch', 'ogion', 'nemmerle', 'ged', 'tenar'])
+
+    def test_order_by_spills(self):
+        rows = [['number', 'position']] + [
+            [str(number % 7), str(position)]
+            for position, number in enumerate(range(100, 0, -1))]
+        expected = [rows[0]] + sorted(rows[1:],
+                                      key=lambda row: int(row[0]))
+
+        spill = csql._spill
+        with mock.patch.object(csql, '_spill',
+                               side_effect=spill) as spilled:
+            for direction in ('', '-'):
+                ordered = list(ORDER_BY(
+                    iter(rows), (direction + 'number', 'number', int),
+                    buffer_rows=8))
+                if direction:
+                    expected = [rows[0]] + sorted(
+                        rows[1:], key=lambda row: -int(row[0]))
+                self.assertEqual(ordered, expected)
+        self.assertEqual(spilled.call_count, 26)
+
+    def test_order_by_fits_in_memory(self):
+        with mock.patch.object(csql, '_spill') as spilled:
+            list(ORDER_BY(PEOPLE, 'name', buffer_rows=len(PEOPLE)))
+        self.assertFalse(spilled.called)
+
+    def test_order_by_invalid_buffer(self):
+        with self.assertRaises(ValueError):
+            ORDER_BY(PEOPLE, 'name', buffer_rows=0)
+        with self.assertRaises(TypeError):
+            ORDER_BY(PEOPLE, 'name', buffer=10)
+
+
+class GroupByTests(TestCase):
+
+    def test_group_by(self):
+        grouped = GROUP_BY(iter(PEOPLE), 'hobby', COUNT(), SUM('age'),
+                           MIN('name', 'first'), MAX('name', 'last'))
+        self.assertEqual(list(grouped),
+                         [['hobby', 'count', 'age', 'first', 'last'],
+                          ['magic', 2, 40, 'ogion', 'vetch'],
+                          ['resting', 2, 360, 'ged', 'nemmerle'],
+                          ['weaving', 1, 35, 'tenar', 'tenar']])
+
+    def test_group_by_column_order(self):
+        grouped = GROUP_BY(PEOPLE, COUNT('people'), AS('hobby', 'Hobby'))
+        self.assertEqual(list(grouped),
+                         [['people', 'Hobby'], [2, 'magic'],
+                          [2, 'resting'], [1, 'weaving']])
+
+    def test_group_by_skips_empty_values(self):
+        grouped = GROUP_BY(WHERE(PEOPLE, 'name',
+                                 lambda name: name == 'ogion'),
+                           'hobby', SUM('age'), MAX('age', 'oldest', int))
+        self.assertEqual(list(grouped),
+                         [['hobby', 'age', 'oldest'], ['magic', None, None]])
+
+    def test_group_by_transformer(self):
+        grouped = GROUP_BY(PEOPLE, ('age', 'has age', bool), COUNT(),
+                           MAX('age', 'oldest', int))
+        self.assertEqual(list(grouped),
+                         [['has age', 'count', 'oldest'],
+                          [True, 4, 300], [False, 1, None]])
+
+    def test_group_by_without_keys(self):
+        grouped = GROUP_BY(PEOPLE, COUNT(), SUM('age', 'total', float))
+        self.assertEqual(list(grouped), [['count', 'total'], [5, 435.0]])
+
+    def test_group_by_empty_dataset(self):
+        self.assertEqual(list(GROUP_BY([['age']], COUNT(), MAX('age'))),
+                         [['count', 'age'], [0, None]])
+        self.assertEqual(list(GROUP_BY([['age']], 'age', COUNT())),
+                         [['age', 'count']])
+
+    def test_min_max_numbers(self):
+        dataset = [['v', 'name'], ['9', 'a'], ['10', 'b'], ['2.5', 'c']]
+        self.assertEqual(list(GROUP_BY(dataset, MIN('v'), MAX('v'),
+                                       MAX('name'))),
+                         [['v', 'v', 'name'], [2.5, 10, 'c']])
+
+    def test_min_max_numbers_and_text(self):
+        # a column with a text cell is compared as text in every group
+        dataset = [['g', 'v'], ['a', '10'], ['a', '9'], ['b', '10'],
+                   ['b', 'abc'], ['c', 7]]
+        self.assertEqual(list(GROUP_BY(dataset, 'g', MIN('v'), MAX('v'))),
+                         [['g', 'v', 'v'], ['a', '10', '9'],
+                          ['b', '10', 'abc'], ['c', 7, 7]])
+        self.assertEqual(list(GROUP_BY(dataset[:3], MIN('v'), MAX('v'))),
+                         [['v', 'v'], [9, 10]])
+
+    def test_group_then_order(self):
+        grouped = ORDER_BY(GROUP_BY(PEOPLE, 'hobby', COUNT()),
+                           '-count', 'hobby')
+        self.assertEqual(list(grouped),
+                         [['hobby', 'count'], ['magic', 2],
+                          ['resting', 2], ['weaving', 1]])
+
+
+class CompiledProjectionTests(TestCase):
+
+    def test_only_transformers_are_called(self):
+        transformer = mock.Mock(side_effect=lambda value: value.upper())
+        with mock.patch.object(csql, '_identity') as identity:
+            selected = list(SELECT(DATASET, ('name', 'Name', transformer),
+                                   'id', AS('address', 'Address')))
+        self.assertEqual(selected,
+                         [['Name', 'id', 'Address'],
+                          ['VETCH', '1', 'iffish'],
+                          ['NEMMERLE', '2', 'roke'],
+                          ['GED', '3', 'gont']])
+        self.assertEqual(transformer.call_count, 3)
+        self.assertFalse(identity.called)
+
+    def test_repeated_columns(self):
+        selected = list(SELECT(DATASET, 'id', CONSTANT('x', 'constant'),
+                               AS('id', 'again'), 'id'))
+        self.assertEqual(selected[0], ['id', 'constant', 'again', 'id'])
+        self.assertEqual(selected[1:],
+                         [[row[0], 'x', row[0], row[0]]
+                          for row in DATASET[1:]])
+
+    def test_wide_projection(self):
+        header = ['column_%d' % index for index in range(1000)]
+        datarow = list(range(1000))
+        selected = list(SELECT([header, datarow], *reversed(header)))
+        self.assertEqual(selected[1], datarow[::-1])
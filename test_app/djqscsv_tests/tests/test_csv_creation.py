@@ -1,16 +1,37 @@
+import datetime
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import zipfile
+
+from unittest import skipIf
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
 from django.db.models import Count
-from django.test import TestCase
+from django.http import FileResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase
 
 from django import VERSION as DJANGO_VERSION
 
 import unicodecsv as csv
+import zlib
 from io import BytesIO
 
-from djqscsv_tests.context import djqscsv
+from djqscsv_tests.context import djqscsv, cache
 
 from djqscsv_tests.context import SELECT, EXCLUDE, AS, CONSTANT
 
-from djqscsv_tests.util import create_people_and_get_queryset
+from djqscsv_tests.models import Activity, Person
+from djqscsv_tests.util import (create_people_and_get_queryset,
+                                skipUnlessThreadsShareDatabase)
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 try:
     from six.moves import zip_longest
@@ -21,7 +42,7 @@ except ImportError:
         from itertools import zip_longest
 
 
-class CSVTestCase(TestCase):
+class CSVTestMixin(object):
 
     def setUp(self):
         self.qs = create_people_and_get_queryset()
@@ -74,7 +95,7 @@ class CSVTestCase(TestCase):
     # use this data structure to build smaller data sets
     BASE_CSV = [
         ['id', 'name', 'address',
-         'info', 'hobby_id', 'born', 'hobby__name', 'Most Powerful'],
+         'info', 'hobby_id', 'born', 'hobby__name', 'Most_Powerful'],
         ['1', 'vetch', 'iffish',
          'wizard', '1', '2001-01-01T01:01:00', 'Doing Magic', '0'],
         ['2', 'nemmerle', 'roke',
@@ -82,27 +103,32 @@ class CSVTestCase(TestCase):
         ['3', 'ged', 'gont',
          'former arch mage', '2', '2001-01-01T01:01:00', 'Resting', '1']]
 
-    FULL_PERSON_CSV_WITH_RELATED = SELECT(BASE_CSV,
-                                          AS('id', 'ID'),
-                                          AS('name', 'Person\'s name'),
-                                          'address',
-                                          AS('info', 'Info on Person'),
-                                          'hobby_id',
-                                          'born',
-                                          'hobby__name')
+    FULL_PERSON_CSV_WITH_RELATED = list(SELECT(BASE_CSV,
+                                               AS('id', 'ID'),
+                                               AS('name', 'Person\'s name'),
+                                               'address',
+                                               AS('info', 'Info on Person'),
+                                               'hobby_id',
+                                               'born',
+                                               'hobby__name'))
+
+    FULL_PERSON_CSV = list(EXCLUDE(FULL_PERSON_CSV_WITH_RELATED,
+                                   'hobby__name'))
+
+    FULL_PERSON_CSV_NO_VERBOSE = list(EXCLUDE(BASE_CSV,
+                                              'hobby__name',
+                                              'Most_Powerful'))
 
-    FULL_PERSON_CSV = EXCLUDE(FULL_PERSON_CSV_WITH_RELATED,
-                              'hobby__name')
+    LIMITED_PERSON_CSV = list(SELECT(FULL_PERSON_CSV,
+                                     'Person\'s name', 'address',
+                                     'Info on Person'))
 
-    FULL_PERSON_CSV_NO_VERBOSE = EXCLUDE(BASE_CSV,
-                                         'hobby__name',
-                                         'Most Powerful')
+    LIMITED_PERSON_CSV_NO_VERBOSE = list(SELECT(BASE_CSV,
+                                                'name', 'address', 'info'))
 
-    LIMITED_PERSON_CSV = SELECT(FULL_PERSON_CSV,
-                                'Person\'s name', 'address', 'Info on Person')
 
-    LIMITED_PERSON_CSV_NO_VERBOSE = SELECT(BASE_CSV,
-                                           'name', 'address', 'info')
+class CSVTestCase(CSVTestMixin, TestCase):
+    pass
 
 
 class WriteCSVDataNoVerboseNamesTests(CSVTestCase):
@@ -194,11 +220,11 @@ class ColumnOrderingTests(CSVTestCase):
         self.qs = create_people_and_get_queryset()
 
     def test_custom_column_order(self):
-        ordered_csv = SELECT(self.BASE_CSV,
-                             'hobby_id',
-                             'info',
-                             'name',
-                             'address')
+        ordered_csv = list(SELECT(self.BASE_CSV,
+                                  'hobby_id',
+                                  'info',
+                                  'name',
+                                  'address'))
 
         with self.assertRaises(AssertionError):
             self.assertQuerySetBecomesCsv(self.qs, ordered_csv)
@@ -242,7 +268,7 @@ class ExtraOrderingTests(CSVTestCase):
 
     def setUp(self):
         self.qs = create_people_and_get_queryset().extra(
-            select={'Most Powerful': "info LIKE '%arch mage%'"})
+            select={'Most_Powerful': "info LIKE '%arch mage%'"})
 
     def test_extra_select(self):
         csv_with_extra = SELECT(self.BASE_CSV,
@@ -252,14 +278,14 @@ class ExtraOrderingTests(CSVTestCase):
                                 AS('info', 'Info on Person'),
                                 'hobby_id',
                                 'born',
-                                'Most Powerful')
+                                'Most_Powerful')
 
         self.assertQuerySetBecomesCsv(self.qs, csv_with_extra)
 
     def test_extra_select_ordering(self):
         custom_order_csv = SELECT(self.BASE_CSV,
                                   AS('id', 'ID'),
-                                  'Most Powerful',
+                                  'Most_Powerful',
                                   AS('name', "Person's name"),
                                   'address',
                                   AS('info', 'Info on Person'),
@@ -267,7 +293,7 @@ class ExtraOrderingTests(CSVTestCase):
                                   'born')
 
         self.assertQuerySetBecomesCsv(self.qs, custom_order_csv,
-                                      field_order=['id', 'Most Powerful'])
+                                      field_order=['id', 'Most_Powerful'])
 
     def test_extra_select_header_map(self):
         csv_with_extra = SELECT(self.BASE_CSV,
@@ -277,11 +303,11 @@ class ExtraOrderingTests(CSVTestCase):
                                 AS('info', 'Info on Person'),
                                 'hobby_id',
                                 'born',
-                                AS('Most Powerful', 'Sturdiest'))
+                                AS('Most_Powerful', 'Sturdiest'))
 
         self.assertQuerySetBecomesCsv(
             self.qs, csv_with_extra,
-            field_header_map={'Most Powerful': 'Sturdiest'})
+            field_header_map={'Most_Powerful': 'Sturdiest'})
 
 
 class RenderToCSVResponseTests(CSVTestCase):
@@ -326,6 +352,61 @@ class RenderToCSVResponseTests(CSVTestCase):
         self.assertMatchesCsv(response.content.splitlines(),
                               self.FULL_PERSON_CSV_NO_VERBOSE)
 
+    def get_spooled_response(self, **kwargs):
+        response = djqscsv.render_to_csv_response(self.qs, streaming=False,
+                                                  use_verbose_names=False,
+                                                  **kwargs)
+        self.addCleanup(response.close)
+        return response
+
+    def test_render_to_csv_response_spooled(self):
+        response = self.get_spooled_response(spool_max_size=1024 * 1024)
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertRegexpMatches(response['Content-Disposition'],
+                                 r'attachment; filename=person_export.csv;')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertMatchesCsv(content.splitlines(),
+                              self.FULL_PERSON_CSV_NO_VERBOSE)
+
+    def test_render_to_csv_response_spooled_to_disk(self):
+        response = self.get_spooled_response(spool_max_size=16)
+        file_obj = response.file_to_stream
+        self.assertTrue(file_obj._rolled)
+        # a real file, which the server can send with sendfile
+        self.assertIsInstance(file_obj.fileno(), int)
+        content = b''.join(response.streaming_content)
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertMatchesCsv(content.splitlines(),
+                              self.FULL_PERSON_CSV_NO_VERBOSE)
+
+    def test_render_to_csv_response_spooled_gzip(self):
+        response = self.get_spooled_response(spool_max_size=16,
+                                             compression='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertMatchesCsv(
+            zlib.decompress(content, 16 + zlib.MAX_WBITS).splitlines(),
+            self.FULL_PERSON_CSV_NO_VERBOSE)
+
+    def test_render_to_csv_response_spooled_from_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        export_cache = cache.ExportCache(directory)
+
+        first = self.get_spooled_response(spool_max_size=16,
+                                          cache=export_cache)
+        content = b''.join(first.streaming_content)
+        with self.assertNumQueries(0):
+            second = self.get_spooled_response(spool_max_size=16,
+                                               cache=export_cache)
+        # the cached file itself is sent
+        self.assertTrue(second.file_to_stream.name.startswith(directory))
+        self.assertEqual(second['Content-Length'], str(len(content)))
+        self.assertEqual(b''.join(second.streaming_content), content)
+
     def test_render_to_csv_response_other_delimiter(self):
         response = djqscsv.render_to_csv_response(self.qs,
                                                   filename="test_csv",
@@ -348,3 +429,968 @@ class RenderToCSVResponseTests(CSVTestCase):
         self.assertNotMatchesCsv(
             b''.join(response.streaming_content).splitlines(),
             self.FULL_PERSON_CSV_NO_VERBOSE)
+
+    def test_render_to_csv_response_buffered(self):
+        response = djqscsv.render_to_csv_response(self.qs,
+                                                  filename="test_csv",
+                                                  use_verbose_names=False)
+        content = list(response.streaming_content)
+        # the BOM and the header, and then the rows
+        self.assertEqual(len(content), 2)
+        self.assertMatchesCsv(b''.join(content).splitlines(),
+                              self.FULL_PERSON_CSV_NO_VERBOSE)
+
+    def test_render_to_csv_response_header_first(self):
+        response = djqscsv.render_to_csv_response(self.qs,
+                                                  filename="test_csv",
+                                                  use_verbose_names=False)
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs, obj, use_verbose_names=False)
+        header = obj.getvalue().split(b'\r\n')[0] + b'\r\n'
+        content = iter(response.streaming_content)
+        # the header is sent before the query runs
+        with self.assertNumQueries(0):
+            self.assertEqual(next(content), header)
+        self.assertEqual(len(list(content)), 1)
+
+    def test_render_to_csv_response_buffered_no_header(self):
+        response = djqscsv.render_to_csv_response(self.qs,
+                                                  filename="test_csv",
+                                                  write_header=False)
+        self.assertEqual(len(list(response.streaming_content)), 1)
+
+    def test_render_to_csv_response_unbuffered(self):
+        response = djqscsv.render_to_csv_response(self.qs,
+                                                  filename="test_csv",
+                                                  use_verbose_names=False,
+                                                  buffer_size=None)
+        content = list(response.streaming_content)
+        # one chunk each for the BOM, the header and the three rows
+        self.assertEqual(len(content), 5)
+        self.assertMatchesCsv(b''.join(content).splitlines(),
+                              self.FULL_PERSON_CSV_NO_VERBOSE)
+
+
+class IteratorTests(CSVTestCase):
+
+    def setUp(self):
+        self.qs = create_people_and_get_queryset().values()
+
+    def test_iterator_does_not_fill_result_cache(self):
+        self.assertQuerySetBecomesCsv(self.qs,
+                                      self.FULL_PERSON_CSV_NO_VERBOSE,
+                                      use_verbose_names=False)
+        self.assertIsNone(self.qs._result_cache)
+
+    def test_iterator_small_chunk_size(self):
+        self.assertQuerySetBecomesCsv(self.qs,
+                                      self.FULL_PERSON_CSV_NO_VERBOSE,
+                                      use_verbose_names=False,
+                                      iterator_chunk_size=1)
+
+    def test_no_iterator_fills_result_cache(self):
+        self.assertQuerySetBecomesCsv(self.qs,
+                                      self.FULL_PERSON_CSV_NO_VERBOSE,
+                                      use_verbose_names=False,
+                                      use_iterator=False)
+        self.assertEqual(len(self.qs._result_cache), 3)
+
+
+class KeysetPaginationTests(CSVTestCase):
+
+    def test_keyset_pages(self):
+        for page_size in (1, 2, 3, 4):
+            self.assertQuerySetBecomesCsv(self.qs,
+                                          self.FULL_PERSON_CSV_NO_VERBOSE,
+                                          use_verbose_names=False,
+                                          keyset_page_size=page_size)
+
+    def test_keyset_query_per_page(self):
+        with self.assertNumQueries(2):
+            djqscsv.write_csv(self.qs, BytesIO(), keyset_page_size=2)
+
+    def test_keyset_without_key_column(self):
+        qs = self.qs.values('name', 'address', 'info')
+        self.assertQuerySetBecomesCsv(qs, self.LIMITED_PERSON_CSV,
+                                      keyset_page_size=1)
+
+    def test_keyset_descending(self):
+        descending_csv = ([self.FULL_PERSON_CSV_NO_VERBOSE[0]] +
+                          self.FULL_PERSON_CSV_NO_VERBOSE[:0:-1])
+        self.assertQuerySetBecomesCsv(self.qs, descending_csv,
+                                      use_verbose_names=False,
+                                      keyset_page_size=2,
+                                      keyset_field='-pk')
+
+    def test_keyset_custom_field(self):
+        by_name_csv = list(SELECT(self.BASE_CSV, 'name', 'address'))
+        by_name_csv = [by_name_csv[0]] + sorted(by_name_csv[1:])
+        qs = self.qs.values('name', 'address')
+        self.assertQuerySetBecomesCsv(qs, by_name_csv,
+                                      use_verbose_names=False,
+                                      keyset_page_size=2,
+                                      keyset_field='name')
+
+    def test_keyset_non_unique_field(self):
+        # nemmerle and ged share a hobby, and are told apart by their pk
+        qs = self.qs.values('name', 'hobby_id')
+        for page_size in (1, 2):
+            output = BytesIO()
+            djqscsv.write_csv(qs, output, keyset_page_size=page_size,
+                              keyset_field='hobby_id')
+            self.assertEqual(output.getvalue().splitlines()[1:],
+                             [b'vetch,1', b'nemmerle,2', b'ged,2'])
+
+    def test_keyset_several_fields(self):
+        qs = self.qs.values('name')
+        for keyset_field, expected in (
+                (('-hobby', 'name'), [b'ged', b'nemmerle', b'vetch']),
+                (('hobby__name', '-pk'), [b'vetch', b'ged', b'nemmerle']),
+                (['-hobby_id', '-name', 'pk'],
+                 [b'nemmerle', b'ged', b'vetch'])):
+            output = BytesIO()
+            djqscsv.write_csv(qs, output, keyset_page_size=1,
+                              keyset_field=keyset_field)
+            self.assertEqual(output.getvalue().splitlines()[1:], expected)
+
+    def test_keyset_nullable_field(self):
+        born = Person._meta.get_field('born')
+        with mock.patch.object(born, 'null', True), \
+                self.assertRaises(djqscsv.CSVException):
+            djqscsv.write_csv(self.qs, BytesIO(), keyset_page_size=2,
+                              keyset_field='born')
+
+        name = Activity._meta.get_field('name')
+        with mock.patch.object(name, 'null', True), \
+                self.assertRaises(djqscsv.CSVException):
+            djqscsv.write_csv(self.qs, BytesIO(), keyset_page_size=2,
+                              keyset_field=('hobby__name', 'pk'))
+
+    def test_keyset_refused_queryset(self):
+        for qs in (self.qs.values('hobby_id').annotate(n=Count('id')),
+                   self.qs.values('hobby_id').distinct(),
+                   self.qs.order_by('pk')[:2]):
+            with self.assertRaises(djqscsv.CSVException):
+                djqscsv.write_csv(qs, BytesIO(), keyset_page_size=10)
+
+    def test_keyset_with_field_order(self):
+        ordered_csv = SELECT(self.FULL_PERSON_CSV_NO_VERBOSE,
+                             'info', 'id', 'name', 'address', 'hobby_id',
+                             'born')
+        self.assertQuerySetBecomesCsv(self.qs, ordered_csv,
+                                      use_verbose_names=False,
+                                      keyset_page_size=2,
+                                      field_order=['info'])
+
+
+class WriteHeaderTests(CSVTestCase):
+
+    def test_no_header(self):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs.values('name'), obj, write_header=False)
+        self.assertEqual(obj.getvalue(), b'vetch\r\nnemmerle\r\nged\r\n')
+
+
+class ParallelExportTests(CSVTestMixin, TransactionTestCase):
+    # the workers read the rows with connections of their own, so they
+    # have to be committed. the primary keys keep growing between the
+    # tests, so outputs are compared with those of serial exports
+
+    def write(self, qs=None, **kwargs):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs if qs is None else qs, obj, **kwargs)
+        return obj.getvalue()
+
+    def assertParallelMatches(self, qs=None, processes=2, **kwargs):
+        expected = self.write(qs, **kwargs)
+        with mock.patch.object(djqscsv, '_write_csv_parallel',
+                               wraps=djqscsv._write_csv_parallel) as parallel:
+            self.assertEqual(self.write(qs, processes=processes, **kwargs),
+                             expected)
+        self.assertTrue(parallel.called)
+
+    def test_parallel(self):
+        self.assertParallelMatches()
+
+    def test_parallel_limited(self):
+        self.assertParallelMatches(self.qs.values('name', 'address', 'info'),
+                                   processes=3)
+
+    def test_parallel_filtered(self):
+        self.assertParallelMatches(self.qs.filter(name='ged'))
+
+    def test_parallel_empty_queryset(self):
+        self.assertEqual(
+            self.write(self.qs.none(), use_verbose_names=False, processes=2),
+            b'\xef\xbb\xbfid,name,address,info,hobby_id,born\r\n')
+
+    def test_parallel_progress_ignored(self):
+        reports = []
+        self.assertEqual(self.write(processes=2, progress=reports.append,
+                                    progress_total='exact'), self.write())
+        self.assertEqual(reports, [])
+
+    def test_parallel_in_transaction(self):
+        with transaction.atomic(), \
+                mock.patch.object(djqscsv, '_write_csv_parallel') as parallel:
+            self.qs.filter(name='vetch').update(address='roke')
+            output = self.write(self.qs.values('address').order_by('name'),
+                                processes=2)
+            # the connection is still usable
+            self.assertEqual(self.qs.count(), 3)
+        self.assertFalse(parallel.called)
+        self.assertEqual(output.splitlines()[1:],
+                         [b'gont', b'roke', b'roke'])
+
+    def test_parallel_serial_querysets(self):
+        # each primary key range would be grouped, made distinct or
+        # sliced on its own
+        for qs in (self.qs.values('hobby_id').annotate(n=Count('id')),
+                   self.qs.values('hobby_id').distinct(),
+                   self.qs.order_by('name')[1:]):
+            expected = self.write(qs)
+            with mock.patch.object(djqscsv,
+                                   '_write_csv_parallel') as parallel:
+                self.assertEqual(self.write(qs, processes=2), expected)
+            self.assertFalse(parallel.called)
+
+    def test_pickled_queryset(self):
+        qs = self.qs.extra(select={'motto': "'true names'"}).values(
+            'name').filter(name='ged').using('default')
+        restored = djqscsv._unpickle_queryset(
+            pickle.loads(pickle.dumps(djqscsv._pickle_queryset(qs))))
+        self.assertEqual(list(restored), [{'name': 'ged'}])
+        self.assertEqual(restored.db, 'default')
+
+        restored = djqscsv._unpickle_queryset(pickle.loads(pickle.dumps(
+            djqscsv._pickle_queryset(self.qs.filter(name='ged')))))
+        self.assertEqual(restored.get().name, 'ged')
+
+
+class CompressionTests(CSVTestCase):
+
+    GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+    def setUp(self):
+        super(CompressionTests, self).setUp()
+        self.uncompressed = BytesIO()
+        djqscsv.write_csv(self.qs, self.uncompressed)
+
+    def test_write_csv_gzip(self):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs, obj, compression='gzip')
+        self.assertEqual(zlib.decompress(obj.getvalue(), self.GZIP_WBITS),
+                         self.uncompressed.getvalue())
+
+    def test_write_csv_deflate(self):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs, obj, compression='deflate')
+        self.assertEqual(zlib.decompress(obj.getvalue()),
+                         self.uncompressed.getvalue())
+
+    def test_write_csv_parallel_gzip(self):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs, obj, compression='gzip', processes=2)
+        self.assertEqual(zlib.decompress(obj.getvalue(), self.GZIP_WBITS),
+                         self.uncompressed.getvalue())
+
+    def test_unsupported_compression(self):
+        with self.assertRaises(djqscsv.CSVException):
+            djqscsv.write_csv(self.qs, BytesIO(), compression='bz2')
+        with self.assertRaises(djqscsv.CSVException):
+            djqscsv.render_to_csv_response(self.qs, compression='bz2')
+
+    def test_render_to_csv_response_gzip(self):
+        response = djqscsv.render_to_csv_response(self.qs,
+                                                  compression='gzip',
+                                                  buffer_size=None)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertRegexpMatches(response['Content-Disposition'],
+                                 r'attachment; filename=person_export.csv;')
+
+        # every chunk can be decompressed as soon as it arrives
+        decompressor = zlib.decompressobj(self.GZIP_WBITS)
+        chunks = [decompressor.decompress(chunk)
+                  for chunk in response.streaming_content]
+        self.assertEqual(chunks[0], b'\xef\xbb\xbf')
+        self.assertEqual(b''.join(chunks), self.uncompressed.getvalue())
+
+    def test_render_to_csv_response_non_streaming_deflate(self):
+        response = djqscsv.render_to_csv_response(self.qs,
+                                                  compression='deflate',
+                                                  streaming=False)
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(response.content),
+                         self.uncompressed.getvalue())
+
+    def test_render_to_csv_response_gzip_file(self):
+        response = djqscsv.render_to_csv_response(self.qs,
+                                                  compression='gzip',
+                                                  content_encoding=False)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertFalse(response.has_header('Vary'))
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertRegexpMatches(
+            response['Content-Disposition'],
+            r'attachment; filename=person_export.csv.gz;')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(zlib.decompress(content, self.GZIP_WBITS),
+                         self.uncompressed.getvalue())
+
+    def test_render_to_csv_response_deflate_file(self):
+        with self.assertRaises(djqscsv.CSVException):
+            djqscsv.render_to_csv_response(self.qs, compression='deflate',
+                                           content_encoding=False)
+
+
+# a database driver whose cursors have copy_expert, like psycopg2
+PSYCOPG2 = mock.Mock()
+
+
+class CopyTests(CSVTestCase):
+
+    COPY_OUTPUT = (b'1,vetch,iffish,wizard,1,2001-01-01 01:01:00+00\n'
+                   b'2,nemmerle,roke,deceased arch mage,2,'
+                   b'2001-01-01 01:01:00+00\n')
+
+    def setUp(self):
+        super(CopyTests, self).setUp()
+        self.cursor = mock.MagicMock()
+        self.cursor.__enter__.return_value = self.cursor
+        self.cursor.mogrify.return_value = b'SELECT 1'
+        self.cursor.copy_expert.side_effect = (
+            lambda sql, output: output.write(self.COPY_OUTPUT))
+
+    def write_with_copy(self, qs, **kwargs):
+        obj = BytesIO()
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(connection, 'Database', PSYCOPG2), \
+                mock.patch.object(connection, 'cursor',
+                                  return_value=self.cursor):
+            djqscsv.write_csv(qs, obj, use_copy=True, **kwargs)
+        return obj.getvalue()
+
+    def assertFallsBack(self, qs, expected_data, database=PSYCOPG2,
+                        **kwargs):
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(connection, 'Database', database), \
+                mock.patch.object(djqscsv, '_iter_copy') as iter_copy:
+            self.assertQuerySetBecomesCsv(qs, expected_data,
+                                          use_copy=True, **kwargs)
+        self.assertFalse(iter_copy.called)
+
+    def test_copy(self):
+        output = self.write_with_copy(self.qs, use_verbose_names=False)
+        self.assertEqual(output,
+                         b'\xef\xbb\xbfid,name,address,info,hobby_id,born\n' +
+                         self.COPY_OUTPUT)
+        copy_sql = self.cursor.copy_expert.call_args[0][0]
+        self.assertEqual(
+            copy_sql,
+            'COPY (SELECT "djqscsv_0", "djqscsv_1", "djqscsv_2", '
+            '"djqscsv_3", "djqscsv_4", "djqscsv_5" FROM (SELECT 1) '
+            'AS djqscsv_export ("djqscsv_0", "djqscsv_1", "djqscsv_2", '
+            '"djqscsv_3", "djqscsv_4", "djqscsv_5")) '
+            'TO STDOUT WITH (FORMAT csv, DELIMITER \',\')')
+
+    def test_copy_column_order(self):
+        qs = self.qs.extra(select={'Most_Powerful': '1'}).values(
+            'name', 'hobby__name', 'Most_Powerful')
+        self.write_with_copy(qs, delimiter='|',
+                             field_order=['hobby__name'])
+        copy_sql = self.cursor.copy_expert.call_args[0][0]
+        # the extra column comes first in the SQL
+        self.assertTrue(copy_sql.startswith(
+            'COPY (SELECT "djqscsv_2", "djqscsv_1", "djqscsv_0" FROM'))
+        self.assertTrue(copy_sql.endswith("DELIMITER '|')"))
+
+    def test_copy_empty_queryset(self):
+        output = self.write_with_copy(self.qs.none(),
+                                      use_verbose_names=False)
+        self.assertEqual(
+            output, b'\xef\xbb\xbfid,name,address,info,hobby_id,born\n')
+        self.assertFalse(self.cursor.copy_expert.called)
+
+    def test_copy_falls_back_with_serializers(self):
+        csv_with_year = SELECT(self.FULL_PERSON_CSV_NO_VERBOSE,
+                               'id', 'name', 'address', 'info', 'hobby_id',
+                               ('born', 'born', lambda born: born[:4]))
+        self.assertFallsBack(self.qs, csv_with_year,
+                             use_verbose_names=False,
+                             field_serializer_map={'born': lambda d: d.year})
+
+    def test_copy_falls_back_with_csv_options(self):
+        self.assertFallsBack(self.qs, self.FULL_PERSON_CSV_NO_VERBOSE,
+                             use_verbose_names=False, quotechar="'")
+
+    def test_copy_falls_back_with_csv_writer(self):
+        self.assertFallsBack(self.qs, self.FULL_PERSON_CSV_NO_VERBOSE,
+                             use_verbose_names=False, csv_writer=csv.writer)
+
+    def test_copy_falls_back_without_copy_expert(self):
+        # psycopg 3, which Django 4.2 supports, has no copy_expert
+        psycopg = mock.Mock(spec=['connect', 'cursor'])
+        self.assertFallsBack(self.qs, self.FULL_PERSON_CSV_NO_VERBOSE,
+                             database=psycopg, use_verbose_names=False)
+
+    def test_copy_falls_back_on_other_backends(self):
+        self.assertQuerySetBecomesCsv(self.qs,
+                                      self.FULL_PERSON_CSV_NO_VERBOSE,
+                                      use_verbose_names=False,
+                                      use_copy=True)
+
+    def test_copy_progress(self):
+        reports = []
+        output = self.write_with_copy(self.qs, progress=reports.append)
+        self.assertEqual(reports[-1]['rows'], None)
+        self.assertEqual(reports[-1]['bytes'], len(output))
+        self.assertIsNone(reports[-1]['rows_per_second'])
+
+    def test_copy_error(self):
+        self.cursor.copy_expert.side_effect = ValueError('broken')
+        with self.assertRaises(ValueError):
+            self.write_with_copy(self.qs)
+
+
+@skipUnlessThreadsShareDatabase
+class PrefetchTests(CSVTestMixin, TransactionTestCase):
+    # the rows are fetched in another thread, with another connection, so
+    # they have to be committed. the primary keys keep growing between the
+    # tests, so outputs are compared with those of serial exports
+
+    def setUp(self):
+        super(PrefetchTests, self).setUp()
+        self.fetch_threads = []
+        original = djqscsv._CSVExport._fetch_records
+
+        def fetch_records(export):
+            self.fetch_threads.append(threading.current_thread())
+            return original(export)
+
+        patcher = mock.patch.object(djqscsv._CSVExport, '_fetch_records',
+                                    autospec=True, side_effect=fetch_records)
+        self.fetch_records = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, qs=None, **kwargs):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs if qs is None else qs, obj, **kwargs)
+        return obj.getvalue()
+
+    def assertPrefetchMatches(self, qs=None, **kwargs):
+        expected = self.write(qs, **kwargs)
+        self.fetch_threads = []
+        self.assertEqual(self.write(qs, **dict(kwargs, prefetch=2)),
+                         expected)
+        self.assertEqual(len(self.fetch_threads), 1)
+        self.assertIsNot(self.fetch_threads[0], threading.current_thread())
+
+    def test_prefetch(self):
+        self.assertPrefetchMatches()
+        self.assertEqual(len(self.write().splitlines()), 4)
+
+    def test_prefetch_small_chunks(self):
+        self.assertPrefetchMatches(iterator_chunk_size=1)
+
+    def test_prefetch_keyset_related(self):
+        self.assertPrefetchMatches(self.qs.values('id', 'name'),
+                                   keyset_page_size=2,
+                                   related_fields=['hobby__name'])
+
+    def test_no_prefetch(self):
+        self.write()
+        self.assertEqual(self.fetch_threads, [threading.current_thread()])
+
+    def test_prefetch_in_transaction(self):
+        with transaction.atomic():
+            self.write(prefetch=2)
+        self.assertEqual(self.fetch_threads, [threading.current_thread()])
+
+    def test_prefetch_error(self):
+        self.fetch_records.side_effect = ValueError('broken')
+        with self.assertRaises(ValueError):
+            self.write(prefetch=2)
+
+    def test_prefetch_cancelled(self):
+        threads = threading.active_count()
+        response = djqscsv.render_to_csv_response(
+            self.qs, prefetch=1, iterator_chunk_size=1, buffer_size=None)
+        content = iter(response.streaming_content)
+        # the BOM, the header and the first row
+        for _ in range(3):
+            next(content)
+        self.assertEqual(threading.active_count(), threads + 1)
+        response.close()
+        self.assertEqual(threading.active_count(), threads)
+
+
+class ProgressTests(CSVTestCase):
+
+    def setUp(self):
+        super(ProgressTests, self).setUp()
+        self.reports = []
+
+    def write(self, qs=None, **kwargs):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs if qs is None else qs, obj,
+                          progress=self.reports.append, **kwargs)
+        return obj.getvalue()
+
+    def expected_output(self):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs, obj)
+        return obj.getvalue()
+
+    def test_final_report(self):
+        output = self.write()
+        self.assertEqual(len(self.reports), 1)
+        report = self.reports[0]
+        self.assertEqual(report['rows'], 3)
+        self.assertEqual(report['bytes'], len(output))
+        self.assertIsNone(report['total'])
+        self.assertEqual(report['eta'], 0.0)
+        self.assertTrue(report['finished'])
+        self.assertGreater(report['rows_per_second'], 0)
+
+    def test_same_output(self):
+        self.assertEqual(self.write(), self.expected_output())
+
+    def test_throttled(self):
+        with mock.patch.object(djqscsv, 'PROGRESS_CHECK_ROWS', 1):
+            self.write(progress_interval=60)
+        self.assertEqual(len(self.reports), 1)
+
+    def test_every_row(self):
+        with mock.patch.object(djqscsv, 'PROGRESS_CHECK_ROWS', 1):
+            self.write(progress_interval=0, progress_total='exact')
+        self.assertEqual([report['rows'] for report in self.reports],
+                         [1, 2, 3, 3])
+        self.assertEqual([report['finished'] for report in self.reports],
+                         [False, False, False, True])
+        self.assertEqual(self.reports[-2]['eta'], 0)
+        self.assertTrue(all(report['total'] == 3
+                            for report in self.reports))
+        self.assertLess(self.reports[0]['bytes'], self.reports[1]['bytes'])
+
+    def test_exact_total(self):
+        with self.assertNumQueries(2):
+            self.write(self.qs.filter(name='ged'), progress_total='exact')
+        self.assertEqual(self.reports[0]['total'], 1)
+
+    def test_estimated_total(self):
+        cursor = mock.MagicMock()
+        cursor.__enter__.return_value = cursor
+        cursor.fetchone.return_value = ['[{"Plan": {"Plan Rows": 1000}}]']
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(connection, 'cursor',
+                                  return_value=cursor):
+            self.assertEqual(djqscsv._estimate_count(self.qs), 1000)
+        self.assertTrue(
+            cursor.execute.call_args[0][0].startswith(
+                'EXPLAIN (FORMAT JSON) SELECT'))
+
+    def test_estimated_total_on_other_backends(self):
+        self.write(progress_total='estimate')
+        self.assertIsNone(self.reports[0]['total'])
+
+    def test_estimated_total_of_empty_queryset(self):
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            self.assertEqual(djqscsv._estimate_count(self.qs.none()), 0)
+
+    def test_invalid_total(self):
+        with self.assertRaises(djqscsv.CSVException):
+            self.write(progress_total='guess')
+
+    def test_streaming_response(self):
+        response = djqscsv.render_to_csv_response(
+            self.qs, progress=self.reports.append)
+        content = b''.join(response.streaming_content)
+        self.assertEqual(self.reports[-1]['rows'], 3)
+        self.assertEqual(self.reports[-1]['bytes'], len(content))
+
+    def test_compressed_bytes(self):
+        # the bytes are counted before they are compressed
+        output = self.write(compression='gzip')
+        self.assertEqual(self.reports[-1]['bytes'],
+                         len(zlib.decompress(output, 16 + zlib.MAX_WBITS)))
+
+
+class RelatedFieldsTests(CSVTestCase):
+
+    def setUp(self):
+        super(RelatedFieldsTests, self).setUp()
+        self.activities = Activity.objects.order_by('pk')
+
+    def test_forward_related_field(self):
+        csv_data = list(SELECT(self.BASE_CSV,
+                               AS('id', 'ID'),
+                               AS('name', 'Person\'s name'),
+                               'address',
+                               AS('info', 'Info on Person'),
+                               'hobby_id',
+                               'born',
+                               AS('hobby__name', 'Hobby')))
+        self.assertQuerySetBecomesCsv(self.qs, csv_data,
+                                      related_fields=['hobby__name'],
+                                      field_header_map={
+                                          'hobby__name': 'Hobby'})
+
+    def test_forward_related_field_is_joined(self):
+        with self.assertNumQueries(1):
+            djqscsv.write_csv(self.qs.values('name'), BytesIO(),
+                              related_fields=['hobby__name'])
+
+    def test_forward_related_field_already_selected(self):
+        qs = self.qs.values('name', 'hobby__name')
+        self.assertQuerySetBecomesCsv(
+            qs, list(SELECT(self.BASE_CSV, 'name', 'hobby__name')),
+            use_verbose_names=False, related_fields=['hobby__name'])
+
+    def test_to_many_related_field(self):
+        self.assertQuerySetBecomesCsv(
+            self.activities, [['ID', 'Name of Activity', 'person__name'],
+                              ['1', 'Doing Magic', 'vetch'],
+                              ['2', 'Resting', 'ged, nemmerle']],
+            related_fields=['person__name'])
+
+    def test_to_many_related_field_queries(self):
+        Activity.objects.create(name='Sleeping')
+        with self.assertNumQueries(2):
+            djqscsv.write_csv(self.activities, BytesIO(),
+                              related_fields=['person__name'])
+        # one query for the rows and one for each batch of two rows
+        with mock.patch.object(djqscsv, 'RELATED_BATCH_SIZE', 2), \
+                self.assertNumQueries(3):
+            djqscsv.write_csv(self.activities, BytesIO(),
+                              related_fields=['person__name'])
+
+    def test_to_many_related_without_pk(self):
+        Activity.objects.create(name='Sleeping')
+        self.assertQuerySetBecomesCsv(
+            self.activities.values('name'),
+            [['Name of Activity', 'people'],
+             ['Doing Magic', 'vetch'],
+             ['Resting', 'ged|nemmerle'],
+             ['Sleeping', '']],
+            related_fields=['person__name'], related_delimiter='|',
+            field_header_map={'person__name': 'people'})
+
+    def test_to_many_related_serializer(self):
+        self.assertQuerySetBecomesCsv(
+            self.activities.values('name'),
+            [['name', 'person__name'],
+             ['Doing Magic', 'VETCH'],
+             ['Resting', 'GED, NEMMERLE']],
+            related_fields=['person__name'], use_verbose_names=False,
+            field_serializer_map={'person__name': lambda name: name.upper()})
+
+    def test_to_many_related_field_order(self):
+        self.assertQuerySetBecomesCsv(
+            self.activities.values('name'),
+            [['person__name', 'name'],
+             ['vetch', 'Doing Magic'],
+             ['ged, nemmerle', 'Resting']],
+            related_fields=['person__name'], use_verbose_names=False,
+            field_order=['person__name'])
+
+    def test_to_many_related_with_keyset_pagination(self):
+        self.assertQuerySetBecomesCsv(
+            self.activities.values('name'),
+            [['name', 'person__name'],
+             ['Doing Magic', 'vetch'],
+             ['Resting', 'ged, nemmerle']],
+            related_fields=['person__name'], use_verbose_names=False,
+            keyset_page_size=1)
+
+    def test_unknown_related_field(self):
+        with self.assertRaises(djqscsv.CSVException):
+            djqscsv.write_csv(self.qs, BytesIO(),
+                              related_fields=['hobby__missing'])
+
+
+class CSVWriterTests(CSVTestCase):
+
+    def write(self, qs=None, **kwargs):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs if qs is None else qs, obj, **kwargs)
+        return obj.getvalue()
+
+    def test_same_output_as_unicodecsv(self):
+        qs = self.qs.extra(select={'motto': u"'caf\xe9, \"mage\"'"})
+        for kwargs in ({}, {'delimiter': '|'}, {'quotechar': "'"},
+                       {'lineterminator': '\n'}, {'encoding': 'latin-1'},
+                       {'quoting': csv.QUOTE_ALL}):
+            self.assertEqual(self.write(qs, **kwargs),
+                             self.write(qs, csv_writer=csv.writer, **kwargs))
+
+    def test_text_writer_encoding(self):
+        qs = self.qs.extra(select={'motto': u"'caf\xe9'"})
+        output = self.write(qs, encoding='latin-1', use_verbose_names=False,
+                            csv_writer=djqscsv.text_csv_writer)
+        self.assertEqual(output.splitlines()[1].split(b',')[-1], b'caf\xe9')
+
+    def test_text_writer_encoding_errors(self):
+        qs = self.qs.extra(select={'motto': u"'caf\xe9'"})
+        with self.assertRaises(UnicodeEncodeError):
+            self.write(qs, encoding='ascii',
+                       csv_writer=djqscsv.text_csv_writer)
+        output = self.write(qs, encoding='ascii', errors='replace',
+                            csv_writer=djqscsv.text_csv_writer)
+        self.assertIn(b'caf?', output)
+
+    def test_custom_writer(self):
+        rows = []
+
+        class ListWriter(object):
+            def writerow(self, row):
+                rows.append(row)
+
+        def list_writer(file_obj, **csv_kwargs):
+            self.assertEqual(csv_kwargs, {'encoding': 'utf-8',
+                                          'delimiter': '|'})
+            return ListWriter()
+
+        self.write(self.qs.values('name'), csv_writer=list_writer,
+                   delimiter='|')
+        self.assertEqual(rows, [["Person's name"], ['vetch'], ['nemmerle'],
+                                ['ged']])
+
+
+class ConditionalResponseTests(CSVTestCase):
+
+    def setUp(self):
+        super(ConditionalResponseTests, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache = cache.ExportCache(directory)
+        # the cache's signal receivers are weak references, which go away
+        # with the cache
+        self.addCleanup(delattr, self, 'cache')
+        self.factory = RequestFactory()
+
+    def render(self, qs=None, headers=None, **kwargs):
+        request = self.factory.get('/', **(headers or {}))
+        kwargs.setdefault('etag_version', 1)
+        return djqscsv.render_to_csv_response(
+            self.qs if qs is None else qs, request=request, **kwargs)
+
+    def get_content(self, response):
+        if response.streaming:
+            return b''.join(response.streaming_content)
+        return response.content
+
+    def full_content(self):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs.order_by('pk'), obj)
+        return obj.getvalue()
+
+    def test_etag(self):
+        etag = self.render()['ETag']
+        self.assertRegexpMatches(etag, r'^"[0-9a-f]{40}"$')
+        self.assertEqual(self.render()['ETag'], etag)
+        self.assertEqual(self.render(qs=self.qs.order_by('pk'))['ETag'],
+                         etag)
+        self.assertNotEqual(self.render(etag_version=2)['ETag'], etag)
+        self.assertNotEqual(self.render(use_verbose_names=False)['ETag'],
+                            etag)
+        self.assertNotEqual(self.render(compression='gzip')['ETag'], etag)
+        self.assertNotIn('Accept-Ranges', self.render())
+
+    def test_etag_sliced(self):
+        etag = self.render(qs=self.qs.order_by('name')[:2])['ETag']
+        self.assertNotEqual(self.render(qs=self.qs.order_by('name')[:1])[
+            'ETag'], etag)
+        with self.assertRaises(djqscsv.CSVException):
+            self.render(qs=self.qs.all()[:2])
+
+    def test_etag_closures(self):
+        def strftime(format):
+            return lambda value: value.strftime(format)
+
+        etag = self.render(field_serializer_map={
+            'born': strftime('%Y')})['ETag']
+        self.assertNotEqual(self.render(field_serializer_map={
+            'born': strftime('%d/%m')})['ETag'], etag)
+
+    def test_no_etag(self):
+        response = djqscsv.render_to_csv_response(self.qs)
+        self.assertNotIn('ETag', response)
+
+    def test_etag_field(self):
+        etag = self.render(etag_version=None, etag_field='born')['ETag']
+        self.assertEqual(
+            self.render(etag_version=None, etag_field='born')['ETag'], etag)
+
+        person = self.qs.get(name='ged')
+        person.born = datetime.datetime(2002, 2, 2)
+        person.save()
+        changed = self.render(etag_version=None, etag_field='born')['ETag']
+        self.assertNotEqual(changed, etag)
+
+        self.qs.filter(name='vetch').delete()
+        self.assertNotEqual(
+            self.render(etag_version=None, etag_field='born')['ETag'],
+            changed)
+
+    def test_if_none_match(self):
+        etag = self.render()['ETag']
+        for header in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+            with self.assertNumQueries(0):
+                response = self.render(
+                    headers={'HTTP_IF_NONE_MATCH': header})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+
+        response = self.render(headers={'HTTP_IF_NONE_MATCH': '"other"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_content(response), self.full_content())
+
+    def test_if_none_match_compressed(self):
+        etag = self.render(compression='gzip')['ETag']
+        response = self.render(compression='gzip',
+                               headers={'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+    def test_range(self):
+        content = self.full_content()
+        size = len(content)
+        for header, first, last in (('bytes=5-10', 5, 10),
+                                    ('bytes=10-', 10, size - 1),
+                                    ('bytes=-7', size - 7, size - 1),
+                                    ('bytes=0-100000', 0, size - 1)):
+            response = self.render(headers={'HTTP_RANGE': header},
+                                   cache=self.cache)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'],
+                             'bytes %d-%d/%d' % (first, last, size))
+            self.assertEqual(response['Content-Length'],
+                             str(last - first + 1))
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            self.assertEqual(self.get_content(response),
+                             content[first:last + 1])
+
+    def test_range_served_from_cache(self):
+        self.render(headers={'HTTP_RANGE': 'bytes=0-1'}, cache=self.cache)
+        key = self.cache.get_key(self.qs.order_by('pk'), {})
+        self.assertIsNotNone(self.cache.open(key))
+
+        response = self.render(headers={'HTTP_RANGE': 'bytes=2-3'},
+                               cache=self.cache)
+        with self.assertNumQueries(0):
+            content = self.get_content(response)
+        self.assertEqual(content, self.full_content()[2:4])
+
+    def test_unsatisfiable_range(self):
+        size = len(self.full_content())
+        response = self.render(headers={'HTTP_RANGE': 'bytes=%d-' % size},
+                               cache=self.cache)
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % size)
+
+    def test_full_response_instead_of_range(self):
+        etag = self.render()['ETag']
+        for headers, kwargs in (
+                ({'HTTP_RANGE': 'bytes=5-10'}, {}),
+                ({'HTTP_RANGE': 'bytes=0-1, 5-10'}, {'cache': self.cache}),
+                ({'HTTP_RANGE': 'lines=1-2'}, {'cache': self.cache}),
+                ({'HTTP_RANGE': 'bytes=5-10', 'HTTP_IF_RANGE': '"other"'},
+                 {'cache': self.cache}),
+                ({'HTTP_RANGE': 'bytes=5-10'},
+                 {'cache': self.cache, 'compression': 'gzip',
+                  'content_encoding': False})):
+            response = self.render(headers=headers, **kwargs)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('Content-Range', response)
+
+        response = self.render(headers={'HTTP_RANGE': 'bytes=5-10',
+                                        'HTTP_IF_RANGE': etag},
+                               cache=self.cache)
+        self.assertEqual(response.status_code, 206)
+
+
+@skipIf(sys.version_info < (3, 6),
+        'streaming ZIP archives require Python 3.6 or later')
+class ZipResponseTests(CSVTestCase):
+
+    def get_archive(self, response):
+        content = b''.join(response.streaming_content)
+        return zipfile.ZipFile(BytesIO(content))
+
+    def get_csv(self, queryset, **kwargs):
+        obj = BytesIO()
+        djqscsv.write_csv(queryset, obj, **kwargs)
+        return obj.getvalue()
+
+    def test_render_to_zip_response(self):
+        activities = Activity.objects.all()
+        response = djqscsv.render_to_zip_response(
+            {'people.csv': self.qs, 'hobbies': activities},
+            filename='report.zip')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=report.zip;')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+        archive = self.get_archive(response)
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(sorted(archive.namelist()),
+                         ['hobbies.csv', 'people.csv'])
+        self.assertEqual(archive.read('people.csv'), self.get_csv(self.qs))
+        self.assertEqual(archive.read('hobbies.csv'),
+                         self.get_csv(activities))
+        for info in archive.infolist():
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_default_filenames(self):
+        response = djqscsv.render_to_zip_response(
+            [self.qs, ('people_2', self.qs.values('name'))])
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=export.zip;')
+        archive = self.get_archive(response)
+        self.assertEqual(archive.namelist(),
+                         ['person_export.csv', 'people_2.csv'])
+        self.assertEqual(archive.read('people_2.csv'),
+                         self.get_csv(self.qs.values('name')))
+
+    def test_export_options(self):
+        response = djqscsv.render_to_zip_response(
+            [self.qs], use_verbose_names=False, delimiter='|')
+        self.assertEqual(
+            self.get_archive(response).read('person_export.csv'),
+            self.get_csv(self.qs, use_verbose_names=False, delimiter='|'))
+
+    def test_append_datestamp(self):
+        response = djqscsv.render_to_zip_response([self.qs],
+                                                  filename='report',
+                                                  append_datestamp=True)
+        self.assertRegexpMatches(response['Content-Disposition'],
+                                 r'filename=report_[0-9]{8}\.zip;$')
+
+    def test_invalid_filenames(self):
+        with self.assertRaises(ValidationError):
+            djqscsv.render_to_zip_response([self.qs], filename='report.csv')
+        with self.assertRaises(ValidationError):
+            djqscsv.render_to_zip_response({'people.txt': self.qs})
+
+    def test_duplicate_filenames(self):
+        with self.assertRaises(djqscsv.CSVException):
+            djqscsv.render_to_zip_response([self.qs, self.qs.all()])
+
+    def test_streams_each_file(self):
+        response = djqscsv.render_to_zip_response(
+            [self.qs, Activity.objects.all()])
+        with mock.patch.object(djqscsv, '_iter_csv',
+                               side_effect=djqscsv._iter_csv) as iter_csv:
+            content = iter(response.streaming_content)
+            first_chunk = next(content)
+            # the archive starts before the second file is exported
+            self.assertTrue(first_chunk.startswith(b'PK\x03\x04'))
+            self.assertEqual(iter_csv.call_count, 1)
+            rest = b''.join(content)
+        self.assertEqual(iter_csv.call_count, 2)
+        archive = zipfile.ZipFile(BytesIO(first_chunk + rest))
+        self.assertIsNone(archive.testzip())
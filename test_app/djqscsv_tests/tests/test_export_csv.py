@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+import zlib
+
+from io import BytesIO
+
+from django.core.management import CommandError, call_command
+from django.test import TransactionTestCase
+
+from six import StringIO
+
+from djqscsv_tests.context import djqscsv
+
+from djqscsv.management.commands import export_csv
+
+from djqscsv_tests.models import Activity
+
+from djqscsv_tests.tests.test_csv_creation import CSVTestCase
+
+from djqscsv_tests.util import (create_people_and_get_queryset,
+                                skipUnlessThreadsShareDatabase)
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class ExportCommandTestMixin(object):
+
+    def setUp(self):
+        super(ExportCommandTestMixin, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def export(self, *args, **options):
+        stdout = StringIO()
+        call_command('export_csv', *args, stdout=stdout, stderr=StringIO(),
+                     **options)
+        return stdout.getvalue()
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as csv_file:
+            return csv_file.read()
+
+    def expected_csv(self, qs, **kwargs):
+        obj = BytesIO()
+        djqscsv.write_csv(qs, obj, **kwargs)
+        return obj.getvalue()
+
+
+class ExportCommandTests(ExportCommandTestMixin, CSVTestCase):
+
+    def test_export_to_file(self):
+        path = os.path.join(self.directory, 'people.csv')
+        output = self.export('djqscsv_tests.Person', output=path)
+        self.assertEqual(output,
+                         'Exported 3 rows of djqscsv_tests.Person to %s\n' %
+                         path)
+        self.assertEqual(self.read('people.csv'), self.expected_csv(self.qs))
+        self.assertEqual(os.listdir(self.directory), ['people.csv'])
+
+    def test_export_to_directory(self):
+        self.export('djqscsv_tests.person', output=self.directory)
+        self.assertEqual(self.read('djqscsv_tests_person.csv'),
+                         self.expected_csv(self.qs))
+
+    def test_several_models(self):
+        output = os.path.join(self.directory, 'exports')
+        self.export('djqscsv_tests.Person', 'djqscsv_tests.Activity',
+                    output=output)
+        self.assertEqual(sorted(os.listdir(output)),
+                         ['djqscsv_tests_activity.csv',
+                          'djqscsv_tests_person.csv'])
+        self.assertEqual(self.read('exports/djqscsv_tests_activity.csv'),
+                         self.expected_csv(Activity.objects.all()))
+
+    def test_filters(self):
+        self.export('djqscsv_tests.Person', output=self.directory,
+                    filter=['hobby__name=Resting'], exclude=['name=ged'],
+                    fields=['name', 'hobby__name'], order_by=['-name'],
+                    no_verbose_names=True, delimiter=';')
+        self.assertEqual(self.read('djqscsv_tests_person.csv'),
+                         b'\xef\xbb\xbfname;hobby__name\r\n'
+                         b'nemmerle;Resting\r\n')
+
+    def test_in_and_isnull_filters(self):
+        self.export('djqscsv_tests.Person', output=self.directory,
+                    filter=['name__in=ged,vetch', 'hobby__isnull=false'],
+                    fields=['name'], order_by=['name'], no_header=True)
+        self.assertEqual(self.read('djqscsv_tests_person.csv'),
+                         b'ged\r\nvetch\r\n')
+
+    def test_compression(self):
+        self.export('djqscsv_tests.Person', output=self.directory,
+                    compression='gzip')
+        content = self.read('djqscsv_tests_person.csv.gz')
+        self.assertEqual(zlib.decompress(content, 16 + zlib.MAX_WBITS),
+                         self.expected_csv(self.qs))
+
+    def test_chunked(self):
+        for options in ({'chunk_size': 1}, {'keyset_page_size': 1}):
+            self.export('djqscsv_tests.Person', output=self.directory,
+                        **options)
+            self.assertEqual(self.read('djqscsv_tests_person.csv'),
+                             self.expected_csv(self.qs))
+
+    def test_unknown_model(self):
+        for label in ('djqscsv_tests.Missing', 'Person'):
+            with self.assertRaises(CommandError):
+                self.export(label, output=self.directory)
+
+    def test_invalid_filter(self):
+        for lookup in ('name', '=ged', 'missing=1'):
+            with self.assertRaises(CommandError):
+                self.export('djqscsv_tests.Person', output=self.directory,
+                            filter=[lookup])
+
+    def test_invalid_fields(self):
+        with self.assertRaises(CommandError):
+            self.export('djqscsv_tests.Person', output=self.directory,
+                        fields=['missing'])
+
+    def test_model_exported_twice(self):
+        with self.assertRaises(CommandError):
+            self.export('djqscsv_tests.Person', 'djqscsv_tests.person',
+                        output=self.directory)
+
+    def test_failed_export(self):
+        def write_csv(queryset, file_obj, **kwargs):
+            if queryset.model is Activity:
+                file_obj.write(b'id')
+                raise ValueError('broken')
+            djqscsv.write_csv(queryset, file_obj, **kwargs)
+
+        with mock.patch.object(export_csv, 'write_csv',
+                               side_effect=write_csv), \
+                self.assertRaises(CommandError):
+            self.export('djqscsv_tests.Activity', 'djqscsv_tests.Person',
+                        output=self.directory)
+        # the other exports still run, and the failed one leaves nothing
+        self.assertEqual(os.listdir(self.directory),
+                         ['djqscsv_tests_person.csv'])
+
+
+class ExportCommandWorkerTests(ExportCommandTestMixin, TransactionTestCase):
+
+    @skipUnlessThreadsShareDatabase
+    def test_workers(self):
+        qs = create_people_and_get_queryset()
+        self.export('djqscsv_tests.Person', 'djqscsv_tests.Activity',
+                    output=self.directory, workers=2)
+        self.assertEqual(self.read('djqscsv_tests_person.csv'),
+                         self.expected_csv(qs))
+        self.assertEqual(self.read('djqscsv_tests_activity.csv'),
+                         self.expected_csv(Activity.objects.all()))
@@ -0,0 +1,160 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+from djqscsv_tests.context import djqscsv, incremental
+
+from djqscsv_tests.context import SELECT
+
+from djqscsv_tests.models import Activity, Person
+
+from djqscsv_tests.tests.test_csv_creation import CSVTestCase
+
+
+class IncrementalExportTests(CSVTestCase):
+
+    def setUp(self):
+        super(IncrementalExportTests, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'people.csv')
+        self.state_path = self.path + '.state'
+
+    def export(self, qs=None, **kwargs):
+        return incremental.write_incremental_csv(
+            self.qs if qs is None else qs, self.path, **kwargs)
+
+    def read(self):
+        with open(self.path, 'rb') as csv_file:
+            return csv_file.read()
+
+    def read_state(self):
+        with open(self.state_path) as state_file:
+            return json.load(state_file)
+
+    def add_person(self, name, **kwargs):
+        return Person.objects.create(name=name, address='havnor',
+                                     info='mage', hobby=Activity.objects.
+                                     get(name='Resting'), **kwargs)
+
+    def test_first_export(self):
+        self.assertEqual(self.export(), 3)
+        self.assertMatchesCsv(self.read().splitlines(), self.FULL_PERSON_CSV)
+        self.assertEqual(self.read_state(), {'field': 'pk', 'watermark': 3,
+                                             'size': len(self.read())})
+
+    def test_nothing_changed(self):
+        self.export()
+        content = self.read()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.export(), 3)
+        self.assertEqual(self.read(), content)
+
+    def test_append(self):
+        self.export()
+        content = self.read()
+        person = self.add_person('tenar')
+        self.assertEqual(self.export(), person.pk)
+
+        appended = self.read()[len(content):]
+        self.assertEqual(
+            appended, b'4,tenar,havnor,mage,2,2001-01-01T01:01:00\r\n')
+        self.assertEqual(self.read_state()['watermark'], person.pk)
+
+    def test_empty_queryset(self):
+        self.assertIsNone(self.export(self.qs.none()))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.read_state()['size'], 0)
+        self.assertEqual(self.export(), 3)
+        self.assertMatchesCsv(self.read().splitlines(), self.FULL_PERSON_CSV)
+
+    def test_datetime_watermark(self):
+        born = datetime.datetime(2001, 1, 1, 1, 1, 0, 123456)
+        Person.objects.filter(name='ged').update(born=born)
+        self.assertEqual(self.export(watermark_field='born'), born)
+        self.assertEqual(self.read_state()['watermark'],
+                         '2001-01-01T01:01:00.123456')
+        self.assertEqual(len(self.read().splitlines()), 4)
+
+        later = self.add_person('tenar',
+                                born=born + datetime.timedelta(microseconds=1))
+        self.add_person('arha', born=born)
+        self.assertEqual(self.export(watermark_field='born'), later.born)
+        # rows at the watermark are not exported again
+        self.assertEqual(self.read().splitlines()[-1].split(b',')[1],
+                         b'tenar')
+        self.assertEqual(len(self.read().splitlines()), 5)
+
+    def test_options(self):
+        self.export(self.qs.values('name'), use_verbose_names=False)
+        self.add_person('tenar')
+        self.export(self.qs.values('name'), use_verbose_names=False)
+        self.assertEqual(self.read().splitlines()[1:],
+                         [b'vetch', b'nemmerle', b'ged', b'tenar'])
+
+    def test_moved_away(self):
+        self.export()
+        os.remove(self.path)
+        self.add_person('tenar')
+        self.export()
+        self.assertMatchesCsv(
+            self.read().splitlines(),
+            SELECT([self.FULL_PERSON_CSV[0],
+                    ['4', 'tenar', 'havnor', 'mage', '2',
+                     '2001-01-01T01:01:00']],
+                   *self.FULL_PERSON_CSV[0]))
+
+    def test_failed_export_truncated(self):
+        self.export()
+        content = self.read()
+        # the rows of an export that failed before it stored its watermark
+        with open(self.path, 'ab') as csv_file:
+            csv_file.write(b'4,tenar,havnor')
+        self.add_person('tenar')
+        self.export()
+        self.assertEqual(
+            self.read()[len(content):],
+            b'4,tenar,havnor,mage,2,2001-01-01T01:01:00\r\n')
+
+    def test_failed_first_export_truncated(self):
+        with self.assertRaises(ZeroDivisionError):
+            self.export(field_serializer_map={'name': lambda name: 1 / 0})
+        self.export()
+        self.assertMatchesCsv(self.read().splitlines(), self.FULL_PERSON_CSV)
+
+    def test_smaller_file(self):
+        self.export()
+        with open(self.path, 'wb') as csv_file:
+            csv_file.write(b'id\r\n')
+        self.add_person('tenar')
+        with self.assertRaises(djqscsv.CSVException):
+            self.export()
+        self.assertEqual(self.read(), b'id\r\n')
+
+    def test_file_without_state(self):
+        with open(self.path, 'wb') as csv_file:
+            csv_file.write(b'id\r\n')
+        with self.assertRaises(djqscsv.CSVException):
+            self.export()
+        self.assertEqual(self.read(), b'id\r\n')
+
+    def test_other_watermark_field(self):
+        self.export()
+        with self.assertRaises(djqscsv.CSVException):
+            self.export(watermark_field='born')
+
+    def test_unknown_watermark_field(self):
+        with self.assertRaises(djqscsv.CSVException):
+            self.export(watermark_field='missing')
+
+    def test_write_header(self):
+        with self.assertRaises(djqscsv.CSVException):
+            self.export(write_header=False)
+
+    def test_state_path(self):
+        state_path = os.path.join(os.path.dirname(self.path), 'state.json')
+        self.export(state_path=state_path)
+        self.assertTrue(os.path.exists(state_path))
+        self.assertFalse(os.path.exists(self.state_path))
@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+from io import BytesIO
+
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+
+from djqscsv_tests.context import djqscsv, jobs
+
+from djqscsv_tests.tests.test_csv_creation import CSVTestCase
+
+from djqscsv_tests.util import (create_people_and_get_queryset,
+                                skipUnlessThreadsShareDatabase)
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class JobStoreTestMixin(object):
+
+    def setUp(self):
+        super(JobStoreTestMixin, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def expected_csv(self, qs, **kwargs):
+        obj = BytesIO()
+        djqscsv.write_csv(qs, obj, **kwargs)
+        return obj.getvalue()
+
+
+class ExportJobStoreTests(JobStoreTestMixin, CSVTestCase):
+
+    def setUp(self):
+        super(ExportJobStoreTests, self).setUp()
+        self.store = jobs.ExportJobStore(self.directory, workers=0)
+
+    def test_submit(self):
+        job_id = self.store.submit(self.qs, use_verbose_names=False)
+        status = self.store.status(job_id)
+        self.assertEqual(status['status'], jobs.FINISHED)
+        self.assertEqual(status['rows'], 3)
+        self.assertEqual(status['filename'], 'person_export.csv')
+        self.assertIsNone(status['error'])
+
+        with self.store.open(job_id) as result:
+            self.assertEqual(
+                result.read(),
+                self.expected_csv(self.qs, use_verbose_names=False))
+
+    def test_submit_without_header(self):
+        job_id = self.store.submit(self.qs, write_header=False)
+        self.assertEqual(self.store.status(job_id)['rows'], 3)
+
+    def test_progress(self):
+        reports = []
+        job_id = self.store.submit(self.qs, progress=reports.append,
+                                   progress_total='exact')
+        status = self.store.status(job_id)
+        self.assertEqual(status['total'], 3)
+        self.assertEqual(status['eta'], 0)
+        self.assertTrue(reports[-1]['finished'])
+
+    def test_response(self):
+        job_id = self.store.submit(self.qs, filename='people.csv')
+        response = self.store.response(job_id)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=people.csv;')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.expected_csv(self.qs))
+        response.close()
+
+    def test_compressed_response(self):
+        job_id = self.store.submit(self.qs, compression='gzip')
+        response = self.store.response(job_id)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=person_export.csv.gz;')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(zlib.decompress(content, 16 + zlib.MAX_WBITS),
+                         self.expected_csv(self.qs))
+        response.close()
+
+    def test_failed_job(self):
+        def broken(value):
+            raise ValueError('broken serializer')
+
+        job_id = self.store.submit(
+            self.qs, field_serializer_map={'name': broken})
+        status = self.store.status(job_id)
+        self.assertEqual(status['status'], jobs.FAILED)
+        self.assertEqual(status['error'], 'broken serializer')
+        with self.assertRaises(djqscsv.CSVException):
+            self.store.open(job_id)
+
+    def test_unknown_job(self):
+        with self.assertRaises(djqscsv.CSVException):
+            self.store.status('unknown')
+
+    def test_cleanup(self):
+        old_job_id = self.store.submit(self.qs)
+        status_path = os.path.join(self.directory, old_job_id + '.json')
+        expired = time.time() - self.store.max_age - 1
+        os.utime(status_path, (expired, expired))
+
+        job_id = self.store.submit(self.qs)
+        with self.assertRaises(djqscsv.CSVException):
+            self.store.status(old_job_id)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted([job_id + '.csv', job_id + '.json']))
+
+
+class ExportJobStoreWorkerTests(JobStoreTestMixin, TransactionTestCase):
+
+    @skipUnlessThreadsShareDatabase
+    def test_thread_worker(self):
+        qs = create_people_and_get_queryset()
+        store = jobs.ExportJobStore(self.directory, workers=1)
+        self.addCleanup(store.close)
+
+        job_id = store.submit(qs)
+        self.assertEqual(store.wait(job_id, 10)['status'], jobs.FINISHED)
+        with store.open(job_id) as result:
+            self.assertEqual(result.read(), self.expected_csv(qs))
+
+    def test_process_worker(self):
+        qs = create_people_and_get_queryset()
+        store = jobs.ExportJobStore(self.directory, workers=1,
+                                    processes=True)
+        self.addCleanup(store.close)
+
+        job_id = store.submit(qs)
+        self.assertEqual(store.wait(job_id, 10)['status'], jobs.FINISHED)
+        with store.open(job_id) as result:
+            self.assertEqual(result.read(), self.expected_csv(qs))
+
+    def test_process_pool_closes_connections(self):
+        qs = create_people_and_get_queryset()
+        store = jobs.ExportJobStore(self.directory, workers=1,
+                                    processes=True)
+        closed_before_fork = []
+
+        def make_pool(*args, **kwargs):
+            closed_before_fork.append(close.called)
+            return mock.Mock()
+
+        with mock.patch.object(connection, 'close') as close, \
+                mock.patch.object(jobs, 'Pool', side_effect=make_pool):
+            store.submit(qs)
+        self.assertEqual(closed_before_fork, [True])
+
+        store = jobs.ExportJobStore(self.directory, workers=1,
+                                    processes=True)
+        with transaction.atomic(), self.assertRaises(djqscsv.CSVException):
+            store.submit(qs)
+
+    def test_process_worker_unpicklable(self):
+        qs = create_people_and_get_queryset()
+        store = jobs.ExportJobStore(self.directory, workers=1,
+                                    processes=True)
+        self.addCleanup(store.close)
+
+        with self.assertRaises(djqscsv.CSVException):
+            store.submit(qs, field_serializer_map={'name': lambda n: n})
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,131 @@
+from django.db import connection
+
+from io import BytesIO
+
+from djqscsv_tests.context import djqscsv, signals
+
+from djqscsv_tests.models import Activity, Person
+
+from djqscsv_tests.tests.test_csv_creation import CSVTestCase, PSYCOPG2
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+TIMINGS = {'query', 'fetch', 'serialize', 'write', 'downstream', 'total',
+           'first_row'}
+
+
+class ExportFinishedTests(CSVTestCase):
+
+    def setUp(self):
+        super(ExportFinishedTests, self).setUp()
+        self.received = []
+
+    def receiver(self, sender, **kwargs):
+        self.received.append(dict(kwargs, sender=sender))
+
+    def connect(self, sender=Person):
+        signals.export_finished.connect(self.receiver, sender=sender)
+        self.addCleanup(signals.export_finished.disconnect, self.receiver,
+                        sender=sender)
+
+    def assertTimings(self, timings):
+        self.assertEqual(set(timings), TIMINGS)
+        for name in TIMINGS - {'total', 'first_row'}:
+            self.assertGreaterEqual(timings[name], 0)
+            self.assertLessEqual(timings[name], timings['total'])
+
+    def test_write_csv(self):
+        self.connect()
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs, obj)
+
+        self.assertEqual(len(self.received), 1)
+        received = self.received[0]
+        self.assertEqual(received['sender'], Person)
+        self.assertEqual(received['queryset'], self.qs)
+        self.assertEqual(received['rows'], 3)
+        self.assertEqual(received['bytes'], len(obj.getvalue()))
+        self.assertTrue(received['completed'])
+        self.assertTimings(received['timings'])
+        self.assertLessEqual(received['timings']['first_row'],
+                             received['timings']['total'])
+
+    def test_progress(self):
+        self.connect()
+        reports = []
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs, obj, progress=reports.append)
+        self.assertEqual(reports[-1]['rows'], 3)
+        self.assertEqual(reports[-1]['bytes'], self.received[0]['bytes'])
+
+    def test_same_output(self):
+        def upper(name):
+            return name.upper()
+
+        expected = BytesIO()
+        djqscsv.write_csv(self.qs, expected,
+                          field_serializer_map={'name': upper})
+        self.connect()
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs, obj,
+                          field_serializer_map={'name': upper})
+        self.assertEqual(obj.getvalue(), expected.getvalue())
+
+    def test_empty_queryset(self):
+        self.connect()
+        djqscsv.write_csv(self.qs.none(), BytesIO())
+        received = self.received[0]
+        self.assertEqual(received['rows'], 0)
+        self.assertTrue(received['completed'])
+        self.assertIsNone(received['timings']['first_row'])
+
+    def test_abandoned_stream(self):
+        self.connect()
+        response = djqscsv.render_to_csv_response(self.qs, buffer_size=None)
+        content = iter(response.streaming_content)
+        for _ in range(3):
+            next(content)
+        self.assertEqual(self.received, [])
+        response.close()
+
+        received = self.received[0]
+        self.assertEqual(received['rows'], 1)
+        self.assertFalse(received['completed'])
+
+    def test_other_sender(self):
+        self.connect(sender=Activity)
+        with mock.patch.object(djqscsv, '_iter_instrumented_csv') as iterate:
+            djqscsv.write_csv(self.qs, BytesIO())
+        self.assertFalse(iterate.called)
+        self.assertEqual(self.received, [])
+
+        djqscsv.write_csv(Activity.objects.all(), BytesIO())
+        self.assertEqual(self.received[0]['rows'], 2)
+
+    def test_no_receivers(self):
+        with mock.patch.object(djqscsv, '_iter_instrumented_csv') as iterate:
+            djqscsv.write_csv(self.qs, BytesIO())
+        self.assertFalse(iterate.called)
+
+    def test_copy(self):
+        self.connect()
+        output = b'1,vetch\n2,nemmerle\n'
+        obj = BytesIO()
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(connection, 'Database', PSYCOPG2), \
+                mock.patch.object(djqscsv, '_compile_copy_sql'), \
+                mock.patch.object(djqscsv, '_iter_copy',
+                                  return_value=iter([output])):
+            djqscsv.write_csv(self.qs.values('id', 'name'), obj,
+                              use_copy=True)
+
+        received = self.received[0]
+        self.assertIsNone(received['rows'])
+        self.assertEqual(received['bytes'], len(obj.getvalue()))
+        self.assertTrue(obj.getvalue().endswith(output))
+        self.assertTrue(received['completed'])
+        self.assertTimings(received['timings'])
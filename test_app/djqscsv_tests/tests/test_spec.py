@@ -0,0 +1,159 @@
+import pickle
+import shutil
+import tempfile
+
+from io import BytesIO
+
+from djqscsv_tests.context import djqscsv, cache, spec
+
+from djqscsv_tests.context import SELECT
+
+from djqscsv_tests.models import Activity, Person
+
+from djqscsv_tests.tests.test_csv_creation import CSVTestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def _upper(value):
+    return value.upper()
+
+
+class ExportSpecTests(CSVTestCase):
+
+    def setUp(self):
+        super(ExportSpecTests, self).setUp()
+        self.spec = spec.ExportSpec(
+            Person, ['name', 'address', 'hobby__name'],
+            field_header_map={'hobby__name': 'Hobby'},
+            field_serializer_map={'name': _upper},
+            field_order=['hobby__name'], delimiter=';')
+
+    def write(self, qs=None, export_spec=None, **kwargs):
+        obj = BytesIO()
+        (export_spec or self.spec).write_csv(
+            self.qs if qs is None else qs, obj, **kwargs)
+        return obj.getvalue()
+
+    def test_same_output_as_options(self):
+        obj = BytesIO()
+        djqscsv.write_csv(self.qs.values('name', 'address', 'hobby__name'),
+                          obj, **self.spec.kwargs)
+        self.assertEqual(self.write(), obj.getvalue())
+
+    def test_output(self):
+        self.assertMatchesCsv(
+            self.write().splitlines(),
+            [['Hobby', "Person's name", 'address'],
+             ['Doing Magic', 'VETCH', 'iffish'],
+             ['Resting', 'NEMMERLE', 'roke'],
+             ['Resting', 'GED', 'gont']],
+            delimiter=';')
+
+    def test_default_fields(self):
+        person_spec = spec.ExportSpec(Person)
+        self.assertMatchesCsv(
+            self.write(export_spec=person_spec).splitlines(),
+            self.FULL_PERSON_CSV)
+
+    def test_values_queryset(self):
+        # the spec decides the columns, whatever the queryset selects
+        self.assertEqual(self.write(self.qs.values('id')), self.write())
+
+    def test_filtered_queryset(self):
+        output = self.write(self.qs.filter(name='ged'))
+        self.assertEqual(output.splitlines()[1:], [b'Resting;GED;gont'])
+
+    def test_set_up_once(self):
+        self.assertEqual(self.spec.layout.encoded_header,
+                         b'Hobby;Person\'s name;address\r\n')
+        with mock.patch.object(djqscsv, '_ExportLayout') as layout:
+            self.write()
+            self.write(write_header=False, use_iterator=False)
+        self.assertFalse(layout.called)
+
+    def test_related_fields(self):
+        activity_spec = spec.ExportSpec(
+            Activity, ['name'], related_fields=['person__name'],
+            use_verbose_names=False)
+        self.assertMatchesCsv(
+            self.write(Activity.objects.order_by('name'),
+                       activity_spec).splitlines(),
+            [['name', 'person__name'],
+             ['Doing Magic', 'vetch'],
+             ['Resting', 'ged, nemmerle']])
+
+    def test_render_to_csv_response(self):
+        response = self.spec.render_to_csv_response(self.qs,
+                                                    filename='people')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=people.csv;')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.write())
+
+    def test_export_spec_argument(self):
+        response = djqscsv.render_to_csv_response(self.qs,
+                                                  export_spec=self.spec,
+                                                  streaming=False)
+        self.assertEqual(response.content, self.write())
+
+    def test_pickle(self):
+        restored = pickle.loads(pickle.dumps(self.spec))
+        self.assertEqual(repr(restored), repr(self.spec))
+        self.assertEqual(self.write(export_spec=restored), self.write())
+
+    def test_cache_key(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        export_cache = cache.ExportCache(directory)
+        other_spec = spec.ExportSpec(Person, ['name', 'address'],
+                                     delimiter=';')
+        self.assertNotEqual(
+            export_cache.get_key(self.qs, {'export_spec': self.spec}),
+            export_cache.get_key(self.qs, {'export_spec': other_spec}))
+
+    def test_invalid_field(self):
+        with self.assertRaises(djqscsv.CSVException):
+            spec.ExportSpec(Person, ['name', 'missing'])
+
+    def test_invalid_related_field(self):
+        with self.assertRaises(djqscsv.CSVException):
+            spec.ExportSpec(Person, ['name'],
+                            related_fields=['hobby__missing'])
+
+    def test_unknown_columns(self):
+        for option in ({'field_header_map': {'missing': 'Missing'}},
+                       {'field_serializer_map': {'missing': _upper}},
+                       {'field_order': ['missing']}):
+            with self.assertRaises(djqscsv.CSVException):
+                spec.ExportSpec(Person, ['name'], **option)
+
+    def test_invalid_csv_options(self):
+        with self.assertRaises(djqscsv.CSVException):
+            spec.ExportSpec(Person, ['name'], delimiter=';;')
+        with self.assertRaises(djqscsv.CSVException):
+            spec.ExportSpec(Person, ['name'], no_such_option=True)
+
+    def test_export_option_in_spec(self):
+        with self.assertRaises(djqscsv.CSVException):
+            spec.ExportSpec(Person, ['name'], use_iterator=False)
+
+    def test_layout_option_in_export(self):
+        with self.assertRaises(djqscsv.CSVException):
+            self.write(field_header_map={'name': 'Name'})
+        with self.assertRaises(djqscsv.CSVException):
+            self.write(delimiter='|')
+
+    def test_other_model(self):
+        with self.assertRaises(djqscsv.CSVException):
+            self.write(Activity.objects.all())
+
+    def test_selected_columns(self):
+        person_spec = spec.ExportSpec(Person, ['name', 'info'],
+                                      use_verbose_names=False)
+        self.assertMatchesCsv(
+            self.write(export_spec=person_spec).splitlines(),
+            SELECT(self.FULL_PERSON_CSV_NO_VERBOSE, 'name', 'info'))
@@ -42,12 +42,29 @@ class ValidateCleanFilenameTests(TestCase):
                           djqscsv._validate_and_clean_filename,
                           'gont.csv.island')
 
+    def test_validate_other_extension(self):
+        validated = djqscsv._validate_and_clean_filename('hort.town.zip',
+                                                         extension='.zip')
+        self.assertEqual(validated, 'horttown.zip')
+        self.assertRaises(ValidationError,
+                          djqscsv._validate_and_clean_filename,
+                          'gont.csv', extension='.zip')
+
+
+class SerializeRowTests(TestCase):
+
+    def sanitize(self, field_serializer_map, record, **kwargs):
+        field_names = sorted(record)
+        serializers = djqscsv._compile_serializers(
+            field_names, field_serializer_map, **kwargs)
+        get_values = djqscsv._values_getter(field_names)
+        row = djqscsv._serialize_row(serializers, get_values(record))
+        return dict(zip(field_names, row))
 
-class SanitizeUnicodeRecordTests(TestCase):
     def test_sanitize(self):
         record = {'name': 'Tenar',
                   'nickname': u'\ufeffThe White Lady of Gont'}
-        sanitized = djqscsv._sanitize_record({}, record)
+        sanitized = self.sanitize({}, record)
         self.assertEqual(sanitized,
                          {'name': 'Tenar',
                           'nickname': u'\ufeffThe White Lady of Gont'})
@@ -55,11 +72,31 @@ class SanitizeUnicodeRecordTests(TestCase):
     def test_sanitize_date(self):
         record = {'name': 'Tenar',
                   'created': datetime.datetime(1, 1, 1)}
-        sanitized = djqscsv._sanitize_record({}, record)
+        sanitized = self.sanitize({}, record)
         self.assertEqual(sanitized,
                          {'name': 'Tenar',
                           'created': '0001-01-01T00:00:00'})
 
+    def test_sanitize_non_text(self):
+        record = {'age': 40, 'height': 1.5, 'alive': True,
+                  'born': datetime.date(1, 1, 1)}
+        sanitized = self.sanitize({}, record)
+        self.assertEqual(sanitized,
+                         {'age': '40', 'height': '1.5', 'alive': 'True',
+                          'born': '0001-01-01'})
+
+    def test_sanitize_single_field(self):
+        self.assertEqual(self.sanitize({}, {'name': 'Tenar'}),
+                         {'name': 'Tenar'})
+
+    def test_sanitize_none(self):
+        record = {'name': 'Tenar', 'created': None}
+        serializer = {'created': lambda d: d.strftime('%Y-%m-%d')}
+        self.assertEqual(self.sanitize(serializer, record),
+                         {'name': 'Tenar', 'created': ''})
+        self.assertEqual(self.sanitize(serializer, record, restval='NULL'),
+                         {'name': 'Tenar', 'created': 'NULL'})
+
     def test_sanitize_date_with_non_string_formatter(self):
         """
         This test is only to make sure an edge case provides a sane
@@ -68,14 +105,14 @@ class SanitizeUnicodeRecordTests(TestCase):
         """
         record = {'name': 'Tenar'}
         serializer = {'name': lambda d: len(d)}
-        sanitized = djqscsv._sanitize_record(serializer, record)
+        sanitized = self.sanitize(serializer, record)
         self.assertEqual(sanitized, {'name': '5'})
 
     def test_sanitize_date_with_formatter(self):
         record = {'name': 'Tenar',
                   'created': datetime.datetime(1973, 5, 13)}
         serializer = {'created': lambda d: d.strftime('%Y-%m-%d')}
-        sanitized = djqscsv._sanitize_record(serializer, record)
+        sanitized = self.sanitize(serializer, record)
         self.assertEqual(sanitized,
                          {'name': 'Tenar',
                           'created': '1973-05-13'})
@@ -84,7 +121,65 @@ class SanitizeUnicodeRecordTests(TestCase):
         record = {'name': 'Tenar',
                   'created': datetime.datetime(1973, 5, 13)}
         with self.assertRaises(AttributeError):
-            djqscsv._sanitize_record(attrgetter('day'), record)
+            self.sanitize(attrgetter('day'), record)
+
+
+class BufferChunksTests(TestCase):
+
+    CHUNKS = [b'abc', b'de', b'fgh', b'i']
+
+    def test_buffer_by_size(self):
+        buffered = djqscsv._buffer_chunks(self.CHUNKS, 4)
+        self.assertEqual(list(buffered), [b'abcde', b'fghi'])
+
+    def test_buffer_by_rows(self):
+        buffered = djqscsv._buffer_chunks(self.CHUNKS, None, buffer_rows=3)
+        self.assertEqual(list(buffered), [b'abcdefgh', b'i'])
+
+    def test_buffer_flushes_remainder(self):
+        buffered = djqscsv._buffer_chunks(self.CHUNKS, 1024)
+        self.assertEqual(list(buffered), [b'abcdefghi'])
+
+    def test_buffer_flush_interval(self):
+        buffered = djqscsv._buffer_chunks(self.CHUNKS, 1024,
+                                          flush_interval=0)
+        self.assertEqual(list(buffered), self.CHUNKS)
+
+    def test_buffer_header_chunks(self):
+        buffered = djqscsv._buffer_chunks(self.CHUNKS, 1024, header_chunks=2)
+        self.assertEqual(list(buffered), [b'abcde', b'fghi'])
+
+
+class IterInThreadTests(TestCase):
+
+    def test_iter_in_thread(self):
+        def produce(emit):
+            for value in range(100):
+                emit(value)
+
+        self.assertEqual(list(djqscsv._iter_in_thread(produce, 2)),
+                         list(range(100)))
+
+    def test_iter_in_thread_raises(self):
+        def produce(emit):
+            emit(1)
+            raise ValueError('broken')
+
+        with self.assertRaises(ValueError):
+            list(djqscsv._iter_in_thread(produce))
+
+    def test_iter_in_thread_close_stops_producer(self):
+        emitted = []
+
+        def produce(emit):
+            for value in range(100):
+                emit(value)
+                emitted.append(value)
+
+        values = djqscsv._iter_in_thread(produce, 1)
+        self.assertEqual(next(values), 0)
+        values.close()
+        self.assertLess(len(emitted), 100)
 
 
 class AppendDatestampTests(TestCase):
@@ -94,6 +189,10 @@ class AppendDatestampTests(TestCase):
         stamped = djqscsv._append_datestamp(filename)
         self.assertRegexpMatches(stamped, r'the_reach_[0-9]{8}.csv')
 
+    def test_other_extension(self):
+        stamped = djqscsv._append_datestamp('the_reach.zip', extension='.zip')
+        self.assertRegexpMatches(stamped, r'the_reach_[0-9]{8}.zip')
+
     def test_no_extension_raises(self):
         filename = "iffish"
         self.assertRaises(ValidationError,
@@ -1,4 +1,8 @@
-from django.conf.urls import url
+try:
+    from django.urls import re_path as url
+except ImportError:
+    # Django < 2.0
+    from django.conf.urls import url
 from djqscsv_tests import views
 
 urlpatterns = (
@@ -1,5 +1,16 @@
+from unittest import skipUnless
+
+from django.db import connection
+
 from .models import Person, Activity
 
+# other threads only see the in-memory SQLite test database where it can be
+# shared, which Django < 2.0 doesn't do on Python 2. other databases always
+# can be.
+skipUnlessThreadsShareDatabase = skipUnless(
+    getattr(connection.features, 'can_share_in_memory_db', True),
+    "other threads can't see the test database")
+
 
 def create_people_and_get_queryset():
     doing_magic, _ = Activity.objects.get_or_create(name="Doing Magic")
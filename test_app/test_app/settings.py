@@ -1,3 +1,11 @@
+import os
+import sys
+
+# the djqscsv app must be importable before the settings are loaded
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '../..'))
+
 
 DATABASES = {
     'default': {
@@ -10,8 +18,11 @@ MIDDLEWARE_CLASSES = ()
 
 SECRET_KEY = 'NO_SECRET_KEY'
 
-INSTALLED_APPS = ('djqscsv_tests',)
+INSTALLED_APPS = ('djqscsv', 'djqscsv_tests')
 
 ROOT_URLCONF = 'djqscsv_tests.urls'
 
 DEBUG = True
+
+# Django 3.2+ warns about implicit primary key types
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'